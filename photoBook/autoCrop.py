@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+顕著度マップによる自動トリミング
+
+プレビューから輝度の勾配と局所的なコントラストで顕著度マップ(最大 SALIENCY_SIZE px)を作成し、
+PreviewData に保持する。セルの縦横比が決まると、顕著度の合計が最大になる切り抜き位置を
+累積和(summed-area table)で全位置まとめて求め、PhotoInfo の offset_x, offset_y, scale に変換する。
+"""
+from typing import NamedTuple
+import numpy as np
+from .imageIO import pil_image
+SALIENCY_SIZE = 64
+"""顕著度マップの最大辺(px)"""
+AUTO_CROP_SCALES = (1.0, 1.1, 1.2, 1.35, 1.5)
+"""試す拡大率(セルをちょうど埋める倍率に対する倍率)"""
+AUTO_CROP_KEEP = 0.95
+"""拡大しても等倍の切り抜きの顕著度をこの割合以上残せる場合だけ拡大する"""
+VARIANCE_FLOOR = 1e-10
+"""これ以下の局所的な分散は累積和の丸め誤差とみなす(1画素だけ1階調違う場合でも 1e-7 程度ある)"""
+
+
+class CropFit(NamedTuple):
+    """自動トリミングの結果(PhotoInfo の値)"""
+    offset_x: float
+    offset_y: float
+    scale: float
+    kept: float
+    """切り抜き範囲に残る顕著度の割合"""
+
+
+def box_filter(values, radius):
+    # type: (np.ndarray, int) -> np.ndarray
+    """(2 * radius + 1) 四方の平均(端は範囲内の画素だけで平均する。values と同じ型で返す)"""
+    height, width = values.shape
+    table = np.zeros((height + 1, width + 1), dtype=np.float64)
+    table[1:, 1:] = values.cumsum(0, dtype=np.float64).cumsum(1)
+    y0 = np.clip(np.arange(height) - radius, 0, height)
+    y1 = np.clip(np.arange(height) + radius + 1, 0, height)
+    x0 = np.clip(np.arange(width) - radius, 0, width)
+    x1 = np.clip(np.arange(width) + radius + 1, 0, width)
+    sums = (table[y1][:, x1] - table[y0][:, x1] - table[y1][:, x0] + table[y0][:, x0])
+    area = (y1 - y0)[:, np.newaxis] * (x1 - x0)[np.newaxis, :]
+    return (sums / area).astype(values.dtype, copy=False)
+
+
+def saliency_map(image):
+    # type: (Image.Image) -> np.ndarray
+    """画像の顕著度マップ(合計が1の float32 配列)"""
+    gray = image.convert("L")
+    ratio = SALIENCY_SIZE / float(max(gray.size))
+    if ratio < 1.0:
+        gray = gray.resize((max(1, int(gray.width * ratio)), max(1, int(gray.height * ratio))), pil_image().BOX)
+    luma = np.asarray(gray, dtype=np.float32) / 255.0
+    # 輝度の勾配(エッジ)
+    grad_x = np.zeros_like(luma)
+    grad_y = np.zeros_like(luma)
+    grad_x[:, 1:-1] = luma[:, 2:] - luma[:, :-2]
+    grad_y[1:-1, :] = luma[2:, :] - luma[:-2, :]
+    energy = np.hypot(grad_x, grad_y)
+    # 局所的なコントラスト(標準偏差)で、模様やテクスチャの多い領域も拾う
+    # float32 では E[x^2] - E[x]^2 の丸め誤差が平坦な画像でもコントラストに見えるので float64 で計算する
+    radius = max(1, max(luma.shape) // 16)
+    luma64 = luma.astype(np.float64)
+    mean = box_filter(luma64, radius)
+    variance = box_filter(luma64 * luma64, radius) - mean * mean
+    contrast = np.sqrt(np.where(variance > VARIANCE_FLOOR, variance, 0.0)).astype(np.float32)
+    saliency = box_filter(energy + contrast, radius)
+    # 平坦な画像は中央で切り抜かれるように、全体に小さな値を足す
+    saliency += saliency.mean() * 0.05 + 1e-6
+    return (saliency / saliency.sum()).astype(np.float32)
+
+
+def saliency_for(preview_data):
+    # type: (PreviewData) -> np.ndarray
+    """プレビューの顕著度マップ(作成済みなら PreviewData に保持しているものを使う)"""
+    if preview_data.saliency is None:
+        source = preview_data.level_for(SALIENCY_SIZE, SALIENCY_SIZE)
+        preview_data.saliency = saliency_map(source)
+    return preview_data.saliency
+
+
+def best_window(saliency, window_width, window_height):
+    # type: (np.ndarray, float, float) -> tuple[float, float, float]
+    """顕著度の合計が最大になる窓の (合計, 中心x, 中心y)(中心は 0-1 の比率)
+
+    同じ合計の位置が複数ある場合は画像の中心に近い位置にする。
+    """
+    height, width = saliency.shape
+    win_w = int(min(width, max(1, round(window_width))))
+    win_h = int(min(height, max(1, round(window_height))))
+    table = np.zeros((height + 1, width + 1), dtype=np.float64)
+    table[1:, 1:] = saliency.cumsum(0, dtype=np.float64).cumsum(1)
+    sums = (table[win_h:, win_w:] - table[:-win_h, win_w:] - table[win_h:, :-win_w] + table[:-win_h, :-win_w])
+    ys, xs = np.mgrid[0:sums.shape[0], 0:sums.shape[1]]
+    distance = np.hypot(xs - (width - win_w) / 2.0, ys - (height - win_h) / 2.0)
+    index = np.unravel_index(np.argmax(sums - distance * 1e-9), sums.shape)
+    y, x = int(index[0]), int(index[1])
+    return float(sums[y, x]), (x + win_w / 2.0) / width, (y + win_h / 2.0) / height
+
+
+def fit_crop(saliency, source_size, rotation, cell_width, cell_height, canvas_width, canvas_height,
+             scales=AUTO_CROP_SCALES, keep=AUTO_CROP_KEEP):
+    # type: (np.ndarray, tuple[int, int], float, float, float, float, float, tuple, float) -> CropFit
+    """セルに顕著な部分が入る offset_x, offset_y, scale を計算
+
+    cell_width, cell_height はセルの大きさ、canvas_width, canvas_height は offset の基準の大きさ(同じ単位)。
+    画像は PhotoBlockItem.paint と同じく、元の向きでセルを覆う倍率 * scale で拡大してから回転する。
+    回転は90度単位に丸めて扱う。
+    """
+    quarter = int(round(rotation / 90.0)) % 4
+    # paint は時計回りに回転するので、マップも時計回りに回転する
+    saliency = np.rot90(saliency, -quarter)
+    map_height, map_width = saliency.shape
+    iw, ih = source_size
+    rotated_w, rotated_h = (ih, iw) if quarter % 2 else (iw, ih)
+    base_ratio = max(cell_width / float(iw), cell_height / float(ih))
+    # 回転後の画像がセルをちょうど覆う scale
+    cover_scale = max(cell_width / (base_ratio * rotated_w), cell_height / (base_ratio * rotated_h))
+
+    candidates = []
+    for scale in scales:
+        display_w = rotated_w * base_ratio * cover_scale * scale
+        display_h = rotated_h * base_ratio * cover_scale * scale
+        kept, center_x, center_y = best_window(
+            saliency, map_width * cell_width / display_w, map_height * cell_height / display_h)
+        candidates.append((scale, kept, center_x, center_y, display_w, display_h))
+    base_kept = candidates[0][1]
+    scale, kept, center_x, center_y, display_w, display_h = [
+        candidate for candidate in candidates if candidate[1] >= base_kept * keep][-1]
+    return CropFit((0.5 - center_x) * display_w / canvas_width, (0.5 - center_y) * display_h / canvas_height,
+                   cover_scale * scale, kept)
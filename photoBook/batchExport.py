@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+保存したレイアウトの一括出力
+
+    python -m photoBook.batchExport レイアウトのフォルダー 出力先フォルダー --format jpg --workers 4
+
+レイアウトファイル(save_layout 形式の JSON)のページごとに1つのジョブを作り、プロセスプールで並列に出力する。
+--format pdf の場合はレイアウトごとに全ページを1つの PDF にする。
+
+出力先フォルダーのマニフェストに「入力のハッシュ -> 出力パス」を完了するたびに記録し、
+再実行時は入力(ページの内容、用紙設定、保存オプション、参照している画像の更新日時とサイズ)が
+変わっておらず、出力ファイルが残っているジョブを飛ばす。途中で中断しても完了した分はやり直さない。
+失敗したジョブは記録して次のジョブに進み、一括出力全体は止めない。
+"""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple, Optional
+from .bookExport import book_snapshots, page_contexts, render_book
+from .exportRenderer import (
+    ENCODE_FORMATS, PDF_COMPRESSIONS, EncodeOptions, ExportCanceled, render_export, snapshot_from_layout)
+MANIFEST_NAME = ".photo_book_batch.json"
+MANIFEST_VERSION = 1
+BYTES_PER_PIXEL = 8
+"""1ジョブが出力画像の1画素あたりに使うメモリの目安(RGB のキャンバス + 描画中のブロック + エンコード)"""
+MEMORY_BUDGET_RATIO = 0.75
+"""ワーカー数を決める時に使ってよい空きメモリの割合"""
+LAYOUT_KEYS = ("input_context", "photo_context")
+"""save_layout 形式のレイアウトファイルに必ずあるキー"""
+MAX_RETRIES = 1
+"""ワーカーが落ちた時に巻き添えになったジョブをやり直す回数"""
+
+
+class BatchJob(NamedTuple):
+    """1つの出力"""
+    layout_path: str
+    page: Optional[int]
+    """出力するページ番号(None の場合は全ページを1つの PDF にする)"""
+    out_path: str
+    key: str
+    """入力のハッシュ"""
+    pixels: int
+    """出力する1ページの画素数(ワーカー数の見積もりに使う)"""
+    retries: int = 0
+    """ワーカーが落ちてやり直した回数"""
+
+
+class BatchResult(NamedTuple):
+    """1ジョブの結果"""
+    job: BatchJob
+    status: str
+    """"done", "skipped", "failed" のいずれか"""
+    seconds: float
+    error: Optional[str] = None
+
+
+# =================================
+# Jobs
+# =================================
+def layout_files(paths):
+    # type: (list[str]) -> list[str]
+    """ファイルとフォルダーの一覧からレイアウトファイル(.json)を取得(フォルダーは直下のみ)"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(".json") and name != MANIFEST_NAME)
+        else:
+            files.append(path)
+    return files
+
+
+def output_stems(files):
+    # type: (list[str]) -> list[str]
+    """レイアウトファイルごとの出力ファイル名(拡張子なし)
+
+    別のフォルダーにある同じ名前のレイアウトはフォルダー名を前に付け、それでも重なる場合は連番を付ける。
+    """
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in files]
+    counts = collections.Counter(stem.lower() for stem in stems)
+    result, used = [], set()
+    for path, stem in zip(files, stems):
+        if counts[stem.lower()] > 1:
+            stem = "%s_%s" % (os.path.basename(os.path.dirname(os.path.abspath(path))), stem)
+        name, number = stem, 1
+        while name.lower() in used:
+            number += 1
+            name = "%s_%d" % (stem, number)
+        used.add(name.lower())
+        result.append(name)
+    return result
+
+
+def load_layout(layout_path):
+    # type: (str) -> dict
+    """レイアウトファイルを読み込む(save_layout 形式でない JSON は ValueError)"""
+    with open(layout_path, "r", encoding="utf-8") as f:
+        context = json.load(f)
+    if not isinstance(context, dict):
+        raise ValueError("レイアウトファイルではありません")
+    missing = [key for key in LAYOUT_KEYS if key not in context]
+    if missing:
+        raise ValueError("レイアウトファイルではありません(%s がありません)" % ", ".join(missing))
+    return context
+
+
+def _image_states(context):
+    # type: (dict) -> list
+    """参照している画像の (パス, 更新日時, サイズ)(画像が差し替えられたら出力し直す)"""
+    states = []
+    for blk_data in context.get("photo_context", []):
+        path = blk_data.get("file_path")
+        if not path:
+            continue
+        try:
+            stat = os.stat(path)
+            states.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            states.append((path, None, None))
+    return states
+
+
+def job_key(context, image_format, options, output_name=""):
+    # type: (dict, str, EncodeOptions, str) -> str
+    """出力結果に影響する入力だけからハッシュを作成(ウィンドウサイズなどは含めない)
+
+    同じ内容のレイアウトが複数あっても別の出力として記録されるように出力ファイル名も含める。
+    """
+    state = {
+        "output_name": output_name,
+        "input_context": context.get("input_context", {}),
+        "photo_context": context.get("photo_context", []),
+        "images": _image_states(context),
+        "format": image_format,
+        "options": list(options),
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def batch_jobs(paths, out_dir, ext=".png", options=None):
+    # type: (list[str], str, str, EncodeOptions) -> tuple[list[BatchJob], list[BatchResult]]
+    """レイアウトファイルからジョブを作成
+
+    読み込めないレイアウトと save_layout 形式でない JSON は失敗した結果として返す。
+    """
+    options = options or EncodeOptions()
+    jobs, failures = [], []
+    files = layout_files(paths)
+    for layout_path, stem in zip(files, output_stems(files)):
+        try:
+            context = load_layout(layout_path)
+            pages = page_contexts(context)
+            snapshots = [snapshot_from_layout(page) for page in pages]
+        except Exception as e:
+            job = BatchJob(layout_path, None, os.path.join(out_dir, stem + ext), "", 0)
+            failures.append(BatchResult(job, "failed", 0.0, "%s: %s" % (type(e).__name__, e)))
+            continue
+        pixels = max(snapshot.width * snapshot.height for snapshot in snapshots)
+        if ext == ".pdf":
+            keys = "".join(job_key(page, "PDF", options, stem + ext) for page in pages)
+            jobs.append(BatchJob(layout_path, None, os.path.join(out_dir, stem + ext),
+                                 hashlib.sha1(keys.encode("utf-8")).hexdigest(), pixels))
+            continue
+        for index, page in enumerate(pages):
+            name = stem + ext if len(pages) == 1 else "%s_p%02d%s" % (stem, index + 1, ext)
+            jobs.append(BatchJob(layout_path, index, os.path.join(out_dir, name),
+                                 job_key(page, ENCODE_FORMATS[ext], options, name), pixels))
+    return jobs, failures
+
+
+def run_job(job, options):
+    # type: (BatchJob, EncodeOptions) -> BatchResult
+    """1ジョブを出力(ワーカープロセスで呼ばれる。例外は結果に入れて返す)"""
+    start = time.perf_counter()
+    try:
+        context = load_layout(job.layout_path)
+        if job.page is None:
+            render_book(book_snapshots(context), job.out_path, options)
+        else:
+            render_export(snapshot_from_layout(page_contexts(context)[job.page]), job.out_path, options)
+    except Exception as e:
+        return BatchResult(job, "failed", time.perf_counter() - start,
+                           "%s: %s\n%s" % (type(e).__name__, e, traceback.format_exc(limit=3)))
+    return BatchResult(job, "done", time.perf_counter() - start)
+
+
+def available_memory():
+    # type: () -> int | None
+    """空きメモリ(bytes、取得できない環境では None)"""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def pool_size(jobs, max_workers=None, memory=None):
+    # type: (list[BatchJob], int, int) -> int
+    """CPU数と、最も大きいページを同時に出力しても空きメモリに収まる数の小さい方"""
+    workers = max_workers or os.cpu_count() or 1
+    memory = memory if memory is not None else available_memory()
+    largest = max((job.pixels for job in jobs), default=0)
+    if memory and largest:
+        workers = min(workers, int(memory * MEMORY_BUDGET_RATIO // (largest * BYTES_PER_PIXEL)))
+    return max(1, min(workers, len(jobs) or 1))
+
+
+# =================================
+# Manifest
+# =================================
+class BatchManifest:
+    """完了した出力の記録(入力のハッシュ -> 出力パス)
+
+    1ジョブ完了するたびに一時ファイル経由で書き換えるので、中断してもそれまでの記録は残る。
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+        self.outputs = {}  # type: dict[str, dict]
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.outputs = data.get("outputs", {})
+        except (OSError, ValueError):
+            pass
+
+    def is_done(self, job):
+        # type: (BatchJob) -> bool
+        """同じ入力の出力が記録されていて、そのファイルが残っているか"""
+        entry = self.outputs.get(job.key)
+        return bool(entry) and entry.get("output") == job.out_path and os.path.isfile(job.out_path)
+
+    def record(self, result):
+        # type: (BatchResult) -> None
+        job = result.job
+        self.outputs[job.key] = {"output": job.out_path, "layout": job.layout_path, "page": job.page,
+                                 "seconds": round(result.seconds, 3), "completed_at": time.time()}
+        self.save()
+
+    def save(self):
+        # type: () -> None
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "outputs": self.outputs}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+# =================================
+# Batch
+# =================================
+def export_batch(paths, out_dir, ext=".png", options=None, max_workers=None, progress=None,
+                 cancel_event=None):
+    # type: (list[str], str, str, EncodeOptions, int, callable, threading.Event) -> list[BatchResult]
+    """レイアウトファイルを並列に出力し、ジョブごとの結果を返す
+
+    progress(result, done, total) はジョブが終わる(飛ばす)たびに呼ばれる。
+    cancel_event がセットされると実行中のジョブの完了を待って ExportCanceled を送出する。
+    """
+    options = options or EncodeOptions()
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = BatchManifest(os.path.join(out_dir, MANIFEST_NAME))
+    jobs, failures = batch_jobs(paths, out_dir, ext, options)
+    total = len(jobs) + len(failures)
+    results = []  # type: list[BatchResult]
+
+    def report(result):
+        results.append(result)
+        if progress:
+            progress(result, len(results), total)
+
+    for result in failures:
+        report(result)
+    queue = []
+    for job in jobs:
+        if manifest.is_done(job):
+            report(BatchResult(job, "skipped", 0.0))
+        else:
+            queue.append(job)
+    if not queue:
+        return results
+
+    workers = pool_size(queue, max_workers)
+    queue.reverse()
+    executor = ProcessPoolExecutor(max_workers=workers)
+    in_flight = {}
+    retry_queue = []  # type: list[BatchJob]
+    try:
+        while queue or retry_queue or in_flight:
+            canceled = cancel_event is not None and cancel_event.is_set()
+            # 実行中 + 待ちのジョブはワーカー数の2倍まで(ジョブ数が多くても Future を溜めない)
+            while queue and len(in_flight) < workers * 2 and not canceled:
+                job = queue.pop()
+                in_flight[executor.submit(run_job, job, options)] = job
+            # やり直すジョブは最後に1つずつ実行し、ワーカーを落とすジョブの巻き添えにならないようにする
+            if retry_queue and not queue and not in_flight and not canceled:
+                job = retry_queue.pop(0)
+                in_flight[executor.submit(run_job, job, options)] = job
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in finished:
+                job = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    broken = True
+                    # どのジョブがワーカーを落としたかは分からないので、巻き添えの分も含めてやり直す
+                    if job.retries < MAX_RETRIES:
+                        retry_queue.append(job._replace(retries=job.retries + 1))
+                        continue
+                    result = BatchResult(job, "failed", 0.0, "ワーカーが終了しました(メモリ不足など): %s" % e)
+                except Exception as e:
+                    result = BatchResult(job, "failed", 0.0, "%s: %s" % (type(e).__name__, e))
+                if result.status == "done":
+                    manifest.record(result)
+                report(result)
+            if broken:
+                # 壊れたプールでは残りを実行できないので、実行中だったジョブを戻して作り直す
+                queue.extend(reversed(list(in_flight.values())))
+                in_flight.clear()
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=workers)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    if cancel_event is not None and cancel_event.is_set():
+        raise ExportCanceled()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="保存したレイアウトをまとめて出力する(完了したものは再実行時に飛ばす)")
+    parser.add_argument("inputs", nargs="+", help="レイアウトファイル(.json)またはそのフォルダー")
+    parser.add_argument("out_dir", help="出力先フォルダー(マニフェストもここに保存する)")
+    parser.add_argument("--format", default="png", choices=[ext.lstrip(".") for ext in ENCODE_FORMATS] + ["pdf"],
+                        help="出力形式(pdf はレイアウトごとに全ページを1つの PDF にする)")
+    parser.add_argument("--workers", type=int, default=None, help="並列数(省略時は CPU 数と空きメモリから決める)")
+    parser.add_argument("--quality", type=int, default=EncodeOptions().quality)
+    parser.add_argument("--pdf-compression", default=EncodeOptions().pdf_compression, choices=PDF_COMPRESSIONS)
+    parser.add_argument("--report", help="ジョブごとの結果を JSON で保存する")
+    args = parser.parse_args(argv)
+
+    options = EncodeOptions(quality=args.quality, pdf_compression=args.pdf_compression)
+
+    def progress(result, done, total):
+        job = result.job
+        page = "" if job.page is None else " p%d" % (job.page + 1)
+        print("[%d/%d] %-7s %7.2fs %s%s -> %s" % (done, total, result.status, result.seconds,
+                                                  os.path.basename(job.layout_path), page, job.out_path))
+        if result.error:
+            print("    " + result.error.strip().replace("\n", "\n    "))
+
+    results = export_batch(args.inputs, args.out_dir, "." + args.format, options, args.workers, progress)
+    counts = {status: sum(1 for result in results if result.status == status)
+              for status in ("done", "skipped", "failed")}
+    print("完了 %(done)d / スキップ %(skipped)d / 失敗 %(failed)d" % counts)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump([{"layout": result.job.layout_path, "page": result.job.page, "output": result.job.out_path,
+                        "status": result.status, "seconds": result.seconds, "error": result.error}
+                       for result in results], f, ensure_ascii=False, indent=1)
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+ヘッドレスのベンチマーク
+
+    python -m photoBook.benchmark                      # 全ケースを実行
+    python -m photoBook.benchmark --save-baseline      # 結果をベースラインとして保存
+    python -m photoBook.benchmark -k export            # 名前に export を含むケースだけ実行
+
+QT_QPA_PLATFORM=offscreen で動作し、合成したJPEG/PNG/HEICを入力に使う。
+各ケースは別プロセスで実行し、処理時間とピークRSSを計測する。
+ベースラインより閾値以上遅くなった、またはピークRSSが増えたケースがあれば終了コード1を返す。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from .define import *
+ROOT_PATH = Path(__file__).parent.parent
+BASELINE_FILE = ROOT_PATH / "benchmark_baseline.json"
+FIXTURE_SIZES = {
+    "jpg": (4032, 3024),
+    "png": (3000, 2000),
+    "heic": (4032, 3024),
+}
+FIXTURE_COUNT = 6
+MAX_FILLED_BLOCKS = 48
+"""画像を割り当てるセルの上限(残りは空のセルのまま、まとめて描画する経路を通す)"""
+PAINT_ZOOM_LEVELS = (0.25, 1.0, 4.0)
+PAINT_LAYOUT = "横 default"
+EXPORT_SIZE_PRESETS = (
+    'L判 1052 x 1500 px (300 DPI)',
+    'A4 2480 x 3508 px (300 DPI)',
+    'A3 4677 x 6614 px (400 DPI)',
+)
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.2
+
+
+# =================================
+# Fixtures
+# =================================
+def make_fixture_image(width, height, seed):
+    # type: (int, int, int) -> Image.Image
+    """グラデーションとノイズで写真に近い画像を作成"""
+    from PIL import Image, ImageChops
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40 + seed * 5)
+    red = ImageChops.add(gradient, noise, scale=2.0)
+    green = gradient.rotate(90 * (seed % 4)).resize((width, height))
+    blue = ImageChops.multiply(noise, gradient.transpose(Image.FLIP_LEFT_RIGHT))
+    return Image.merge("RGB", (red, green, blue))
+
+
+def is_valid_fixture(path):
+    # type: (str) -> bool
+    """作成済みの画像が開けるか(中断した実行で壊れたファイルを再利用しない)"""
+    from .imageIO import pil_image
+    try:
+        with pil_image().open(path) as image:
+            image.verify()
+    except Exception:
+        return False
+    return True
+
+
+def make_fixtures(fixture_dir, count=FIXTURE_COUNT):
+    # type: (str, int) -> dict[str, list[str]]
+    """形式ごとにベンチマーク用の画像を作成(作成済みで壊れていなければ再利用)
+
+    一時ファイルに保存してから置き換えるので、中断しても書きかけのファイルは残らない。
+    """
+    from .imageIO import pil_image
+    Image = pil_image()  # HEIFの保存も有効にする
+    fixtures = {}
+    for ext, (width, height) in FIXTURE_SIZES.items():
+        paths = []
+        for index in range(count):
+            path = os.path.join(fixture_dir, "fixture_%02d.%s" % (index, ext))
+            if not os.path.isfile(path) or not is_valid_fixture(path):
+                image = make_fixture_image(width, height, index)
+                if index % 2:
+                    image = image.transpose(Image.ROTATE_90)
+                tmp_path = os.path.join(fixture_dir, "fixture_%02d.tmp.%s" % (index, ext))
+                try:
+                    image.save(tmp_path, quality=90)
+                    os.replace(tmp_path, path)
+                except (KeyError, OSError, ValueError):
+                    # HEIFのエンコーダーが無い環境では HEIC を省略する
+                    break
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+            paths.append(path)
+        if paths:
+            fixtures[ext] = paths
+    return fixtures
+
+
+def all_fixture_paths(fixtures):
+    # type: (dict[str, list[str]]) -> list[str]
+    return [path for paths in fixtures.values() for path in paths]
+
+
+# =================================
+# Helpers
+# =================================
+def _application():
+    from PySide6 import QtWidgets
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def _setup_view(layout_name, size_preset, image_paths):
+    # type: (str, str, list[str]) -> PhotoCollageView
+    """画像を割り当てたビューを作成(プレビューのデコードは画像ごとに1回)
+
+    画像を割り当てるのは先頭の MAX_FILLED_BLOCKS 個のセルだけで、元画像は開かない(出力時に開く)。
+    """
+    from .imageIO import decode_preview
+    from .photoCollageView import PhotoCollageView
+    _application()
+    view = PhotoCollageView()
+    view.resize(1200, 900)
+    width, height, dpi = SIZE_PRESETS[size_preset]
+    view.export_width, view.export_height, view.dpi = height, width, dpi
+    view.set_block_layout(layout_name, LAYOUT_PRESETS[layout_name])
+    previews = [(path, decode_preview(path)) for path in image_paths]
+    for index, blk in enumerate(view.blocks[:min(view.block_count, MAX_FILLED_BLOCKS)]):
+        path, preview_data = previews[index % len(previews)]
+        blk.image_path = path
+        blk.set_preview(preview_data)
+    return view
+
+
+def _timed_runs(func, repeat):
+    # type: (callable, int) -> dict
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {"seconds": times[0], "median_seconds": times[len(times) // 2]}
+
+
+# =================================
+# Cases
+# =================================
+def bench_decode(fixtures, ext, repeat):
+    from .imageIO import decode_preview
+    paths = fixtures[ext]
+
+    def run():
+        for path in paths:
+            decode_preview(path)
+    result = _timed_runs(run, repeat)
+    result["per_image_ms"] = result["seconds"] / len(paths) * 1000.0
+    return result
+
+
+def bench_paint(fixtures, zoom, repeat):
+    from PySide6 import QtGui, QtWidgets
+    view = _setup_view(PAINT_LAYOUT, EXPORT_SIZE_PRESETS[1], all_fixture_paths(fixtures))
+    view.draw_layout()
+    # paint は描画先の倍率に合わせた解像度で縮小するので、ズームで縮小の仕事量が変わる
+    view.setTransform(QtGui.QTransform.fromScale(zoom, zoom))
+    items = list(view._photo_block_items)
+    max_width = max(item.boundingRect().width() for item in items) * zoom
+    max_height = max(item.boundingRect().height() for item in items) * zoom
+    target = QtGui.QImage(int(max_width) + 1, int(max_height) + 1, QtGui.QImage.Format_ARGB32_Premultiplied)
+    option = QtWidgets.QStyleOptionGraphicsItem()
+
+    def run():
+        # 前回の縮小結果を使い回さず、毎回縮小から計測する
+        for item in items:
+            item._image_buffer.clear()
+        painter = QtGui.QPainter(target)
+        for item in items:
+            rect = item.boundingRect()
+            painter.save()
+            painter.setTransform(view.transform())
+            painter.translate(-rect.x(), -rect.y())
+            item.paint(painter, option, None)
+            painter.restore()
+        painter.end()
+    result = _timed_runs(run, repeat)
+    result["per_item_ms"] = result["seconds"] / len(items) * 1000.0
+    return result
+
+
+def bench_draw_layout(fixtures, layout_name, repeat):
+    view = _setup_view(layout_name, EXPORT_SIZE_PRESETS[1], all_fixture_paths(fixtures))
+    result = _timed_runs(view.draw_layout, repeat)
+    result["blocks"] = view.block_count
+    return result
+
+
+def bench_export(fixtures, size_preset, repeat):
+    view = _setup_view(PAINT_LAYOUT, size_preset, all_fixture_paths(fixtures))
+    view.draw_layout()
+    with tempfile.TemporaryDirectory() as out_dir:
+        out_path = os.path.join(out_dir, "export.png")
+        return _timed_runs(lambda: view.export_image(out_path), repeat)
+
+
+def build_cases():
+    # type: () -> dict[str, tuple]
+    """ケース名と (関数, 引数) の辞書"""
+    cases = {}
+    for ext in FIXTURE_SIZES:
+        cases["decode/%s" % ext] = (bench_decode, ext)
+    for zoom in PAINT_ZOOM_LEVELS:
+        cases["paint/zoom%s" % zoom] = (bench_paint, zoom)
+    for layout_name in LAYOUT_PRESETS:
+        cases["draw_layout/%s" % layout_name] = (bench_draw_layout, layout_name)
+    for size_preset in EXPORT_SIZE_PRESETS:
+        cases["export/%s" % size_preset] = (bench_export, size_preset)
+    return cases
+
+
+# =================================
+# Runner
+# =================================
+def peak_rss_mb():
+    # type: () -> float | None
+    """このプロセスのピークRSS(MB)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024.0 / 1024.0
+    return peak / 1024.0
+
+
+def run_case(name, fixture_dir, repeat):
+    # type: (str, str, int) -> dict
+    """1ケースをこのプロセスで実行"""
+    func, arg = build_cases()[name]
+    fixtures = make_fixtures(fixture_dir)
+    if func is bench_decode and arg not in fixtures:
+        return {"skipped": "fixture unavailable"}
+    result = func(fixtures, arg, repeat)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_isolated(name, fixture_dir, repeat):
+    # type: (str, str, int) -> dict
+    """ピークRSSを分けるためにケースごとに子プロセスで実行"""
+    command = [sys.executable, "-m", "photoBook.benchmark", "--case", name,
+               "--fixtures", fixture_dir, "--repeat", str(repeat)]
+    process = subprocess.run(command, cwd=str(ROOT_PATH), capture_output=True, text=True)
+    lines = process.stdout.strip().splitlines()
+    # 結果を出力した後の終了処理(Qt の破棄)で落ちた場合も、計測結果は使う
+    if lines and lines[-1].startswith("{"):
+        return json.loads(lines[-1])
+    return {"error": process.stderr.strip().splitlines()[-1:] or ["failed"]}
+
+
+def compare(results, baseline, threshold):
+    # type: (dict, dict, float) -> dict[str, list[str]]
+    """ベースラインより劣化したケース名と、劣化した項目("time" / "rss")を取得"""
+    regressions = {}
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        degraded = []
+        if "seconds" in base and "seconds" in result and result["seconds"] > base["seconds"] * (1.0 + threshold):
+            degraded.append("time")
+        base_rss, rss = base.get("peak_rss_mb"), result.get("peak_rss_mb")
+        if base_rss and rss and rss > base_rss * (1.0 + threshold):
+            degraded.append("rss")
+        if degraded:
+            regressions[name] = degraded
+    return regressions
+
+
+def print_report(results, baseline, regressions):
+    # type: (dict, dict, dict[str, list[str]]) -> None
+    print("%-48s %10s %10s %10s %10s %12s" % ("case", "time(ms)", "base(ms)", "rss(MB)", "base(MB)", ""))
+    labels = {"time": "SLOWER", "rss": "MORE-RSS"}
+    for name, result in results.items():
+        if "seconds" not in result:
+            print("%-48s %s" % (name, result.get("error") or result.get("skipped")))
+            continue
+        base = baseline.get(name, {})
+        print("%-48s %10.1f %10s %10s %10s %12s" % (
+            name, result["seconds"] * 1000.0,
+            "%.1f" % (base["seconds"] * 1000.0) if base.get("seconds") else "-",
+            "%.1f" % result["peak_rss_mb"] if result.get("peak_rss_mb") else "-",
+            "%.1f" % base["peak_rss_mb"] if base.get("peak_rss_mb") else "-",
+            ",".join(labels[kind] for kind in regressions.get(name, []))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PhotoBook のヘッドレスベンチマーク")
+    parser.add_argument("-k", "--keyword", default="", help="ケース名に含まれる文字列で絞り込む")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--fixtures", default=os.path.join(tempfile.gettempdir(), "photobook_bench_fixtures"))
+    parser.add_argument("--baseline", default=str(BASELINE_FILE))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="処理時間かピークRSSがこの割合以上増えたら劣化とみなす")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.fixtures, exist_ok=True)
+    if args.case:
+        print(json.dumps(run_case(args.case, args.fixtures, args.repeat)))
+        return 0
+
+    make_fixtures(args.fixtures)
+    results = {}
+    for name in build_cases():
+        if args.keyword in name:
+            results[name] = run_isolated(name, args.fixtures, args.repeat)
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    print_report(results, baseline, regressions)
+
+    if args.save_baseline:
+        baseline.update({name: result for name, result in results.items() if "seconds" in result})
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=4, ensure_ascii=False)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+複数ページのフォトブック
+
+ページごとにレイアウト名とブロックの状態(PhotoCollageView.context() 形式)だけを保持する。
+デコード済みのプレビューは表示中のページと前後のページの分だけ残し、
+それ以外のページは画像パスなどのメタデータのみにするので、ページ数が増えてもメモリは増えない。
+"""
+import os
+from .imageIO import resolve_path
+RESIDENT_PAGE_RADIUS = 1
+"""表示中のページの前後何ページ分のプレビューを保持するか"""
+
+
+class BookPage:
+    """1ページ分のレイアウト情報"""
+    def __init__(self, layout_name, blocks=None):
+        # type: (str, list[dict]) -> None
+        self.layout_name = layout_name
+        self.blocks = blocks or []  # type: list[dict]
+        """PhotoCollageView.context() 形式のブロック情報"""
+
+    def image_paths(self):
+        # type: () -> list[str]
+        return [blk_data["file_path"] for blk_data in self.blocks if blk_data.get("file_path")]
+
+    def context(self):
+        # type: () -> dict
+        return {"layout": self.layout_name, "photo_context": self.blocks}
+
+
+class BookDocument:
+    """ページのリストと、表示中の付近のページのプレビューを保持する"""
+
+    def __init__(self, layout_name="横 default"):
+        # type: (str) -> None
+        self.pages = [BookPage(layout_name)]  # type: list[BookPage]
+        self.current = 0
+        """表示中のページ番号"""
+        self._previews = {}  # type: dict[str, PreviewData]
+
+    @property
+    def current_page(self):
+        # type: () -> BookPage
+        return self.pages[self.current]
+
+    # =================================
+    # Pages
+    # =================================
+    def add_page(self, index=None, layout_name=None):
+        # type: (int, str) -> int
+        """ページを追加して、そのページ番号を返す(既定では表示中のページの次)"""
+        index = self.current + 1 if index is None else index
+        self.pages.insert(index, BookPage(layout_name or self.current_page.layout_name))
+        if index <= self.current:
+            self.current += 1
+        return index
+
+    def remove_page(self, index):
+        # type: (int) -> None
+        """ページを削除(最後の1ページは削除しない)"""
+        if len(self.pages) <= 1:
+            return
+        del self.pages[index]
+        if index < self.current or self.current >= len(self.pages):
+            self.current = max(0, self.current - 1)
+        self._evict()
+
+    def move_page(self, source, destination):
+        # type: (int, int) -> None
+        """ページの順番を入れ替え(表示中のページは同じページを指したままにする)"""
+        current_page = self.current_page
+        self.pages.insert(destination, self.pages.pop(source))
+        self.current = self.pages.index(current_page)
+        self._evict()
+
+    def store_page(self, index, layout_name, blocks, previews=None):
+        # type: (int, str, list[dict], dict[str, PreviewData]) -> None
+        """編集中のページの状態を保存し、デコード済みのプレビューを引き取る"""
+        page = self.pages[index]
+        page.layout_name = layout_name
+        page.blocks = blocks
+        resident = self.resident_paths()
+        for path, preview_data in (previews or {}).items():
+            if preview_data is not None and path in resident:
+                self._previews[path] = preview_data
+
+    def set_current(self, index):
+        # type: (int) -> BookPage
+        """表示するページを切り替え、範囲外になったページのプレビューを破棄する"""
+        self.current = max(0, min(index, len(self.pages) - 1))
+        self._evict()
+        return self.current_page
+
+    # =================================
+    # Previews
+    # =================================
+    def resident_pages(self):
+        # type: () -> list[BookPage]
+        """プレビューを保持するページ(表示中のページを先頭に、前後のページ)"""
+        indexes = [self.current]
+        for offset in range(1, RESIDENT_PAGE_RADIUS + 1):
+            indexes.extend([self.current + offset, self.current - offset])
+        return [self.pages[i] for i in indexes if 0 <= i < len(self.pages)]
+
+    def resident_paths(self):
+        # type: () -> set[str]
+        return {path for page in self.resident_pages() for path in page.image_paths()}
+
+    def preview(self, path):
+        # type: (str) -> PreviewData | None
+        """保持しているプレビュー(PhotoCollageView.set_context の preview_provider に渡す)"""
+        preview_data = self._previews.get(path)
+        if preview_data is not None and not self._is_current(path, preview_data):
+            del self._previews[path]
+            return None
+        return preview_data
+
+    def put_preview(self, path, preview_data):
+        # type: (str, PreviewData) -> None
+        """前後のページで使う画像のプレビューのみ保持する"""
+        if preview_data is not None and path in self.resident_paths():
+            self._previews[path] = preview_data
+
+    def preview_sources(self):
+        # type: () -> dict[str, PreviewData]
+        """保持しているプレビュー(画像パス -> PreviewData)"""
+        return dict(self._previews)
+
+    def missing_previews(self):
+        # type: () -> list[str]
+        """前後のページで使うのにまだ保持していない画像パス"""
+        paths = []
+        for page in self.resident_pages()[1:]:
+            for path in page.image_paths():
+                if path not in self._previews and path not in paths:
+                    paths.append(path)
+        return paths
+
+    def nbytes(self):
+        # type: () -> int
+        return sum(preview_data.nbytes() for preview_data in self._previews.values())
+
+    def _evict(self):
+        # type: () -> None
+        resident = self.resident_paths()
+        for path in [path for path in self._previews if path not in resident]:
+            del self._previews[path]
+
+    @staticmethod
+    def _is_current(path, preview_data):
+        # type: (str, PreviewData) -> bool
+        try:
+            stat = os.stat(resolve_path(path))
+        except OSError:
+            return True
+        return preview_data.mtime is None or preview_data.mtime == stat.st_mtime
+
+    # =================================
+    # Context
+    # =================================
+    def context(self):
+        # type: () -> dict
+        return {"current_page": self.current, "pages": [page.context() for page in self.pages]}
+
+    def set_context(self, context):
+        # type: (dict) -> None
+        pages = [BookPage(page.get("layout", "横 default"), page.get("photo_context", []))
+                 for page in context.get("pages", [])]
+        self.pages = pages or [BookPage("横 default")]
+        self._previews.clear()
+        self.current = max(0, min(context.get("current_page", 0), len(self.pages) - 1))
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+複数ページのブック出力(PDF / マルチページTIFF)
+
+    python -m photoBook.bookExport layout.json book.pdf
+
+BookDocument の全ページを1ページずつ描画し、描画したページはすぐにファイルへ追記して解放する。
+同時にメモリにあるページは常に1枚なので、ページ数が増えてもピークのメモリ使用量は1ページ分と変わらない。
+PDF は画像を1枚ずつストリームとして書き出す簡易ライタ、TIFF は Pillow の AppendingTiffWriter を使う。
+どちらもページの DPI から用紙サイズ(解像度)を埋め込む。
+"""
+import argparse
+import json
+import os
+import zlib
+from .define import SIZE_SWITCH_LAYOUT
+from .exportRenderer import (
+    PDF_COMPRESSIONS, EncodeOptions, ExportCanceled, render_canvas, save_options, snapshot_from_layout)
+from .perfMonitor import PERF, timed
+BOOK_FORMATS = {
+    ".pdf": "PDF",
+    ".tif": "TIFF",
+    ".tiff": "TIFF",
+}
+BOOK_FILE_FILTER = "PDF Files (*.pdf);;TIFF Files (*.tif)"
+PDF_STRIP_ROWS = 256
+"""flate 圧縮で一度に圧縮する行数"""
+
+
+def book_format(path):
+    # type: (str) -> str
+    """拡張子からブックの保存形式を取得"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in BOOK_FORMATS:
+        raise ValueError("対応していないブックの形式です: %s" % ext)
+    return BOOK_FORMATS[ext]
+
+
+def page_contexts(context):
+    # type: (dict) -> list[dict]
+    """save_layout 形式のレイアウト情報をページごとのレイアウト情報に分ける
+
+    input_context の layout と size_switch は保存時に表示していたページのものなので、
+    ページのレイアウトから決め直す(ToolBarWidget と同じく SIZE_SWITCH_LAYOUT のレイアウトは縦向き)。
+    ページの無い古いレイアウトは photo_context を1ページとして扱う。
+    """
+    pages = (context.get("book") or {}).get("pages")
+    if not pages:
+        return [dict(context)]
+    input_context = context.get("input_context", {})
+    contexts = []
+    for page in pages:
+        page_input = dict(input_context)
+        if page.get("layout"):
+            page_input.update(layout=page["layout"], size_switch=page["layout"] in SIZE_SWITCH_LAYOUT)
+        contexts.append(dict(context, input_context=page_input, photo_context=page.get("photo_context", [])))
+    return contexts
+
+
+def book_snapshots(context):
+    # type: (dict) -> list[ExportSnapshot]
+    """save_layout 形式のレイアウト情報から全ページのスナップショットを作成"""
+    return [snapshot_from_layout(page) for page in page_contexts(context)]
+
+
+class PdfWriter:
+    """ページ画像を1枚ずつ追記する PDF ライタ
+
+    ページ(/Pages)の一覧とクロスリファレンスは close() で最後に書くので、
+    書き終わったページの画像を保持しておく必要がない。
+    """
+
+    def __init__(self, fp):
+        # type: (io.BufferedWriter) -> None
+        self._fp = fp
+        self._offsets = {}  # type: dict[int, int]
+        self._page_ids = []  # type: list[int]
+        self._next_id = 3
+        # 1: Catalog, 2: Pages(最後に書く)
+        self._fp.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self._write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+    @property
+    def page_count(self):
+        # type: () -> int
+        return len(self._page_ids)
+
+    def add_page(self, image, dpi=None, options=None):
+        # type: (Image.Image, int, EncodeOptions) -> None
+        """RGB 画像を1ページとして追記(用紙サイズは dpi から計算)"""
+        options = options or EncodeOptions()
+        image_id, length_id, contents_id, page_id = self._reserve(4)
+        width, height = image.size
+        dpi = dpi or 72
+        page_w, page_h = width * 72.0 / dpi, height * 72.0 / dpi
+
+        if options.pdf_compression == "flate":
+            stream_filter = b"/FlateDecode"
+        else:
+            stream_filter = b"/DCTDecode"
+        self._begin_object(image_id)
+        self._fp.write(b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB "
+                       b"/BitsPerComponent 8 /Filter %s /Length %d 0 R >>\nstream\n"
+                       % (width, height, stream_filter, length_id))
+        start = self._fp.tell()
+        if options.pdf_compression == "flate":
+            self._write_flate(image, options.compress_level)
+        else:
+            image.save(self._fp, "JPEG", **save_options("JPEG", dpi, options))
+        length = self._fp.tell() - start
+        self._fp.write(b"\nendstream\nendobj\n")
+        self._write_object(length_id, b"%d" % length)
+
+        contents = b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (page_w, page_h)
+        self._write_object(contents_id, b"<< /Length %d >>\nstream\n%s\nendstream" % (len(contents), contents))
+        self._write_object(page_id, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] "
+                                    b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+                           % (page_w, page_h, image_id, contents_id))
+        self._page_ids.append(page_id)
+
+    def close(self):
+        # type: () -> None
+        """ページの一覧とクロスリファレンスを書く"""
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self._page_ids)
+        self._write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._page_ids)))
+        xref = self._fp.tell()
+        self._fp.write(b"xref\n0 %d\n0000000000 65535 f \n" % self._next_id)
+        for object_id in range(1, self._next_id):
+            self._fp.write(b"%010d 00000 n \n" % self._offsets[object_id])
+        self._fp.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self._next_id, xref))
+
+    def _reserve(self, count):
+        # type: (int) -> list[int]
+        ids = list(range(self._next_id, self._next_id + count))
+        self._next_id += count
+        return ids
+
+    def _begin_object(self, object_id):
+        # type: (int) -> None
+        self._offsets[object_id] = self._fp.tell()
+        self._fp.write(b"%d 0 obj\n" % object_id)
+
+    def _write_object(self, object_id, body):
+        # type: (int, bytes) -> None
+        self._begin_object(object_id)
+        self._fp.write(body + b"\nendobj\n")
+
+    def _write_flate(self, image, level):
+        # type: (Image.Image, int) -> None
+        """ページ全体のバイト列を作らずに、数百行ずつ圧縮して書き出す"""
+        compressor = zlib.compressobj(level)
+        width, height = image.size
+        for top in range(0, height, PDF_STRIP_ROWS):
+            strip = image.crop((0, top, width, min(height, top + PDF_STRIP_ROWS)))
+            self._fp.write(compressor.compress(strip.tobytes()))
+        self._fp.write(compressor.flush())
+
+
+@timed("book_export")
+def render_book(snapshots, out_path, options=None, progress=None, cancel_event=None, tile_cache=None):
+    # type: (list[ExportSnapshot], str, EncodeOptions, callable, threading.Event, TileCache) -> int
+    """全ページを描画して1つの PDF / TIFF に保存し、ページ数を返す
+
+    progress(done, total) は全ページ通してのブロック数で呼ばれる。
+    tile_cache を渡すとページをまたいでタイルが残るので、既定では使わない。
+    一時ファイルに書き出してから置き換えるので、キャンセルしても壊れたファイルは残らない。
+    """
+    image_format = book_format(out_path)
+    options = options or EncodeOptions()
+    total = sum(len(snapshot.blocks) for snapshot in snapshots)
+
+    def write_pages(add_page):
+        # type: (callable) -> None
+        done = 0
+        for number, snapshot in enumerate(snapshots):
+            if cancel_event is not None and cancel_event.is_set():
+                raise ExportCanceled()
+            page_progress = (lambda index, _, done=done: progress(done + index, total)) if progress else None
+            with PERF.measure("book_page", page=number + 1):
+                canvas = render_canvas(snapshot, page_progress, cancel_event, tile_cache)
+            with PERF.measure("book_encode", page=number + 1):
+                add_page(snapshot, canvas)
+            # 次のページを描画する前に解放する
+            del canvas
+            done += len(snapshot.blocks)
+
+    tmp_path = "%s.tmp%s" % (out_path, os.path.splitext(out_path)[1])
+    try:
+        if image_format == "PDF":
+            with open(tmp_path, "wb") as fp:
+                writer = PdfWriter(fp)
+                write_pages(lambda snapshot, canvas: writer.add_page(canvas, snapshot.dpi, options))
+                writer.close()
+        else:
+            from PIL import TiffImagePlugin
+            with TiffImagePlugin.AppendingTiffWriter(tmp_path, True) as tiff:
+                def add_tiff_page(snapshot, canvas):
+                    canvas.save(tiff, "TIFF", **save_options("TIFF", snapshot.dpi, options))
+                    tiff.newFrame()
+                write_pages(add_tiff_page)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return len(snapshots)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="保存したレイアウトの全ページを PDF / マルチページTIFF に出力する")
+    parser.add_argument("layout", help="save_layout で保存したレイアウト(JSON)")
+    parser.add_argument("out_path", help="保存先(.pdf / .tif)")
+    parser.add_argument("--quality", type=int, default=EncodeOptions().quality)
+    parser.add_argument("--pdf-compression", default=EncodeOptions().pdf_compression, choices=PDF_COMPRESSIONS)
+    parser.add_argument("--tiff-compression", default=EncodeOptions().tiff_compression)
+    args = parser.parse_args(argv)
+
+    with open(args.layout, "r", encoding="utf-8") as f:
+        context = json.load(f)
+    options = EncodeOptions(quality=args.quality, tiff_compression=args.tiff_compression,
+                            pdf_compression=args.pdf_compression)
+    count = render_book(book_snapshots(context), args.out_path, options)
+    print("%d ページを保存しました: %s" % (count, args.out_path))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
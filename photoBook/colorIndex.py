@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+色の特徴量による類似度の索引
+
+プレビューを FEATURE_SIZE px 以下に縮小して Lab 色空間に変換し、
+平均と標準偏差(色味と明るさ、そのばらつき)と、明度と色度の粗いヒストグラムを
+FEATURE_DIM 次元の float32 ベクトルにまとめる(1枚 104 bytes)。
+ヒストグラムは平方根を取っておくので、ベクトルのユークリッド距離がそのまま類似度の距離になる。
+
+ColorIndex は特徴量を (N, FEATURE_DIM) の配列で持ち、k近傍の検索、似た順の並べ替え、
+容量付きのクラスタリング(ページ分け)を NumPy でまとめて計算する。数千枚でも1秒かからない。
+特徴量は PhotoIndex に保存し、次回からはプレビューをデコードせずに使う。
+"""
+import os
+import numpy as np
+from .imageIO import pil_image
+FEATURE_VERSION = 1
+"""特徴量の計算方法を変えたら上げる(保存済みの特徴量を作り直す)"""
+FEATURE_SIZE = 32
+"""特徴量を計算する画像の最大辺(px)"""
+L_BINS = 4
+AB_BINS = 4
+AB_RANGE = 64.0
+"""色度(a, b)のヒストグラムの範囲(±)"""
+MOMENT_WEIGHT = 2.0
+"""ヒストグラムに対する平均・標準偏差の重み"""
+FEATURE_DIM = 6 + L_BINS + AB_BINS * AB_BINS
+CLUSTER_ITERATIONS = 20
+# sRGB(D65) -> XYZ
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]], dtype=np.float32)
+_WHITE = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+
+
+def rgb_to_lab(rgb):
+    # type: (np.ndarray) -> np.ndarray
+    """(..., 3) の uint8 の sRGB を Lab(L: 0-100, a/b: おおよそ ±128)に変換"""
+    rgb = rgb.astype(np.float32) / 255.0
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    lab = np.empty_like(f)
+    lab[..., 0] = 116.0 * f[..., 1] - 16.0
+    lab[..., 1] = 500.0 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200.0 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+def color_feature(image):
+    # type: (Image.Image) -> np.ndarray
+    """画像の色の特徴量(FEATURE_DIM 次元の float32)"""
+    image = image.convert("RGB")
+    ratio = FEATURE_SIZE / float(max(image.size))
+    if ratio < 1.0:
+        image = image.resize((max(1, int(image.width * ratio)), max(1, int(image.height * ratio))),
+                             pil_image().BOX)
+    lab = rgb_to_lab(np.asarray(image)).reshape(-1, 3)
+    moments = np.concatenate([lab.mean(0), lab.std(0)]) / 100.0 * MOMENT_WEIGHT
+    l_hist = np.bincount(np.clip((lab[:, 0] * (L_BINS / 100.0)).astype(np.int32), 0, L_BINS - 1),
+                         minlength=L_BINS)
+    ab = np.clip(((lab[:, 1:] + AB_RANGE) * (AB_BINS / (2.0 * AB_RANGE))).astype(np.int32), 0, AB_BINS - 1)
+    ab_hist = np.bincount(ab[:, 0] * AB_BINS + ab[:, 1], minlength=AB_BINS * AB_BINS)
+    hists = np.concatenate([l_hist, ab_hist]).astype(np.float32) / float(len(lab))
+    return np.concatenate([moments, np.sqrt(hists)]).astype(np.float32)
+
+
+def feature_for(preview_data):
+    # type: (PreviewData) -> np.ndarray
+    """プレビューの色の特徴量(作成済みなら PreviewData に保持しているものを使う)"""
+    if preview_data.color_feature is None:
+        preview_data.color_feature = color_feature(preview_data.level_for(FEATURE_SIZE, FEATURE_SIZE))
+    return preview_data.color_feature
+
+
+def load_features(photo_index, paths):
+    # type: (PhotoIndex, list[str]) -> dict[str, np.ndarray]
+    """PhotoIndex に保存した特徴量のうち、ファイルが変わっていないものを取得"""
+    features = {}
+    for path, (mtime_ns, size, blob) in photo_index.get_color_features(paths, FEATURE_VERSION).items():
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if stat.st_mtime_ns == mtime_ns and stat.st_size == size:
+            features[path] = np.frombuffer(blob, dtype=np.float32)
+    return features
+
+
+def store_features(photo_index, features):
+    # type: (PhotoIndex, dict[str, np.ndarray]) -> None
+    """特徴量を PhotoIndex に保存(ファイルの更新日時とサイズも記録する)"""
+    rows = []
+    for path, feature in features.items():
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        rows.append((path, stat.st_mtime_ns, stat.st_size, np.asarray(feature, dtype=np.float32).tobytes()))
+    if rows:
+        photo_index.put_color_features(rows, FEATURE_VERSION)
+
+
+class ColorIndex:
+    """色の特徴量の索引"""
+
+    def __init__(self, paths, features):
+        # type: (list[str], np.ndarray | list[np.ndarray]) -> None
+        self.paths = list(paths)
+        self.features = np.asarray(features, dtype=np.float32).reshape(len(self.paths), FEATURE_DIM)
+        self._positions = {path: index for index, path in enumerate(self.paths)}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def distances(self, query):
+        # type: (str | np.ndarray) -> np.ndarray
+        """query(パスまたは特徴量)から全画像への距離"""
+        if isinstance(query, str):
+            query = self.features[self._positions[query]]
+        return np.sqrt(((self.features - query) ** 2).sum(1))
+
+    def knn(self, query, k=10):
+        # type: (str | np.ndarray, int) -> list[tuple[str, float]]
+        """query に近い順に k 枚の (パス, 距離)(query がパスの場合は自身を除く)"""
+        distances = self.distances(query)
+        if isinstance(query, str):
+            distances[self._positions[query]] = np.inf
+        k = min(k, len(self.paths))
+        nearest = np.argpartition(distances, k - 1)[:k] if k else np.array([], dtype=np.int64)
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        return [(self.paths[i], float(distances[i])) for i in nearest if np.isfinite(distances[i])]
+
+    def order(self, indexes=None):
+        # type: (np.ndarray) -> list[int]
+        """隣り合う画像が似るように並べた順番(画像の番号)
+
+        全体の平均から最も遠い画像から始め、まだ並べていない中で最も近い画像を順につなぐ。
+        """
+        indexes = np.arange(len(self.paths)) if indexes is None else np.asarray(indexes)
+        if len(indexes) == 0:
+            return []
+        features = self.features[indexes]
+        # |x - c|^2 = |x|^2 - 2 x・c + |c|^2 の |c|^2 は比較に不要なので、1ステップは行列とベクトルの積1回
+        norms_left = (features * features).sum(1)
+        current = int(np.argmax(((features - features.mean(0)) ** 2).sum(1)))
+        ordered = []
+        for _ in range(len(indexes)):
+            ordered.append(current)
+            norms_left[current] = np.inf
+            if len(ordered) == len(indexes):
+                break
+            current = int(np.argmin(norms_left - 2.0 * (features @ features[current])))
+        return [int(indexes[i]) for i in ordered]
+
+    def sorted_paths(self):
+        # type: () -> list[str]
+        """似た順に並べたパス"""
+        return [self.paths[i] for i in self.order()]
+
+    def cluster(self, count, capacity=None, iterations=CLUSTER_ITERATIONS, seed=0):
+        # type: (int, int, int, int) -> list[list[str]]
+        """count 個のグループに分け、各グループを似た順に並べたパスのリストを返す
+
+        capacity を指定すると1グループの枚数をそれ以下にする(ページのセル数など)。
+        k-means(k-means++ で初期化)で中心を求め、容量を守りながら近い中心から順に割り当てる。
+        グループの並びも中心が似た順にする。
+        """
+        total = len(self.paths)
+        count = max(1, min(count, total))
+        if total == 0:
+            return []
+        capacity = max(capacity or 0, -(-total // count))
+        centers = self._kmeans(count, iterations, np.random.default_rng(seed))
+        assignment = _assign_with_capacity(_squared_distances(self.features, centers), capacity)
+        center_order = ColorIndex([str(i) for i in range(count)], centers).order()
+        groups = []
+        for center in center_order:
+            members = np.flatnonzero(assignment == center)
+            if len(members):
+                groups.append([self.paths[i] for i in self.order(members)])
+        return groups
+
+    def _kmeans(self, count, iterations, rng):
+        # type: (int, int, np.random.Generator) -> np.ndarray
+        features = self.features
+        norms = (features * features).sum(1)
+        first = rng.integers(len(features))
+        chosen = [first]
+        nearest = np.maximum(norms - 2.0 * (features @ features[first]) + norms[first], 0.0)
+        for _ in range(1, count):
+            total = nearest.sum()
+            index = rng.choice(len(features), p=nearest / total) if total > 0 else rng.integers(len(features))
+            chosen.append(index)
+            nearest = np.minimum(nearest, np.maximum(norms - 2.0 * (features @ features[index]) + norms[index], 0.0))
+        centers = features[chosen].astype(np.float32)
+        for _ in range(iterations):
+            labels = _squared_distances(features, centers, norms).argmin(1)
+            # 中心ごとの合計と枚数(メンバーのいない中心はそのまま)
+            counts = np.bincount(labels, minlength=count)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, labels, features)
+            updated = centers.copy()
+            filled = counts > 0
+            updated[filled] = sums[filled] / counts[filled, np.newaxis]
+            if np.allclose(updated, centers):
+                break
+            centers = updated
+        return centers
+
+
+def _squared_distances(features, centers, norms=None):
+    # type: (np.ndarray, np.ndarray, np.ndarray) -> np.ndarray
+    """(N, K) の距離の2乗(|x|^2 - 2 x・c + |c|^2 を行列の積1回で計算し、(N, K, D) の差は作らない)"""
+    if norms is None:
+        norms = (features * features).sum(1)
+    distances = norms[:, np.newaxis] - 2.0 * (features @ centers.T) + (centers * centers).sum(1)[np.newaxis, :]
+    return np.maximum(distances, 0.0)
+
+
+def _assign_with_capacity(distances, capacity):
+    # type: (np.ndarray, int) -> np.ndarray
+    """各画像を空きのある最も近い中心に割り当てる(中心ごとに capacity 枚まで)
+
+    未割り当ての画像がそれぞれ最も近い中心を選び、各中心は近い画像から空きの数だけ受け入れる。
+    一杯になった中心を候補から外して、全ての画像が割り当たるまで繰り返す(1回ごとに NumPy でまとめて処理する)。
+    """
+    total, count = distances.shape
+    distances = distances.copy()
+    assignment = np.full(total, -1)
+    loads = np.zeros(count, dtype=np.int64)
+    unassigned = np.arange(total)
+    while len(unassigned):
+        candidates = distances[unassigned]
+        choice = candidates.argmin(1)
+        # 中心ごと、距離の近い順に並べて、中心の中での順位を求める
+        order = np.lexsort((candidates[np.arange(len(unassigned)), choice], choice))
+        sorted_choice = choice[order]
+        rank = np.arange(len(order)) - np.searchsorted(sorted_choice, sorted_choice, side="left")
+        accepted = rank < capacity - loads[sorted_choice]
+        assignment[unassigned[order[accepted]]] = sorted_choice[accepted]
+        loads += np.bincount(sorted_choice[accepted], minlength=count)
+        distances[:, loads >= capacity] = np.inf
+        unassigned = unassigned[assignment[unassigned] < 0]
+    return assignment
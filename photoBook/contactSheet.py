@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+フォルダー単位のコンタクトシート(インデックスプリント)作成
+
+    python -m photoBook.contactSheet 撮影フォルダー 出力先/sheet.jpg --columns 6 --rows 8
+
+画像を tile_layout の格子に番号付きで並べ、必要なページ数に分けて保存する。
+サムネイルのデコードはプロセスプールで並列に行い、同時に処理する枚数を制限しながら
+1ページずつ合成・保存してすぐ解放するので、枚数が増えてもメモリ使用量は変わらない。
+"""
+import argparse
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Tuple
+from .define import *
+from .exportRenderer import ExportCanceled, EncodeOptions, save_image
+from .imageIO import image_orientation, orientation_transform, pil_image, transform_size, transpose_image
+from .perfMonitor import PERF
+LABEL_COLOR = (40, 40, 40)
+EMPTY_THUMBNAIL_COLOR = (200, 200, 200)
+"""読み込めなかった画像の枠の色"""
+
+
+class ContactSheetOptions(NamedTuple):
+    """コンタクトシートの体裁"""
+    columns: int = 6
+    rows: int = 8
+    width: int = 2480
+    height: int = 3508
+    dpi: int = 300
+    space_margin: int = 30
+    """サムネイル同士の間隔(px)"""
+    page_margin: int = 80
+    """ページの上下左右の余白(px)"""
+    label_height: int = 40
+    """番号とファイル名を書く高さ(px、0 の場合は書かない)"""
+    bg_color: Tuple[int, int, int] = (255, 255, 255)
+
+    @property
+    def per_page(self):
+        # type: () -> int
+        return self.columns * self.rows
+
+
+def sheet_cells(options):
+    # type: (ContactSheetOptions) -> list[tuple[int, int, int, int]]
+    """1ページ分のセルのピクセル範囲 (left, top, right, bottom)"""
+    cells = []
+    for rect_ratio in tile_layout(options.columns, options.rows):
+        x, y, w, h = apply_block_margins(rect_ratio, options.width, options.height, options.space_margin,
+                                         options.page_margin, options.page_margin)
+        cells.append((int(round(x * options.width)), int(round(y * options.height)),
+                      int(round((x + w) * options.width)), int(round((y + h) * options.height))))
+    return cells
+
+
+def thumbnail_box(cell, label_height):
+    # type: (tuple[int, int, int, int], int) -> tuple[int, int]
+    """セルの中でサムネイルに使える (幅, 高さ)"""
+    left, top, right, bottom = cell
+    return max(1, right - left), max(1, bottom - top - label_height)
+
+
+def decode_thumbnail(path, size):
+    # type: (str, tuple[int, int]) -> tuple[str, tuple[int, int], bytes] | None
+    """size に収まるサムネイルを作成(プロセスプールで実行するので画素をバイト列で返す)
+
+    EXIF の向きは縮小した後に転置して正す(縮小は元画像の向きのまま、向きを正した後に size に収まる大きさにする)。
+    """
+    try:
+        with pil_image().open(path) as image:
+            transform = orientation_transform(image_orientation(image))
+            box = transform_size(size, transform)
+            # JPEGは縮小デコードで必要な解像度の近くまで落としてから縮小する
+            image.draft("RGB", box)
+            image = image.convert("RGB")
+            image.thumbnail(box, pil_image().BICUBIC, reducing_gap=2.0)
+            image = transpose_image(image, transform)
+            return image.mode, image.size, image.tobytes()
+    except Exception:
+        return None
+
+
+def folder_images(folder, recursive=False):
+    # type: (str, bool) -> list[str]
+    """フォルダーの画像をパス順に取得"""
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith(IMAGE_EXTS))
+        if not recursive:
+            break
+    return paths
+
+
+def sheet_page_path(out_path, page, page_count):
+    # type: (str, int, int) -> str
+    """ページごとの保存先(sheet.jpg -> sheet_001.jpg)"""
+    root, ext = os.path.splitext(out_path)
+    return "%s_%0*d%s" % (root, max(3, len(str(page_count))), page + 1, ext)
+
+
+def _draw_label(draw, cell, label_height, text, font):
+    left, _, right, bottom = cell
+    # 入りきらない場合は後ろを省略する
+    try:
+        while len(text) > 3 and draw.textlength(text, font=font) > right - left:
+            text = text[:-4] + "..."
+        draw.text((left, bottom - label_height + label_height // 4), text, fill=LABEL_COLOR, font=font)
+    except UnicodeEncodeError:
+        # ビットマップフォントで書けないファイル名は番号だけにする
+        draw.text((left, bottom - label_height + label_height // 4), text.split()[0], fill=LABEL_COLOR,
+                  font=font)
+
+
+def render_contact_sheets(image_paths, out_path, options=None, encode_options=None, max_workers=None,
+                          progress=None, cancel_event=None):
+    # type: (list[str], str, ContactSheetOptions, EncodeOptions, int, callable, threading.Event) -> list[str]
+    """画像の一覧からコンタクトシートを作成して、保存したページのパスを返す
+
+    デコード中とデコード済みで合成待ちのサムネイルは max_workers * 2 枚までにする。
+    progress(done, total) は1枚合成するたびに呼ばれる。
+    """
+    Image = pil_image()
+    from PIL import ImageDraw, ImageFont
+    options = options or ContactSheetOptions()
+    cells = sheet_cells(options)
+    total = len(image_paths)
+    page_count = max(1, -(-total // options.per_page))
+    font = ImageFont.load_default()
+    max_workers = max_workers or os.cpu_count() or 1
+    max_in_flight = max_workers * 2
+    saved = []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = collections.deque()
+        next_index = 0
+        page = None
+        draw = None
+        for index in range(total):
+            # 順番に合成するので、先頭が終わるのを待つ間も後続のデコードを進めておく
+            while next_index < total and len(in_flight) < max_in_flight:
+                cell = cells[next_index % options.per_page]
+                in_flight.append(executor.submit(
+                    decode_thumbnail, image_paths[next_index], thumbnail_box(cell, options.label_height)))
+                next_index += 1
+            if cancel_event is not None and cancel_event.is_set():
+                for future in in_flight:
+                    future.cancel()
+                raise ExportCanceled()
+            thumbnail = in_flight.popleft().result()
+
+            slot = index % options.per_page
+            if page is None:
+                page = Image.new("RGB", (options.width, options.height), options.bg_color)
+                draw = ImageDraw.Draw(page)
+            cell = cells[slot]
+            box_width, box_height = thumbnail_box(cell, options.label_height)
+            if thumbnail is None:
+                draw.rectangle((cell[0], cell[1], cell[0] + box_width - 1, cell[1] + box_height - 1),
+                               fill=EMPTY_THUMBNAIL_COLOR)
+            else:
+                image = Image.frombytes(*thumbnail)
+                page.paste(image, (cell[0] + (box_width - image.width) // 2,
+                                   cell[1] + (box_height - image.height) // 2))
+            if options.label_height:
+                _draw_label(draw, cell, options.label_height,
+                            "%d  %s" % (index + 1, os.path.basename(image_paths[index])), font)
+            if progress:
+                progress(index + 1, total)
+
+            if slot == options.per_page - 1 or index == total - 1:
+                path = sheet_page_path(out_path, len(saved), page_count)
+                with PERF.measure("contact_sheet_page", page=len(saved) + 1):
+                    save_image(page, path, options.dpi, encode_options)
+                saved.append(path)
+                page = draw = None
+    return saved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="フォルダーの画像からコンタクトシートを作成する")
+    parser.add_argument("folder")
+    parser.add_argument("out_path", help="保存先(ページ番号を付けて保存する)")
+    parser.add_argument("--columns", type=int, default=ContactSheetOptions().columns)
+    parser.add_argument("--rows", type=int, default=ContactSheetOptions().rows)
+    parser.add_argument("--preset", default=DEFAULT_SIZE_PRESET, choices=list(SIZE_PRESETS),
+                        help="用紙サイズ(縦向きで使う)")
+    parser.add_argument("--recursive", action="store_true", help="サブフォルダーの画像も含める")
+    parser.add_argument("--workers", type=int, default=None, help="デコードに使うプロセス数")
+    parser.add_argument("--quality", type=int, default=EncodeOptions().quality)
+    args = parser.parse_args(argv)
+
+    width, height, dpi = preset_canvas_size(args.preset, True)
+    options = ContactSheetOptions(args.columns, args.rows, width, height, dpi)
+    image_paths = folder_images(args.folder, args.recursive)
+    if not image_paths:
+        print("画像がありません: %s" % args.folder)
+        return 1
+    saved = render_contact_sheets(image_paths, args.out_path, options, EncodeOptions(quality=args.quality),
+                                  args.workers)
+    print("%d 枚を %d ページに保存しました" % (len(image_paths), len(saved)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
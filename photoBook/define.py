@@ -2,6 +2,17 @@
 COLUMN_YHK = 0.000
 ROW_YHK = 0.000
 IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', '.heic')
+PREVIEW_MAX_SIZE = 512.0
+PREVIEW_PYRAMID_LEVELS = 3
+BUNDLE_EXT = '.pbook'
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_MAKE_TAG = 0x010F
+EXIF_MODEL_TAG = 0x0110
+EXIF_DATETIME_TAG = 0x0132
+EXIF_IFD_TAG = 0x8769
+EXIF_DATETIME_ORIGINAL_TAG = 0x9003
+BATCH_RENDER_THRESHOLD = 1000
+"""ブロック数がこれを超えるレイアウトは空のセルをまとめて描画する"""
 
 
 def tile_base(column, row, total_columns, total_rows, column_scale=1, row_scale=None,
@@ -23,6 +34,33 @@ def tiled46(column, row, column_scale=1, row_scale=None):
     return tile_base(column, row, 4, 6, column_scale, row_scale)
 
 
+def apply_block_margins(rect_ratio, export_width, export_height,
+                        block_space_margin_px=0, top_under_margin_px=0, side_margin_px=0):
+    """レイアウトの矩形(比率)に余白(px)を反映した矩形(比率)を返す"""
+    # 各スペースの値をpxから出力サイズを1とした場合に比率に治す
+    margin_ratio_x = margin_ratio_y = 0
+    if block_space_margin_px > 0:
+        margin_ratio_x = block_space_margin_px / export_width
+        margin_ratio_y = block_space_margin_px / export_height
+
+    side_margin = side_margin_px / export_width
+    top_under_margin = top_under_margin_px / export_height
+    side_scale = (1.0 - side_margin * 2.0)
+    top_scale = (1.0 - top_under_margin * 2.0)
+
+    # rect_ratio からマージン分を減算
+    x, y, w, h = rect_ratio[0:4]
+    x += margin_ratio_x / 2
+    y += margin_ratio_y / 2
+    w -= margin_ratio_x
+    h -= margin_ratio_y
+    x = x * side_scale + side_margin
+    y = y * top_scale + top_under_margin
+    w = w * side_scale
+    h = h * top_scale
+    return (x, y, w, h)
+
+
 def tile_layout(column=141, row=100):
     result = []
     for rw in range(row):
@@ -98,6 +136,26 @@ SIZE_PRESETS = {
 }
 
 
+DEFAULT_SIZE_PRESET = 'A4 2480 x 3508 px (300 DPI)'
+
+
+def size_preset_variants(preset_name):
+    # type: (str) -> list[str]
+    """同じ用紙サイズでDPIだけが異なるプリセット名をDPIの高い順に取得"""
+    paper = preset_name.split(' ')[0]
+    names = [name for name, (_, _, dpi) in SIZE_PRESETS.items() if dpi and name.split(' ')[0] == paper]
+    return sorted(names, key=lambda name: SIZE_PRESETS[name][2], reverse=True)
+
+
+def preset_canvas_size(preset_name, size_switch=False):
+    # type: (str, bool) -> tuple[int, int, int]
+    """サイズスイッチを反映したプリセットの (幅, 高さ, DPI)"""
+    height, width, dpi = SIZE_PRESETS[preset_name]
+    if size_switch:
+        return height, width, dpi
+    return width, height, dpi
+
+
 LAYOUT_PRESETS = {
     "横 family": [
         tiled87(0, 0), tiled87(1, 0), tiled87(2, 0), tiled87(3, 0), tiled87(4, 0), tiled87(5, 0), tiled87(6, 0), tiled87(7, 0),
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+編集の元に戻す/やり直し
+
+ブロックの状態を HISTORY_CHUNK_SIZE 個ずつのタプル(チャンク)に分けた不変のスナップショットで保持する。
+新しいスナップショットは直前のものと要素を同一性で比べ、変わっていない状態のタプルとチャンクは使い回す。
+1回の操作で変わるのは数ブロックなので、1ステップあたりに増えるのは変わったチャンク1つ分程度になる。
+デコード済みの画像(PreviewData など)は参照を持つだけで複製しない。
+"""
+import time
+from typing import NamedTuple
+HISTORY_CHUNK_SIZE = 32
+"""1チャンクのブロック数"""
+HISTORY_LIMIT = 5000
+"""保持する元に戻すステップ数の上限"""
+MERGE_SECONDS = 1.0
+"""同じ merge_key の操作がこの秒数以内に続いた場合は1ステップにまとめる"""
+_SCALAR_TYPES = (int, float, str, bool, type(None))
+
+
+class ModelSnapshot(NamedTuple):
+    """ある時点のブロックの状態"""
+    chunks: tuple
+    """ブロックの状態のタプルを HISTORY_CHUNK_SIZE 個ずつに分けたタプル"""
+    view_state: tuple
+    """レイアウト名や余白など、変わるとレイアウトを描画し直す状態"""
+    label: str = ""
+    """操作の名前"""
+
+    def states(self):
+        # type: () -> list[tuple]
+        return [state for chunk in self.chunks for state in chunk]
+
+
+def _same_value(a, b):
+    # type: (object, object) -> bool
+    """同一のオブジェクトか、等しいスカラー値か(画像は == で比較しない)"""
+    if a is b:
+        return True
+    return type(a) in _SCALAR_TYPES and type(a) is type(b) and a == b
+
+
+def _share_state(state, previous):
+    # type: (tuple, tuple | None) -> tuple
+    """前のスナップショットと同じ内容なら前の状態のタプルを返す"""
+    if previous is None or len(previous) != len(state):
+        return state
+    for a, b in zip(state, previous):
+        if not _same_value(a, b):
+            return state
+    return previous
+
+
+def build_snapshot(states, view_state, label="", previous=None):
+    # type: (list[tuple], tuple, str, ModelSnapshot) -> ModelSnapshot
+    """previous と構造を共有するスナップショットを作成"""
+    previous_chunks = previous.chunks if previous is not None else ()
+    chunks = []
+    for index, start in enumerate(range(0, len(states), HISTORY_CHUNK_SIZE)):
+        previous_chunk = previous_chunks[index] if index < len(previous_chunks) else ()
+        chunk = tuple(_share_state(state, previous_chunk[i] if i < len(previous_chunk) else None)
+                      for i, state in enumerate(states[start:start + HISTORY_CHUNK_SIZE]))
+        if len(chunk) == len(previous_chunk) and all(a is b for a, b in zip(chunk, previous_chunk)):
+            chunk = previous_chunk
+        chunks.append(chunk)
+    return ModelSnapshot(tuple(chunks), tuple(view_state), label)
+
+
+def changed_indexes(current, target):
+    # type: (ModelSnapshot, ModelSnapshot) -> list[int]
+    """current から target に戻す時に状態を書き換えるブロックの番号
+
+    チャンクが同一なら中を比較せずに飛ばす。
+    """
+    indexes = []
+    for index in range(max(len(current.chunks), len(target.chunks))):
+        current_chunk = current.chunks[index] if index < len(current.chunks) else ()
+        target_chunk = target.chunks[index] if index < len(target.chunks) else ()
+        if current_chunk is target_chunk:
+            continue
+        base = index * HISTORY_CHUNK_SIZE
+        for i in range(max(len(current_chunk), len(target_chunk))):
+            if i >= len(current_chunk) or i >= len(target_chunk) or current_chunk[i] is not target_chunk[i]:
+                indexes.append(base + i)
+    return indexes
+
+
+def is_same_snapshot(a, b):
+    # type: (ModelSnapshot, ModelSnapshot) -> bool
+    return a.view_state == b.view_state and len(a.chunks) == len(b.chunks) and all(
+        x is y for x, y in zip(a.chunks, b.chunks))
+
+
+class EditHistory:
+    """元に戻す/やり直しのスタック
+
+    編集の直前に checkpoint() で状態を渡し、undo()/redo() には現在の状態を渡して戻し先を受け取る。
+    checkpoint() で受け取った状態は保留し、次に現在の状態と比べた時に変わっていた場合だけ積む
+    (何も変えなかった操作でやり直しの履歴を消さない)。
+    各スナップショットは直前に積んだものと構造を共有する。
+    """
+
+    def __init__(self, limit=HISTORY_LIMIT, merge_seconds=MERGE_SECONDS):
+        # type: (int, float) -> None
+        self.limit = limit
+        self.merge_seconds = merge_seconds
+        self._undo = []  # type: list[ModelSnapshot]
+        self._redo = []  # type: list[ModelSnapshot]
+        self._pending = None  # type: ModelSnapshot | None
+        """checkpoint で受け取り、まだ状態が変わったか確認していない編集前の状態"""
+        self._merge_key = None
+        self._merge_time = 0.0
+
+    def __len__(self):
+        return len(self._undo)
+
+    def can_undo(self):
+        # type: () -> bool
+        return bool(self._undo) or self._pending is not None
+
+    def can_redo(self):
+        # type: () -> bool
+        return bool(self._redo)
+
+    def undo_label(self):
+        # type: () -> str
+        if self._pending is not None:
+            return self._pending.label
+        return self._undo[-1].label if self._undo else ""
+
+    def redo_label(self):
+        # type: () -> str
+        return self._redo[-1].label if self._redo else ""
+
+    def snapshot(self, states, view_state, label=""):
+        # type: (list[tuple], tuple, str) -> ModelSnapshot
+        """直前の履歴(保留中の状態を含む)と構造を共有するスナップショットを作成"""
+        previous = self._pending
+        if previous is None:
+            previous = self._undo[-1] if self._undo else (self._redo[-1] if self._redo else None)
+        return build_snapshot(states, view_state, label, previous)
+
+    def checkpoint(self, snapshot, merge_key=None):
+        # type: (ModelSnapshot, object) -> bool
+        """編集前の状態を受け取る(受け取った場合は True)
+
+        前回受け取った状態はここで snapshot と比べて、変わっていれば積む。
+        merge_key が同じ操作が続いている場合は受け取らない。
+        """
+        self._settle(snapshot)
+        now = time.monotonic()
+        merged = (merge_key is not None and merge_key == self._merge_key
+                  and now - self._merge_time < self.merge_seconds)
+        self._merge_key = merge_key
+        self._merge_time = now
+        if merged:
+            return False
+        self._pending = snapshot
+        return True
+
+    def settle(self, states, view_state):
+        # type: (list[tuple], tuple) -> None
+        """保留中の状態を現在の状態と比べて確定する(メニューの表示を更新する前などに呼ぶ)"""
+        if self._pending is not None:
+            self._settle(self.snapshot(states, view_state))
+
+    def undo(self, states, view_state):
+        # type: (list[tuple], tuple) -> tuple[ModelSnapshot, ModelSnapshot] | None
+        """現在の状態をやり直し側に積み、(現在の状態, 戻し先) を返す
+
+        現在の状態は戻し先と構造を共有するので、changed_indexes で書き換えるブロックだけを求められる。
+        """
+        self.settle(states, view_state)
+        return self._step(states, view_state, self._undo, self._redo)
+
+    def redo(self, states, view_state):
+        # type: (list[tuple], tuple) -> tuple[ModelSnapshot, ModelSnapshot] | None
+        self.settle(states, view_state)
+        return self._step(states, view_state, self._redo, self._undo)
+
+    def clear(self):
+        # type: () -> None
+        self._undo.clear()
+        self._redo.clear()
+        self._pending = None
+        self._merge_key = None
+
+    def _settle(self, current):
+        # type: (ModelSnapshot) -> None
+        """保留中の状態から current に変わっていれば積み、やり直しの履歴を消す"""
+        pending, self._pending = self._pending, None
+        if pending is None or is_same_snapshot(pending, current):
+            return
+        self._redo.clear()
+        if self._undo and is_same_snapshot(self._undo[-1], pending):
+            return
+        self._undo.append(pending)
+        if len(self._undo) > self.limit:
+            del self._undo[:len(self._undo) - self.limit]
+
+    def _step(self, states, view_state, source, destination):
+        # type: (list[tuple], tuple, list[ModelSnapshot], list[ModelSnapshot]) -> tuple | None
+        self._merge_key = None
+        while source:
+            current = build_snapshot(states, view_state, previous=source[-1])
+            # 何も変えなかった操作の履歴は飛ばす
+            if not is_same_snapshot(source[-1], current):
+                target = source.pop()
+                destination.append(current._replace(label=target.label))
+                return current, target
+            source.pop()
+        return None
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+操作していない間の出力の先読み
+
+編集が止まってしばらくすると、配置済みのブロックを現在の出力サイズで描画して
+タイルキャッシュに入れておく。出力時は render_canvas がキャッシュから合成するので、
+元画像のデコードと縮小は出力ボタンを押す前に済んでいることが多くなる。
+
+マウスやキーの操作があると次のブロックの前で中断し、操作が止まってから再開する。
+画像の読み込み待ちがある間も待機し、タイルキャッシュが max_bytes を超える分は作らない。
+"""
+import os
+import threading
+from PySide6 import QtCore, QtWidgets
+from .exportRenderer import block_box, render_block
+from .imageLoadQueue import image_load_queue
+from .perfMonitor import PERF
+from .tileCache import TILE_CACHE, tile_key
+IDLE_MSEC = 1500
+"""最後の操作からこの時間が経ったら先読みを始める"""
+PREFETCH_MAX_BYTES = 256 * 1024 * 1024
+"""先読みでタイルキャッシュをこのサイズまで使う(他のタイルを追い出さないよう最大値より小さくする)"""
+_ACTIVITY_EVENTS = frozenset((
+    QtCore.QEvent.MouseButtonPress, QtCore.QEvent.MouseButtonRelease, QtCore.QEvent.MouseMove,
+    QtCore.QEvent.Wheel, QtCore.QEvent.KeyPress, QtCore.QEvent.DragMove, QtCore.QEvent.Drop,
+))
+
+
+class ExportPrefetcher(QtCore.QThread):
+    """操作していない間に出力用のタイルをタイルキャッシュに作成する"""
+    tile_prefetched = QtCore.Signal(int, int)
+    """(作成したタイル数, 作成するタイル数)"""
+
+    def __init__(self, snapshot_provider, tile_cache=TILE_CACHE, idle_msec=IDLE_MSEC,
+                 max_bytes=PREFETCH_MAX_BYTES, parent=None):
+        # type: (callable, TileCache, int, int, QtCore.QObject) -> None
+        """snapshot_provider は ExportSnapshot を返す関数(GUIスレッドで呼ぶ)"""
+        super().__init__(parent)
+        self._snapshot_provider = snapshot_provider
+        self._tile_cache = tile_cache
+        self.max_bytes = min(max_bytes, tile_cache.max_bytes)
+        self._snapshot = None  # type: ExportSnapshot | None
+        self._interrupt = threading.Event()
+        self._suspend_count = 0
+        self._idle_timer = QtCore.QTimer(self)
+        self._idle_timer.setSingleShot(True)
+        self._idle_timer.setInterval(idle_msec)
+        self._idle_timer.timeout.connect(self._start_prefetch)
+        self.finished.connect(self._on_finished)
+        QtWidgets.QApplication.instance().installEventFilter(self)
+        self._idle_timer.start()
+
+    def notify_activity(self):
+        # type: () -> None
+        """ユーザーの操作があったことを通知(作成中なら中断し、待ち時間をやり直す)"""
+        self._interrupt.set()
+        if not self._suspend_count:
+            self._idle_timer.start()
+
+    def suspend(self):
+        # type: () -> None
+        """resume が呼ばれるまで先読みしない(出力中など)"""
+        self._suspend_count += 1
+        self._interrupt.set()
+        self._idle_timer.stop()
+
+    def resume(self):
+        # type: () -> None
+        self._suspend_count = max(0, self._suspend_count - 1)
+        if not self._suspend_count:
+            self._idle_timer.start()
+
+    def stop(self):
+        # type: () -> None
+        """先読みを止めてスレッドの終了を待つ"""
+        self._suspend_count += 1
+        self._idle_timer.stop()
+        self._interrupt.set()
+        self.wait()
+
+    def eventFilter(self, watched, event):
+        if event.type() in _ACTIVITY_EVENTS:
+            self.notify_activity()
+        return False
+
+    def _start_prefetch(self):
+        # type: () -> None
+        if self._suspend_count or self.isRunning():
+            return
+        self._snapshot = self._snapshot_provider()
+        if not any(block.image_path for block in self._snapshot.blocks):
+            return
+        self._interrupt.clear()
+        self.start(QtCore.QThread.IdlePriority)
+
+    def _on_finished(self):
+        # type: () -> None
+        # 中断した場合は操作が止まってから続きを作成する(全て作成できた場合は次の操作まで待つ)
+        if self._interrupt.is_set() and not self._suspend_count:
+            self._idle_timer.start()
+
+    def _wait_for_image_loads(self):
+        # type: () -> bool
+        """表示用の画像の読み込みが終わるまで待つ(中断された場合は False)"""
+        queue = image_load_queue()
+        while queue.pending_count():
+            if self._interrupt.wait(0.1):
+                return False
+        return not self._interrupt.is_set()
+
+    def run(self):
+        snapshot = self._snapshot
+        width, height = snapshot.width, snapshot.height
+        jobs = []
+        for block in snapshot.blocks:
+            key = tile_key(block, width, height, snapshot.dpi)
+            if key and not self._tile_cache.contains(key):
+                jobs.append((block, key))
+        for done, (block, key) in enumerate(jobs):
+            if not self._wait_for_image_loads():
+                return
+            left, top, right, bottom = block_box(block, width, height)
+            if self._tile_cache.nbytes + (right - left) * (bottom - top) * 3 > self.max_bytes:
+                PERF.count("export_prefetch_over_budget")
+                return
+            try:
+                with PERF.measure("export_prefetch", path=os.path.basename(block.image_path)):
+                    tile = render_block(block, width, height, snapshot.bg_color)
+            except Exception:
+                continue
+            if tile is not None:
+                self._tile_cache.put(key, tile)
+            self.tile_prefetched.emit(done + 1, len(jobs))
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+画像出力のレンダリング
+
+PhotoCollageView のシーンを使わず、ブロック情報のスナップショットから
+Pillow だけで出力画像を合成する。Qt に依存しないのでワーカースレッドから呼べる。
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional, Tuple
+from .define import *
+from .imageIO import (
+    image_orientation, open_image, orientation_transform, pil_image, resolve_path, transform_size, transpose_image)
+from .perfMonitor import PERF, timed
+from .tileCache import source_key, tile_key
+EMPTY_BLOCK_COLOR = (200, 200, 200)
+"""画像のはみ出し部分などに見える下地の色(PhotoBlockItem.paint と同じ)"""
+ENCODE_FORMATS = {
+    ".png": "PNG",
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".webp": "WEBP",
+    ".tif": "TIFF",
+    ".tiff": "TIFF",
+}
+TIFF_COMPRESSIONS = ("tiff_lzw", "tiff_adobe_deflate", "raw")
+PDF_COMPRESSIONS = ("jpeg", "flate")
+"""PDF に埋め込む画像の圧縮方式(flate は可逆)"""
+
+
+class BlockSnapshot(NamedTuple):
+    """出力に必要なブロックの状態"""
+    rect_ratio: Tuple[float, float, float, float]
+    """余白を反映済みの矩形(比率)"""
+    image_path: Optional[str]
+    offset_x: float
+    offset_y: float
+    scale: float
+    rotation: float
+
+
+class ExportSnapshot(NamedTuple):
+    """出力時点のレイアウトの状態"""
+    width: int
+    height: int
+    dpi: Optional[int]
+    bg_color: Tuple[int, int, int]
+    blocks: Tuple[BlockSnapshot, ...]
+
+
+class EncodeOptions(NamedTuple):
+    """画像形式ごとの保存オプション"""
+    quality: int = 90
+    """JPEG/WebP の品質(1-100)"""
+    compress_level: int = 6
+    """PNG の圧縮レベル(0-9)"""
+    tiff_compression: str = "tiff_lzw"
+    pdf_compression: str = "jpeg"
+
+
+class ExportCanceled(Exception):
+    """出力がキャンセルされた"""
+
+
+def snapshot_from_context(blocks_context, width, height, dpi=None, bg_color=(255, 255, 255),
+                          block_space_margin_px=0, top_under_margin_px=0, side_margin_px=0):
+    # type: (list[dict], int, int, int, tuple, int, int, int) -> ExportSnapshot
+    """PhotoCollageView.context() 形式のリストからスナップショットを作成"""
+    blocks = []
+    for blk_data in blocks_context:
+        rect_ratio = apply_block_margins(
+            blk_data.get("rect_ratio", (0.0, 0.0, 1.0, 1.0)), width, height,
+            block_space_margin_px, top_under_margin_px, side_margin_px)
+        blocks.append(BlockSnapshot(
+            tuple(rect_ratio), blk_data.get("file_path"), blk_data.get("offset_x", 0),
+            blk_data.get("offset_y", 0), blk_data.get("scale", 1.0), blk_data.get("rotation", 0)))
+    return ExportSnapshot(int(width), int(height), dpi, tuple(bg_color), tuple(blocks))
+
+
+def snapshot_from_layout(context):
+    # type: (dict) -> ExportSnapshot
+    """save_layout 形式のレイアウト情報からスナップショットを作成"""
+    input_context = context.get("input_context", {})
+    preset_name = input_context.get("size_preset", DEFAULT_SIZE_PRESET)
+    if preset_name not in SIZE_PRESETS:
+        raise ValueError("不明なサイズプリセットです: %s" % preset_name)
+    width, height, dpi = preset_canvas_size(preset_name, input_context.get("size_switch", False))
+    return snapshot_from_context(
+        context.get("photo_context", []), width, height, dpi,
+        tuple(input_context.get("bg_color", (255, 255, 255))),
+        input_context.get("space_margin", 10), input_context.get("top_under_margin", 10),
+        input_context.get("side_margin", 10))
+
+
+def block_box(block, width, height):
+    # type: (BlockSnapshot, int, int) -> tuple[int, int, int, int]
+    """ブロックの出力画像上のピクセル範囲 (left, top, right, bottom)"""
+    x, y, w, h = block.rect_ratio
+    return (int(round(width * x)), int(round(height * y)),
+            int(round(width * (x + w))), int(round(height * (y + h))))
+
+
+def render_block(block, width, height, bg_color, source_cache=None):
+    # type: (BlockSnapshot, int, int, tuple, TileCache) -> Image.Image | None
+    """ブロック1つ分の画像(ブロックの範囲で切り抜き済み)を作成
+
+    source_cache を渡すと縮小デコードした元画像を保持し、同じ解像度で使う間はデコードし直さない。
+    """
+    Image = pil_image()
+    left, top, right, bottom = block_box(block, width, height)
+    if right <= left or bottom <= top:
+        return None
+    if not block.image_path or not os.path.isfile(resolve_path(block.image_path)):
+        return Image.new("RGB", (right - left, bottom - top), bg_color)
+
+    rect_x, rect_y = width * block.rect_ratio[0], height * block.rect_ratio[1]
+    rect_w, rect_h = width * block.rect_ratio[2], height * block.rect_ratio[3]
+    with open_image(block.image_path) as source:
+        orientation = image_orientation(source)
+        upright = orientation_transform(orientation)
+        # スケール倍率を計算(PhotoBlockItem.paint と同じく、向きを正した回転前のサイズで計算)
+        iw, ih = transform_size(source.size, upright)
+        ratio = max(rect_w / iw, rect_h / ih) * block.scale + 0.005
+        # 縮小は元画像の向きのまま行い、向きと回転は縮小後にまとめて転置する
+        scaled_size = transform_size((int(iw * ratio), int(ih * ratio)), upright)
+        # JPEGは必要な解像度に近い縮小デコードを行う
+        source.draft("RGB", scaled_size)
+        key = source_key(block.image_path, source.size, source.mode) if source_cache is not None else None
+        img = source_cache.get(key) if key else None
+        if img is None:
+            with PERF.measure("decode", path=os.path.basename(block.image_path)):
+                img = source.convert("RGBA")
+            if key:
+                source_cache.put(key, img)
+    with PERF.measure("resample"):
+        img = img.resize(scaled_size, Image.BICUBIC)
+        transform = orientation_transform(orientation, block.rotation)
+        if transform is not None:
+            # 90度単位の回転は EXIF の向きと合わせて1回の転置で行う(補間しない)
+            img = transpose_image(img, transform)
+        else:
+            img = transpose_image(img, upright)
+            img = img.rotate(-block.rotation, expand=True, resample=Image.BICUBIC)
+
+    # 中心配置 + offset
+    cx = round(rect_x + rect_w / 2.0 - img.width / 2.0 + block.offset_x * width)
+    cy = round(rect_y + rect_h / 2.0 - img.height / 2.0 + block.offset_y * height)
+    tile = Image.new("RGB", (right - left, bottom - top), EMPTY_BLOCK_COLOR)
+    tile.paste(img, (cx - left, cy - top), img)
+    return tile
+
+
+@timed("export_render")
+def render_canvas(snapshot, progress=None, cancel_event=None, tile_cache=None, source_cache=None):
+    # type: (ExportSnapshot, callable, threading.Event, TileCache, TileCache) -> Image.Image
+    """スナップショットから出力画像を合成
+
+    progress(done, total) はブロックを1つ描画するたびに呼ばれる。
+    cancel_event がセットされると ExportCanceled を送出する。
+    tile_cache を渡すと、前回から状態が変わっていないブロックはキャッシュから合成する。
+    source_cache は render_block に渡す(配置だけ変わったブロックは元画像をデコードし直さない)。
+    """
+    canvas = pil_image().new("RGB", (snapshot.width, snapshot.height), snapshot.bg_color)
+    total = len(snapshot.blocks)
+    for index, block in enumerate(snapshot.blocks):
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExportCanceled()
+        tile = None
+        key = tile_key(block, snapshot.width, snapshot.height, snapshot.dpi) if tile_cache else None
+        if key:
+            tile = tile_cache.get(key)
+        if tile is None:
+            with PERF.measure("export_block", index=index):
+                tile = render_block(block, snapshot.width, snapshot.height, snapshot.bg_color, source_cache)
+            if key and tile is not None:
+                tile_cache.put(key, tile)
+        if tile is not None:
+            left, top = block_box(block, snapshot.width, snapshot.height)[:2]
+            canvas.paste(tile, (left, top))
+        if progress:
+            progress(index + 1, total)
+    return canvas
+
+
+def encode_format(path):
+    # type: (str) -> str
+    """拡張子から保存形式を取得"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in ENCODE_FORMATS:
+        raise ValueError("対応していない画像形式です: %s" % ext)
+    return ENCODE_FORMATS[ext]
+
+
+def save_options(image_format, dpi, options):
+    # type: (str, int, EncodeOptions) -> dict
+    """Image.save に渡すオプション"""
+    params = {}
+    if dpi:
+        params["dpi"] = (dpi, dpi)
+    if image_format == "PNG":
+        params["compress_level"] = options.compress_level
+    elif image_format == "JPEG":
+        params["quality"] = options.quality
+        params["optimize"] = True
+    elif image_format == "WEBP":
+        params["quality"] = options.quality
+        params["method"] = 4
+    elif image_format == "TIFF":
+        params["compression"] = None if options.tiff_compression == "raw" else options.tiff_compression
+    return params
+
+
+@timed("encode")
+def save_image(image, path, dpi=None, options=None):
+    # type: (Image.Image, str, int, EncodeOptions) -> None
+    """一時ファイルに書き出してから置き換える(途中でキャンセルされても壊れたファイルを残さない)"""
+    image_format = encode_format(path)
+    params = save_options(image_format, dpi, options or EncodeOptions())
+    tmp_path = "%s.tmp%s" % (path, os.path.splitext(path)[1])
+    try:
+        image.save(tmp_path, image_format, **params)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def render_export(snapshot, out_path, options=None, progress=None, cancel_event=None, tile_cache=None):
+    # type: (ExportSnapshot, str, EncodeOptions, callable, threading.Event, TileCache) -> None
+    """スナップショットを描画して保存"""
+    canvas = render_canvas(snapshot, progress, cancel_event, tile_cache)
+    if cancel_event is not None and cancel_event.is_set():
+        raise ExportCanceled()
+    save_image(canvas, out_path, snapshot.dpi, options)
+
+
+def render_export_variants(snapshot, outputs, options=None, progress=None, cancel_event=None,
+                           tile_cache=None, max_workers=None):
+    # type: (ExportSnapshot, list[tuple[int, int, int, str]], EncodeOptions, callable, threading.Event, TileCache, int) -> list[str]
+    """同じレイアウトを複数の解像度で出力
+
+    outputs は (幅, 高さ, DPI, 保存先) のリスト。最も大きいサイズで1回だけ描画し、
+    他の解像度はそこから縮小して作成する。縮小と保存は並列に行う。
+    """
+    master_width, master_height, master_dpi, _ = max(outputs, key=lambda output: output[0] * output[1])
+    master = snapshot._replace(width=master_width, height=master_height, dpi=master_dpi)
+    canvas = render_canvas(master, progress, cancel_event, tile_cache)
+
+    def write(output):
+        width, height, dpi, path = output
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExportCanceled()
+        image = canvas
+        if (width, height) != canvas.size:
+            with PERF.measure("downsample", width=width, height=height):
+                image = canvas.resize((width, height), pil_image().LANCZOS, reducing_gap=3.0)
+        save_image(image, path, dpi, options)
+        return path
+
+    max_workers = max_workers or min(len(outputs), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(write, outputs))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+バックグラウンドでの画像出力
+"""
+import os
+import threading
+from PySide6 import QtWidgets, QtCore
+from .exportRenderer import (
+    ENCODE_FORMATS, PDF_COMPRESSIONS, TIFF_COMPRESSIONS, EncodeOptions, ExportCanceled,
+    render_export, render_export_variants)
+from .bookExport import render_book
+from .contactSheet import render_contact_sheets
+from .tileCache import TILE_CACHE
+EXPORT_FILE_FILTER = "PNG Files (*.png);;JPEG Files (*.jpg);;WebP Files (*.webp);;TIFF Files (*.tif)"
+
+
+class ExportWorker(QtCore.QThread):
+    """スナップショットを別スレッドで描画・保存する"""
+    progress = QtCore.Signal(int, int)
+    succeeded = QtCore.Signal(str)
+    failed = QtCore.Signal(str)
+    canceled = QtCore.Signal()
+
+    def __init__(self, snapshot, out_path, options=None, parent=None, variants=None):
+        # type: (ExportSnapshot, str, EncodeOptions, QtCore.QObject, list[tuple[int, int, int, str]]) -> None
+        """variants に (幅, 高さ, DPI, 保存先) のリストを渡すと複数解像度を1回の描画で出力する"""
+        super().__init__(parent)
+        self._snapshot = snapshot
+        self._out_path = out_path
+        self._options = options
+        self._variants = variants
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        # type: () -> None
+        """キャンセルを要求(次のブロックの描画前に中断する)"""
+        self._cancel_event.set()
+
+    def run(self):
+        try:
+            if self._variants:
+                render_export_variants(self._snapshot, self._variants, self._options,
+                                       self.progress.emit, self._cancel_event, TILE_CACHE)
+            else:
+                render_export(self._snapshot, self._out_path, self._options,
+                              self.progress.emit, self._cancel_event, TILE_CACHE)
+        except ExportCanceled:
+            self.canceled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(self._out_path)
+
+
+class BookExportWorker(QtCore.QThread):
+    """全ページのスナップショットを別スレッドで1つの PDF / TIFF に出力する"""
+    progress = QtCore.Signal(int, int)
+    succeeded = QtCore.Signal(str)
+    failed = QtCore.Signal(str)
+    canceled = QtCore.Signal()
+
+    def __init__(self, snapshots, out_path, options=None, parent=None):
+        # type: (list[ExportSnapshot], str, EncodeOptions, QtCore.QObject) -> None
+        super().__init__(parent)
+        self._snapshots = snapshots
+        self._out_path = out_path
+        self._options = options
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        # type: () -> None
+        self._cancel_event.set()
+
+    def run(self):
+        try:
+            render_book(self._snapshots, self._out_path, self._options, self.progress.emit, self._cancel_event)
+        except ExportCanceled:
+            self.canceled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(self._out_path)
+
+
+class ContactSheetWorker(QtCore.QThread):
+    """コンタクトシートを別スレッドで作成する"""
+    progress = QtCore.Signal(int, int)
+    succeeded = QtCore.Signal(list)
+    failed = QtCore.Signal(str)
+    canceled = QtCore.Signal()
+
+    def __init__(self, image_paths, out_path, options=None, encode_options=None, parent=None):
+        # type: (list[str], str, ContactSheetOptions, EncodeOptions, QtCore.QObject) -> None
+        super().__init__(parent)
+        self._image_paths = image_paths
+        self._out_path = out_path
+        self._options = options
+        self._encode_options = encode_options
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        # type: () -> None
+        self._cancel_event.set()
+
+    def run(self):
+        try:
+            saved = render_contact_sheets(self._image_paths, self._out_path, self._options, self._encode_options,
+                                          progress=self.progress.emit, cancel_event=self._cancel_event)
+        except ExportCanceled:
+            self.canceled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(saved)
+
+
+class ExportOptionsDialog(QtWidgets.QDialog):
+    """保存形式に応じた圧縮レベル/品質の設定ダイアログ"""
+
+    def __init__(self, image_format, options=None, parent=None):
+        # type: (str, EncodeOptions, QtWidgets.QWidget) -> None
+        super().__init__(parent)
+        options = options or EncodeOptions()
+        self.setWindowTitle("出力設定")
+        self._image_format = image_format
+        self.quality_spin = QtWidgets.QSpinBox()
+        self.quality_spin.setRange(1, 100)
+        self.quality_spin.setValue(options.quality)
+        self.compress_level_spin = QtWidgets.QSpinBox()
+        self.compress_level_spin.setRange(0, 9)
+        self.compress_level_spin.setValue(options.compress_level)
+        self.tiff_compression_combo = QtWidgets.QComboBox()
+        self.tiff_compression_combo.addItems(TIFF_COMPRESSIONS)
+        self.tiff_compression_combo.setCurrentText(options.tiff_compression)
+        self.pdf_compression_combo = QtWidgets.QComboBox()
+        self.pdf_compression_combo.addItems(PDF_COMPRESSIONS)
+        self.pdf_compression_combo.setCurrentText(options.pdf_compression)
+
+        form = QtWidgets.QFormLayout()
+        if image_format in ("JPEG", "WEBP"):
+            form.addRow("品質(1-100):", self.quality_spin)
+        elif image_format == "PNG":
+            form.addRow("圧縮レベル(0-9):", self.compress_level_spin)
+        elif image_format == "TIFF":
+            form.addRow("圧縮方式:", self.tiff_compression_combo)
+        elif image_format == "PDF":
+            form.addRow("圧縮方式:", self.pdf_compression_combo)
+            form.addRow("品質(jpeg, 1-100):", self.quality_spin)
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(form)
+        layout.addWidget(buttons)
+
+    def options(self):
+        # type: () -> EncodeOptions
+        return EncodeOptions(self.quality_spin.value(), self.compress_level_spin.value(),
+                             self.tiff_compression_combo.currentText(), self.pdf_compression_combo.currentText())
+
+
+def ensure_export_ext(path, selected_filter):
+    # type: (str, str) -> str
+    """拡張子が無い場合は選択したフィルターの拡張子を付ける"""
+    if os.path.splitext(path)[1].lower() in ENCODE_FORMATS:
+        return path
+    for ext in ENCODE_FORMATS:
+        if "*%s" % ext in selected_filter:
+            return path + ext
+    return path + ".png"
+
+
+def variant_output_path(path, dpi):
+    # type: (str, int) -> str
+    """DPIごとの保存先 (collage.png -> collage_400dpi.png)"""
+    stem, ext = os.path.splitext(path)
+    return "%s_%ddpi%s" % (stem, dpi, ext)
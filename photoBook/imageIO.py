@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+画像の読み込みとプレビュー生成
+"""
+import os
+from .define import *
+from .perfMonitor import PERF
+_PIL_IMAGE = None
+_PATH_RESOLVER = None
+_ORIENTATION_TRANSFORMS = {
+    # EXIF の向き: (左右反転するか, 反転後に時計回りに 90度回転する回数)
+    1: (False, 0),
+    2: (True, 0),
+    3: (False, 2),
+    4: (True, 2),
+    5: (True, 3),
+    6: (False, 1),
+    7: (True, 1),
+    8: (False, 3),
+}
+_TRANSPOSE_METHODS = {
+    # (左右反転するか, 時計回りに 90度回転する回数): 同じ変換になる Image.transpose の引数
+    (False, 1): "ROTATE_270",
+    (False, 2): "ROTATE_180",
+    (False, 3): "ROTATE_90",
+    (True, 0): "FLIP_LEFT_RIGHT",
+    (True, 1): "TRANSVERSE",
+    (True, 2): "FLIP_TOP_BOTTOM",
+    (True, 3): "TRANSPOSE",
+}
+
+
+def pil_image():
+    # type: () -> module
+    """PIL.Image を初回使用時に読み込む
+
+    Pillow と pillow_heif の読み込みは起動時間の大部分を占めるので、
+    モジュールの読み込み時ではなく最初に画像を扱う時まで遅らせる。
+    """
+    global _PIL_IMAGE
+    if _PIL_IMAGE is None:
+        from PIL import Image
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        _PIL_IMAGE = Image
+    return _PIL_IMAGE
+
+
+def set_path_resolver(resolver):
+    # type: (callable | None) -> None
+    """元画像のパスからデコードに使うパスを返す関数を登録(MirrorCache.resolve など)"""
+    global _PATH_RESOLVER
+    _PATH_RESOLVER = resolver
+
+
+def resolve_path(path):
+    # type: (str) -> str
+    """デコードに使うパス(ローカルのコピーがあればそちら)"""
+    if _PATH_RESOLVER is None or not path:
+        return path
+    return _PATH_RESOLVER(path)
+
+
+def quarter_turns(rotation):
+    # type: (float) -> int | None
+    """時計回りの回転角を 90度の回数(0-3)にする(90度単位でない場合は None)"""
+    if rotation % 90:
+        return None
+    return int(rotation // 90) % 4
+
+
+def image_orientation(image):
+    # type: (Image.Image) -> int
+    """元画像の EXIF の向き(1-8、無い場合は 1)"""
+    try:
+        orientation = int(image.getexif().get(EXIF_ORIENTATION_TAG, 1) or 1)
+    except Exception:
+        return 1
+    return orientation if orientation in _ORIENTATION_TRANSFORMS else 1
+
+
+def orientation_transform(orientation=1, rotation=0):
+    # type: (int, float) -> tuple[bool, int] | None
+    """EXIF の向きを正してから rotation だけ時計回りに回す変換 (左右反転するか, 時計回りに 90度回転する回数)
+
+    回転が 90度単位でない場合は None。
+    """
+    quarters = quarter_turns(rotation)
+    if quarters is None:
+        return None
+    mirror, base = _ORIENTATION_TRANSFORMS.get(orientation, (False, 0))
+    return mirror, (base + quarters) % 4
+
+
+def transform_size(size, transform):
+    # type: (tuple[int, int], tuple[bool, int]) -> tuple[int, int]
+    """変換後の画像のサイズ"""
+    width, height = size
+    return (height, width) if transform[1] % 2 else (width, height)
+
+
+def transpose_image(image, transform):
+    # type: (Image.Image, tuple[bool, int]) -> Image.Image
+    """変換を1回の転置で適用(画素を並べ替えるだけで補間しない)"""
+    method = _TRANSPOSE_METHODS.get(transform)
+    if method is None:
+        return image
+    return image.transpose(getattr(pil_image(), method))
+
+
+class PreviewData:
+    """デコード済みのプレビュー情報
+
+    levels には PREVIEW_MAX_SIZE を最大辺とする画像から半分ずつ縮小した画像を
+    大きい順に保持する(プレビューピラミッド)。
+    レベルは EXIF の向きを正した状態で、ブロックの回転は rotated() で作成する。
+    """
+    def __init__(self, levels, source_size, mtime=None, file_size=None):
+        # type: (list[Image.Image], tuple[int, int], float, int) -> None
+        self.levels = levels
+        self.source_size = source_size
+        """元画像のサイズ(px)"""
+        self.mtime = mtime
+        self.file_size = file_size
+        self.saliency = None
+        """自動トリミング用の顕著度マップ(autoCrop.saliency_for で作成)"""
+        self.color_feature = None
+        """類似度用の色の特徴量(colorIndex.feature_for で作成)"""
+        self._rotated = {}  # type: dict[tuple[int, int], Image.Image]
+        """(レベルの番号, 時計回りに 90度回転する回数): 回転済みのレベル"""
+
+    @property
+    def preview(self):
+        # type: () -> Image.Image
+        return self.levels[0]
+
+    @property
+    def rot_90_scale(self):
+        # type: () -> float
+        """90度回転時にセルを埋めるためのスケール"""
+        return compute_rot_90_scale(*self.source_size)
+
+    def level_for(self, width, height, scale=1.0):
+        # type: (float, float, float) -> Image.Image
+        """指定サイズの矩形を埋められる最小のピラミッド画像を返す"""
+        iw, ih = self.preview.size
+        needed_width = max(width, height * iw / float(ih)) * scale
+        for level in reversed(self.levels):
+            if level.width >= needed_width:
+                return level
+        return self.levels[0]
+
+    def rotated(self, image, rotation):
+        # type: (Image.Image, float) -> Image.Image
+        """ピラミッドのレベルを rotation(時計回り、90度単位)だけ回転した画像
+
+        回転は補間の無い転置で行い、レベルと回転角ごとに1回だけ作成して保持する。
+        同じプレビューを使うブロック全てで使い回すので、セルを回転しても再サンプリングは起きない。
+        """
+        transform = orientation_transform(1, rotation)
+        if transform is None or transform == (False, 0):
+            return image
+        for index, level in enumerate(self.levels):
+            if level is image:
+                break
+        else:
+            return transpose_image(image, transform)
+        key = (index, transform[1])
+        rotated = self._rotated.get(key)
+        if rotated is None:
+            with PERF.measure("transpose"):
+                rotated = self._rotated[key] = transpose_image(image, transform)
+        return rotated
+
+    def nbytes(self):
+        # type: () -> int
+        """保持しているピクセルのバイト数"""
+        images = list(self.levels) + list(self._rotated.values())
+        return sum(image.width * image.height * len(image.getbands()) for image in images)
+
+
+def compute_rot_90_scale(width, height):
+    # type: (float, float) -> float
+    if width > height:
+        return float(width) / float(height)
+    return float(height) / float(width)
+
+
+def image_aspect(source_size, rotation=0):
+    # type: (tuple[int, int], float) -> float
+    """回転を反映した画像の縦横比(幅 / 高さ)"""
+    width, height = source_size
+    if int(round(rotation / 90.0)) % 2:
+        width, height = height, width
+    return float(width) / float(height)
+
+
+def preview_size(width, height):
+    # type: (int, int) -> tuple[int, int]
+    """元画像サイズからプレビューのサイズを計算"""
+    if width > height:
+        new_width = PREVIEW_MAX_SIZE
+        new_height = (PREVIEW_MAX_SIZE / width) * height
+    else:
+        new_height = PREVIEW_MAX_SIZE
+        new_width = (PREVIEW_MAX_SIZE / height) * width
+    return int(new_width), int(new_height)
+
+
+def build_pyramid(preview):
+    # type: (Image.Image) -> list[Image.Image]
+    """プレビュー画像からピラミッドを作成"""
+    levels = [preview]
+    for _ in range(PREVIEW_PYRAMID_LEVELS - 1):
+        last = levels[-1]
+        if last.width < 4 or last.height < 4:
+            break
+        levels.append(last.reduce(2))
+    return levels
+
+
+def open_image(path):
+    # type: (str) -> Image.Image
+    """元画像を開く(ピクセルのデコードは遅延される。EXIF の向きは正さない)"""
+    return pil_image().open(resolve_path(path))
+
+
+def decode_preview(path, image=None):
+    # type: (str, Image.Image) -> PreviewData | None
+    """画像ファイルからプレビューを作成
+
+    EXIF の向きはここで1回だけ正す。縮小してから転置するので、全画素の転置は行わない。
+    プレビューのレベルと source_size は向きを正した後のもの。
+    """
+    # ローカルのコピーは元画像と同じ更新日時なので、stat もコピーから取得する
+    local_path = resolve_path(path)
+    if not local_path or not os.path.isfile(local_path):
+        return None
+    stat = os.stat(local_path)
+    if image is None:
+        image = pil_image().open(local_path)
+    transform = orientation_transform(image_orientation(image))
+    size = preview_size(image.width, image.height)
+    with PERF.measure("decode", path=os.path.basename(path)):
+        image.load()
+    with PERF.measure("resample"):
+        preview = transpose_image(image.resize(size, pil_image().BICUBIC), transform)
+    return PreviewData(build_pyramid(preview), transform_size(image.size, transform), stat.st_mtime, stat.st_size)
+
+
+def _exif_text(value):
+    # type: (object) -> str | None
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    return str(value).strip("\x00 ") or None
+
+
+def difference_hash(image, hash_size=8):
+    # type: (Image.Image, int) -> str
+    """画像の dHash(隣り合う画素の明暗差による知覚ハッシュ)を16進数で取得"""
+    Image = pil_image()
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.BOX)
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            bits = (bits << 1) | (left > pixels[row * (hash_size + 1) + col + 1])
+    return "%0*x" % (hash_size * hash_size // 4, bits)
+
+
+def read_metadata(path):
+    # type: (str) -> dict
+    """サイズ、EXIF(向き, 撮影日時, カメラ)、知覚ハッシュを取得
+
+    ハッシュ用のデコードは JPEG の縮小デコードを使うので、全画素は展開しない。
+    """
+    with open_image(path) as image:
+        width, height = image.size
+        exif = image.getexif()
+        exif_ifd = exif.get_ifd(EXIF_IFD_TAG)
+        captured_at = _exif_text(exif_ifd.get(EXIF_DATETIME_ORIGINAL_TAG) or exif.get(EXIF_DATETIME_TAG))
+        if captured_at:
+            # "2024:05:01 12:34:56" -> "2024-05-01 12:34:56"(文字列のまま並べ替えられる形式)
+            captured_at = captured_at.replace(":", "-", 2)
+        camera = " ".join(filter(None, (_exif_text(exif.get(EXIF_MAKE_TAG)), _exif_text(exif.get(EXIF_MODEL_TAG)))))
+        image.draft("L", (64, 64))
+        with PERF.measure("phash"):
+            phash = difference_hash(image)
+    return {
+        "width": width,
+        "height": height,
+        "orientation": int(exif.get(EXIF_ORIENTATION_TAG, 1) or 1),
+        "captured_at": captured_at,
+        "camera": camera or None,
+        "phash": phash,
+    }
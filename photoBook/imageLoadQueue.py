@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+画像のバックグラウンド読み込み
+
+優先度付きのキューでプレビューのデコードをワーカースレッドに任せ、
+結果はGUIスレッドのコールバックで受け取る。
+"""
+import heapq
+import itertools
+import os
+import threading
+from PySide6 import QtCore
+from .imageIO import decode_preview
+from .perfMonitor import PERF
+DEFAULT_WORKER_COUNT = max(1, min(4, (os.cpu_count() or 2) - 1))
+
+
+class ImageLoadQueue(QtCore.QObject):
+    """優先度の小さい順にプレビューをデコードするキュー"""
+    _loaded = QtCore.Signal(object, str, object)
+
+    def __init__(self, worker_count=DEFAULT_WORKER_COUNT, parent=None):
+        # type: (int, QtCore.QObject) -> None
+        super().__init__(parent)
+        self._heap = []  # type: list[tuple]
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._worker_count = worker_count
+        self._workers = []  # type: list[threading.Thread]
+        self._loaded.connect(self._deliver, QtCore.Qt.QueuedConnection)
+
+    def request(self, path, priority, callback):
+        # type: (str, tuple, callable) -> None
+        """path のデコードを要求する
+
+        callback(path, preview_data) はGUIスレッドで呼ばれる(失敗時は preview_data が None)。
+        """
+        with self._condition:
+            heapq.heappush(self._heap, (priority, next(self._counter), path, callback))
+            self._condition.notify()
+        self._start_workers()
+
+    def pending_count(self):
+        # type: () -> int
+        with self._condition:
+            return len(self._heap)
+
+    def _start_workers(self):
+        # type: () -> None
+        while len(self._workers) < self._worker_count:
+            worker = threading.Thread(target=self._run, name="ImageLoadQueue", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                _, _, path, callback = heapq.heappop(self._heap)
+            try:
+                with PERF.measure("background_decode", path=os.path.basename(path)):
+                    preview_data = decode_preview(path)
+            except Exception:
+                preview_data = None
+            if preview_data is not None:
+                # 自動トリミング用の顕著度マップと類似度用の色の特徴量も読み込み時に作成しておく
+                try:
+                    from .autoCrop import saliency_for
+                    saliency_for(preview_data)
+                except Exception:
+                    pass
+                try:
+                    from .colorIndex import feature_for
+                    feature_for(preview_data)
+                except Exception:
+                    pass
+            self._loaded.emit(callback, path, preview_data)
+
+    def _deliver(self, callback, path, preview_data):
+        # type: (callable, str, PreviewData) -> None
+        callback(path, preview_data)
+
+
+_IMAGE_LOAD_QUEUE = None
+
+
+def image_load_queue():
+    # type: () -> ImageLoadQueue
+    """アプリ全体で共有する読み込みキュー(QApplication 作成後に呼ぶ)"""
+    global _IMAGE_LOAD_QUEUE
+    if _IMAGE_LOAD_QUEUE is None:
+        _IMAGE_LOAD_QUEUE = ImageLoadQueue()
+    return _IMAGE_LOAD_QUEUE
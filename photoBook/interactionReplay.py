@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+操作の記録と再生によるUIレイテンシ計測
+
+記録: 表示メニューの「操作を記録する」で開始/停止し、JSONに保存する。
+再生:
+    python -m photoBook.interactionReplay recording.json [--repeat 3] [--json result.json]
+
+記録したマウス/ホイール/ドロップ操作を offscreen で同じ順番に送り直し、
+イベント処理時間と再描画時間の p50/p95/p99 をイベントの種類ごとに出力する。
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PySide6 import QtWidgets, QtGui, QtCore
+RECORDING_VERSION = 1
+PERCENTILES = (50, 95, 99)
+MOUSE_EVENT_TYPES = {
+    QtCore.QEvent.MouseButtonPress: "press",
+    QtCore.QEvent.MouseMove: "move",
+    QtCore.QEvent.MouseButtonRelease: "release",
+}
+
+
+def _modifiers_value(modifiers):
+    # type: (QtCore.Qt.KeyboardModifiers) -> int
+    return modifiers.value if hasattr(modifiers, "value") else int(modifiers)
+
+
+def _view_state(view):
+    # type: (QtWidgets.QGraphicsView) -> dict
+    """ビューのズームとスクロール位置"""
+    t = view.transform()
+    return {
+        "transform": [t.m11(), t.m12(), t.m21(), t.m22(), t.dx(), t.dy()],
+        "scroll": [view.horizontalScrollBar().value(), view.verticalScrollBar().value()],
+        "viewport_size": [view.viewport().width(), view.viewport().height()],
+    }
+
+
+def _restore_view_state(view, state):
+    # type: (QtWidgets.QGraphicsView, dict) -> None
+    view.setTransform(QtGui.QTransform(*state["transform"]))
+    view.horizontalScrollBar().setValue(state["scroll"][0])
+    view.verticalScrollBar().setValue(state["scroll"][1])
+
+
+class InteractionRecorder(QtCore.QObject):
+    """PhotoCollageView のビューポートに届くイベントを記録する"""
+
+    def __init__(self, views, context=None):
+        # type: (dict[str, QtWidgets.QGraphicsView], dict) -> None
+        super().__init__()
+        self._views = views
+        self._viewports = {view.viewport(): name for name, view in views.items()}
+        self._start = 0.0
+        self.recording = False
+        self.data = {
+            "version": RECORDING_VERSION,
+            "context": context,
+            "views": {},
+            "events": [],
+        }
+
+    def start(self):
+        # type: () -> None
+        """記録開始"""
+        self.data["views"] = {name: _view_state(view) for name, view in self._views.items()}
+        self.data["events"] = []
+        self._start = time.perf_counter()
+        for viewport in self._viewports:
+            viewport.installEventFilter(self)
+        self.recording = True
+
+    def stop(self):
+        # type: () -> dict
+        """記録停止"""
+        for viewport in self._viewports:
+            viewport.removeEventFilter(self)
+        self.recording = False
+        return self.data
+
+    def save(self, path):
+        # type: (str) -> None
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=2, ensure_ascii=False)
+
+    def eventFilter(self, obj, event):
+        name = self._viewports.get(obj)
+        if name is None:
+            return False
+        record = None
+        event_type = event.type()
+        if event_type in MOUSE_EVENT_TYPES:
+            record = {
+                "type": MOUSE_EVENT_TYPES[event_type],
+                "pos": [event.position().x(), event.position().y()],
+                "button": event.button().value,
+                "buttons": event.buttons().value,
+                "modifiers": _modifiers_value(event.modifiers()),
+            }
+        elif event_type == QtCore.QEvent.Wheel:
+            record = {
+                "type": "wheel",
+                "pos": [event.position().x(), event.position().y()],
+                "angle_delta": [event.angleDelta().x(), event.angleDelta().y()],
+                "buttons": event.buttons().value,
+                "modifiers": _modifiers_value(event.modifiers()),
+            }
+        elif event_type == QtCore.QEvent.Drop:
+            mime = event.mimeData()
+            record = {
+                "type": "drop",
+                "pos": [event.position().x(), event.position().y()],
+                "text": mime.text() if mime.hasText() else None,
+                "urls": [url.toLocalFile() for url in mime.urls()] if mime.hasUrls() else [],
+                "modifiers": _modifiers_value(event.modifiers()),
+            }
+        if record:
+            record["view"] = name
+            record["time"] = time.perf_counter() - self._start
+            self.data["events"].append(record)
+        return False
+
+
+class InteractionReplayer:
+    """記録した操作を送り直し、処理時間と再描画時間を計測する"""
+
+    def __init__(self, views, set_context=None):
+        # type: (dict[str, QtWidgets.QGraphicsView], callable) -> None
+        self._views = views
+        self._set_context = set_context
+        """記録の context を復元する関数(PhotoBookApp.set_context)"""
+        self.samples = {}  # type: dict[str, dict[str, list[float]]]
+        """イベント種類ごとの {"handle": [ms], "repaint": [ms]}"""
+
+    def replay(self, recording, repeat=1):
+        # type: (dict, int) -> dict
+        """記録を再生し、集計結果を返す
+
+        繰り返す場合は毎回、記録開始時のレイアウト(context)と表示位置に戻してから再生する
+        (入れ替えや拡大縮小の結果が積み重なって、2回目以降が別の処理を計測しないようにする)。
+        """
+        originals = {}
+        for view in self._views.values():
+            # QDrag.exec はネストしたイベントループで待ってしまうので、再生中は何もしない
+            originals[view] = view.exec_block_drag
+            view.exec_block_drag = lambda mime: None
+        try:
+            for _ in range(repeat):
+                if self._set_context is not None and recording.get("context"):
+                    self._set_context(recording["context"])
+                    QtWidgets.QApplication.processEvents()
+                for name, state in recording.get("views", {}).items():
+                    if name in self._views:
+                        _restore_view_state(self._views[name], state)
+                for record in recording["events"]:
+                    self._replay_event(record)
+        finally:
+            for view, original in originals.items():
+                view.exec_block_drag = original
+        return self.report()
+
+    def _replay_event(self, record):
+        # type: (dict) -> None
+        view = self._views.get(record["view"])
+        if view is None:
+            return
+        viewport = view.viewport()
+        pos = QtCore.QPointF(*record["pos"])
+        global_pos = QtCore.QPointF(viewport.mapToGlobal(pos.toPoint()))
+        modifiers = QtCore.Qt.KeyboardModifier(record.get("modifiers", 0))
+        QtGui.QCursor.setPos(global_pos.toPoint())
+        events = []
+        if record["type"] == "wheel":
+            angle_delta = QtCore.QPoint(*record["angle_delta"])
+            events.append(QtGui.QWheelEvent(
+                pos, global_pos, QtCore.QPoint(), angle_delta, QtCore.Qt.MouseButton(record["buttons"]),
+                modifiers, QtCore.Qt.NoScrollPhase, False))
+        elif record["type"] == "drop":
+            mime = QtCore.QMimeData()
+            if record.get("text") is not None:
+                mime.setText(record["text"])
+            if record.get("urls"):
+                mime.setUrls([QtCore.QUrl.fromLocalFile(path) for path in record["urls"]])
+            actions = QtCore.Qt.CopyAction | QtCore.Qt.MoveAction
+            buttons = QtCore.Qt.LeftButton
+            events.append(QtGui.QDragEnterEvent(pos.toPoint(), actions, mime, buttons, modifiers))
+            events.append(QtGui.QDragMoveEvent(pos.toPoint(), actions, mime, buttons, modifiers))
+            events.append(QtGui.QDropEvent(pos, actions, mime, buttons, modifiers))
+        else:
+            event_type = {value: key for key, value in MOUSE_EVENT_TYPES.items()}[record["type"]]
+            events.append(QtGui.QMouseEvent(
+                event_type, pos, global_pos, QtCore.Qt.MouseButton(record["button"]),
+                QtCore.Qt.MouseButton(record["buttons"]), modifiers))
+
+        start = time.perf_counter()
+        for event in events:
+            QtWidgets.QApplication.sendEvent(viewport, event)
+        handled = time.perf_counter()
+        QtWidgets.QApplication.processEvents()
+        viewport.repaint()
+        repainted = time.perf_counter()
+
+        key = self._event_key(record)
+        samples = self.samples.setdefault(key, {"handle": [], "repaint": []})
+        samples["handle"].append((handled - start) * 1000.0)
+        samples["repaint"].append((repainted - handled) * 1000.0)
+
+    @staticmethod
+    def _event_key(record):
+        # type: (dict) -> str
+        """集計用のイベント名(Ctrl付きの操作は別に集計)"""
+        key = record["type"]
+        if record.get("modifiers", 0) & QtCore.Qt.ControlModifier.value:
+            key = "ctrl+" + key
+        return key
+
+    def report(self):
+        # type: () -> dict
+        """イベント種類ごとのパーセンタイル"""
+        result = {}
+        for key, samples in sorted(self.samples.items()):
+            result[key] = {"count": len(samples["handle"])}
+            for phase in ("handle", "repaint"):
+                for percentile_value in PERCENTILES:
+                    result[key]["%s_p%d_ms" % (phase, percentile_value)] = percentile(
+                        samples[phase], percentile_value)
+        return result
+
+
+def percentile(values, percent):
+    # type: (list[float], float) -> float
+    """最近傍順位法によるパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def print_report(report):
+    # type: (dict) -> None
+    header = "%-14s %6s" % ("event", "count")
+    for phase in ("handle", "repaint"):
+        for percentile_value in PERCENTILES:
+            header += " %11s" % ("%s p%d" % (phase, percentile_value))
+    print(header)
+    for key, values in report.items():
+        line = "%-14s %6d" % (key, values["count"])
+        for phase in ("handle", "repaint"):
+            for percentile_value in PERCENTILES:
+                line += " %11.2f" % values["%s_p%d_ms" % (phase, percentile_value)]
+        print(line)
+
+
+def main(argv=None):
+    from .mainWidget import PhotoBookApp
+    parser = argparse.ArgumentParser(description="記録した操作を再生してレイテンシを計測する")
+    parser.add_argument("recording")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", help="集計結果の保存先")
+    args = parser.parse_args(argv)
+
+    with open(args.recording, "r", encoding="utf-8") as f:
+        recording = json.load(f)
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    window = PhotoBookApp(restore_session=False)
+    window.show()
+    app.processEvents()
+    replayer = InteractionReplayer({"photo": window.photo_widget, "stock": window.stock_widget},
+                                   window.set_context)
+    report = replayer.replay(recording, args.repeat)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+画像の縦横比に合うレイアウトの推薦
+
+LAYOUT_PRESETS の全レイアウトについて、画像をセルに最適に割り当てた時の
+切り抜き量をシーンを使わずに NumPy でまとめて計算し、少ない順に並べる。
+
+画像とセルの縦横比の差は log(縦横比) の差で測る。この差の絶対値は凸なので、
+画像とセルをそれぞれ log(縦横比) で並べ替えると、最適な割り当ては順序を保つものに限られる。
+そのため割り当ては「どのセルを使うか」だけのDPになり、全レイアウトをまとめて計算できる。
+"""
+import math
+from typing import NamedTuple
+import numpy as np
+from .define import *
+UNMATCHED_PENALTY = math.log(2.0)
+"""画像の入らないセル、セルに入らない画像1つあたりの損失(面積の半分を失うのと同じ)"""
+
+
+class LayoutScore(NamedTuple):
+    """レイアウトの評価結果"""
+    layout_name: str
+    size_switch: bool
+    """縦向きで使うかどうか(SIZE_SWITCH_LAYOUT に含まれるレイアウト)"""
+    score: float
+    """1枠あたりの平均損失(小さいほど良い)"""
+    crop_loss: float
+    """割り当てた画像の log(縦横比) の差の合計"""
+    unmatched: int
+    """画像の入らないセル、またはセルに入らない画像の数"""
+
+    @property
+    def crop_ratio(self):
+        # type: () -> float
+        """切り抜かれる面積の割合の目安"""
+        return 1.0 - math.exp(-self.score)
+
+
+def cell_log_aspects(rect_ratios, width, height, block_space_margin_px=0, top_under_margin_px=0,
+                     side_margin_px=0):
+    # type: (list[tuple], int, int, int, int, int) -> np.ndarray
+    """余白を反映したセルの log(縦横比) を並べ替えて取得"""
+    rects = np.asarray(rect_ratios, dtype=np.float64).reshape(-1, 4)
+    # apply_block_margins は要素ごとの演算だけなので配列のままで計算できる
+    _, _, w, h = apply_block_margins(rects.T, width, height, block_space_margin_px,
+                                     top_under_margin_px, side_margin_px)
+    w, h = np.maximum(w * width, 1e-6), np.maximum(h * height, 1e-6)
+    return np.sort(np.log(w / h))
+
+
+def ordered_match_cost(short_logs, long_logs):
+    # type: (np.ndarray, np.ndarray) -> np.ndarray
+    """順序を保つ割り当ての最小コストをレイアウトごとにまとめて計算
+
+    short_logs は (L, n)、long_logs は (L, m) の並べ替え済みの配列(n <= m)。
+    long_logs の使わない部分は inf で埋めておく。
+    short の i 番目を long の j 番目に割り当てる時、
+        dp[i][j] = min(dp[i][j-1], dp[i-1][j-1] + |short[i] - long[j]|)
+    を j 方向の累積最小値で1行ずつ計算する。
+    """
+    layouts, n = short_logs.shape
+    m = long_logs.shape[1]
+    dp = np.zeros((layouts, m + 1))
+    for i in range(n):
+        cost = np.abs(long_logs - short_logs[:, i:i + 1])
+        row = np.full((layouts, m + 1), np.inf)
+        row[:, 1:] = np.minimum.accumulate(dp[:, :-1] + cost, axis=1)
+        dp = row
+    return dp[:, -1]
+
+
+def recommend_layouts(image_aspects, short_px, long_px, block_space_margin_px=0,
+                      top_under_margin_px=0, side_margin_px=0, presets=None):
+    # type: (list[float], int, int, int, int, int, dict) -> list[LayoutScore]
+    """画像の縦横比に合うレイアウトを良い順に取得
+
+    short_px, long_px は SIZE_PRESETS の (短辺, 長辺)。
+    レイアウトの向きは SIZE_SWITCH_LAYOUT に含まれるかどうかで決める(ToolBarWidget と同じ)。
+    """
+    presets = presets if presets is not None else LAYOUT_PRESETS
+    logs = np.sort(np.log(np.asarray(image_aspects, dtype=np.float64)))
+    names = list(presets)
+    cells = []
+    for name in names:
+        size_switch = name in SIZE_SWITCH_LAYOUT
+        width, height = (short_px, long_px) if size_switch else (long_px, short_px)
+        cells.append(cell_log_aspects(presets[name], width, height, block_space_margin_px,
+                                      top_under_margin_px, side_margin_px))
+
+    # セル数の違うレイアウトを inf で埋めて1つの配列にする
+    max_cells = max(len(c) for c in cells)
+    padded = np.full((len(names), max_cells), np.inf)
+    for index, c in enumerate(cells):
+        padded[index, :len(c)] = c
+    counts = np.array([len(c) for c in cells])
+    image_count = len(logs)
+
+    crop = np.zeros(len(names))
+    # 画像の方が少ないレイアウトは使うセルを、多いレイアウトは使う画像を選ぶ
+    fewer_images = counts >= image_count
+    if image_count and fewer_images.any():
+        short = np.broadcast_to(logs, (int(fewer_images.sum()), image_count))
+        crop[fewer_images] = ordered_match_cost(short, padded[fewer_images])
+    for index in np.flatnonzero(~fewer_images):
+        c = cells[index]
+        if len(c):
+            crop[index] = ordered_match_cost(c[np.newaxis, :], logs[np.newaxis, :])[0]
+
+    unmatched = np.abs(counts - image_count)
+    slots = np.maximum(np.maximum(counts, image_count), 1)
+    scores = (crop + unmatched * UNMATCHED_PENALTY) / slots
+    order = np.argsort(scores, kind="stable")
+    return [LayoutScore(names[i], names[i] in SIZE_SWITCH_LAYOUT, float(scores[i]), float(crop[i]),
+                        int(unmatched[i]))
+            for i in order]
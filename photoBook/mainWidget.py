@@ -2,22 +2,52 @@
 """
 Copyright 2024, YAMAGUCHI Yasushi
 """
+import time
+STARTUP_NS = time.perf_counter_ns()
+"""起動時間の計測の基準(重いモジュールを読み込む前に記録する)"""
 import json
 from PySide6 import QtWidgets, QtGui, QtCore
 import os
 from pathlib import Path
 from photoBook.define import *
 from photoBook.toolBarWidget import ToolBarWidget
+from photoBook.pageNavigatorWidget import PageNavigatorWidget
+from photoBook.bookDocument import BookDocument
+from photoBook.imageLoadQueue import image_load_queue
 from photoBook.photoCollageView import PhotoCollageView
+from photoBook.projectBundle import ProjectBundle, context_image_paths, save_bundle
+from photoBook.photoIndex import PhotoIndex
+from photoBook.photoIndexScanner import PhotoIndexScanner
+from photoBook.perfMonitor import PERF
+from photoBook.exportRenderer import EncodeOptions, encode_format
+from photoBook.exportWorker import (
+    EXPORT_FILE_FILTER, BookExportWorker, ContactSheetWorker, ExportOptionsDialog, ExportWorker,
+    ensure_export_ext, variant_output_path)
+from photoBook.bookExport import BOOK_FILE_FILTER, BOOK_FORMATS, book_format, book_snapshots
+from photoBook.contactSheet import ContactSheetOptions, folder_images
+from photoBook.tileCache import TILE_CACHE
+from photoBook.exportPrefetcher import ExportPrefetcher
+from photoBook.mirrorCache import MirrorCache, throttle_from_env
+from photoBook.imageIO import set_path_resolver
+from photoBook.previewArena import open_arena, write_arena
 ROOT_PATH = Path(__file__).parent.parent
 CONFIG_FILE = ROOT_PATH / "photo_book_config.json"
+TILE_CACHE_DIR = ROOT_PATH / ".photo_book_tile_cache"
+INDEX_FILE = ROOT_PATH / "photo_book_index.sqlite3"
+MIRROR_DIR = ROOT_PATH / ".photo_book_mirror"
+PREVIEW_ARENA_FILE = ROOT_PATH / "photo_book_previews.arena"
+LAYOUT_FILE_FILTER = "Layout Files (*.json);;Photo Book Files (*%s)" % BUNDLE_EXT
+STARTUP_TRACE_ENV = "PHOTOBOOK_STARTUP_TRACE"
 
 
 class PhotoBookApp(QtWidgets.QMainWindow):
 
-    def __init__(self):
+    def __init__(self, restore_session=True):
+        # type: (bool) -> None
         super().__init__()
         self.input_widget = ToolBarWidget()
+        self.page_navigator = PageNavigatorWidget()
+        self.book = BookDocument(self.input_widget.get_current_layout())
         self.splitter = QtWidgets.QSplitter(QtCore.Qt.Horizontal)
         self.photo_widget = PhotoCollageView()
         self.stock_widget = PhotoCollageView()
@@ -30,13 +60,28 @@ class PhotoBookApp(QtWidgets.QMainWindow):
         self.stock_widget.export_height = 1000
         # self.stock_widget.wheel_zoom_flag = False
         self._first_show = True
+        self._interaction_recorder = None
+        self._export_options = EncodeOptions()
+        self._export_workers = []  # type: list[ExportWorker]
+        self._mirror = None  # type: MirrorCache | None
+        self._preview_arena = None  # type: PreviewArena | None
+        self.photo_index = PhotoIndex(INDEX_FILE.as_posix())
+        self._index_scanner = PhotoIndexScanner(self.photo_index, self)
+        self.photo_widget.photo_index = self.photo_index
+        self.stock_widget.photo_index = self.photo_index
+        self.export_prefetcher = ExportPrefetcher(self.photo_widget.export_snapshot, parent=self)
+        self.photo_widget.first_painted.connect(self._on_first_frame)
+        self.photo_widget.images_loaded.connect(self._on_images_loaded)
+        self.photo_widget.history_restored.connect(self._sync_tool_bar)
         self.stock_widget.set_block_layout("ストック", tile_layout(3, 10))
-        self.stock_widget.draw_layout(True)
+        self.stock_widget.draw_layout()
 
         self._setup_gui()
         # 初期値、もしくは前回の復帰
-        if not self.load_layout(True):
+        if not restore_session or not self.load_layout(True):
             self.set_layout_name(self.input_widget.get_current_layout())
+        self.photo_widget.history.clear()
+        self._update_page_navigator()
 
     # =================================
     # Public
@@ -57,12 +102,143 @@ class PhotoBookApp(QtWidgets.QMainWindow):
             index += 1
         self.update()
 
-    def save_image(self):
-        path, _ = QtWidgets.QFileDialog.getSaveFileName(
-            self, "画像を保存", "collage.png", "PNG Files (*.png);;JPEG Files (*.jpg)")
-        if path:
-            self.photo_widget.export_image(path)
-            QtWidgets.QMessageBox.information(self, "保存完了", f"保存しました:\n{path}")
+    def save_image(self, all_dpi=False):
+        # type: (bool) -> None
+        """画像を出力する
+        all_dpi の場合は、同じ用紙サイズの全てのDPIを1回の描画で出力する
+        """
+        path, selected_filter = QtWidgets.QFileDialog.getSaveFileName(
+            self, "画像を保存", "collage.png", EXPORT_FILE_FILTER)
+        if not path:
+            return
+        path = ensure_export_ext(path, selected_filter)
+        dialog = ExportOptionsDialog(encode_format(path), self._export_options, self)
+        if dialog.exec() != QtWidgets.QDialog.Accepted:
+            return
+        self._export_options = dialog.options()
+        variants = None
+        if all_dpi:
+            variants = []
+            for preset_name in size_preset_variants(self.input_widget.get_current_size_preset()):
+                width, height, dpi = self.input_widget.preset_canvas_size(preset_name)
+                variants.append((width, height, dpi, variant_output_path(path, dpi)))
+        self.start_export(path, variants or None)
+
+    def save_image_all_dpi(self):
+        # type: () -> None
+        self.save_image(all_dpi=True)
+
+    def start_export(self, path, variants=None):
+        # type: (str, list[tuple[int, int, int, str]]) -> None
+        """現在のレイアウトのスナップショットをバックグラウンドで出力する
+        出力中も編集を続けられる
+        """
+        snapshot = self.photo_widget.export_snapshot()
+        worker = ExportWorker(snapshot, path, self._export_options, self, variants)
+        progress = QtWidgets.QProgressDialog("画像を出力しています...", "キャンセル", 0, len(snapshot.blocks), self)
+        progress.setWindowTitle("画像を出力")
+        progress.setWindowModality(QtCore.Qt.NonModal)
+        progress.setAutoClose(False)
+        progress.setMinimumDuration(0)
+        progress.canceled.connect(worker.cancel)
+        worker.progress.connect(lambda done, total: progress.setValue(done))
+        saved_paths = "\n".join(variant[3] for variant in variants) if variants else path
+        worker.succeeded.connect(
+            lambda _: QtWidgets.QMessageBox.information(self, "保存完了", f"保存しました:\n{saved_paths}"))
+        worker.failed.connect(
+            lambda message: QtWidgets.QMessageBox.warning(self, "保存失敗", f"保存できませんでした:\n{message}"))
+        worker.finished.connect(progress.deleteLater)
+        worker.finished.connect(lambda: self._export_workers.remove(worker))
+        worker.finished.connect(self.export_prefetcher.resume)
+        worker.finished.connect(worker.deleteLater)
+        # 出力中は先読みと元画像の読み込みを取り合わないようにする
+        self.export_prefetcher.suspend()
+        self._export_workers.append(worker)
+        worker.start()
+
+    def export_book(self):
+        # type: () -> None
+        """全てのページを1つの PDF / マルチページTIFF に出力する(1ページずつ描画して追記する)
+        """
+        path, selected_filter = QtWidgets.QFileDialog.getSaveFileName(
+            self, "ブックを保存", "book.pdf", BOOK_FILE_FILTER)
+        if not path:
+            return
+        if os.path.splitext(path)[1].lower() not in BOOK_FORMATS:
+            path += ".tif" if "*.tif" in selected_filter else ".pdf"
+        dialog = ExportOptionsDialog(book_format(path), self._export_options, self)
+        if dialog.exec() != QtWidgets.QDialog.Accepted:
+            return
+        self._export_options = dialog.options()
+        snapshots = book_snapshots(self.context())
+
+        worker = BookExportWorker(snapshots, path, self._export_options, self)
+        total = sum(len(snapshot.blocks) for snapshot in snapshots)
+        progress = QtWidgets.QProgressDialog("ブックを出力しています...", "キャンセル", 0, total, self)
+        progress.setWindowTitle("ブックを出力")
+        progress.setWindowModality(QtCore.Qt.NonModal)
+        progress.setAutoClose(False)
+        progress.setMinimumDuration(0)
+        progress.canceled.connect(worker.cancel)
+        worker.progress.connect(lambda done, total: progress.setValue(done))
+        worker.succeeded.connect(lambda saved: QtWidgets.QMessageBox.information(
+            self, "保存完了", "%d ページを保存しました:\n%s" % (len(snapshots), saved)))
+        worker.failed.connect(
+            lambda message: QtWidgets.QMessageBox.warning(self, "保存失敗", f"保存できませんでした:\n{message}"))
+        worker.finished.connect(progress.deleteLater)
+        worker.finished.connect(lambda: self._export_workers.remove(worker))
+        worker.finished.connect(self.export_prefetcher.resume)
+        worker.finished.connect(worker.deleteLater)
+        self.export_prefetcher.suspend()
+        self._export_workers.append(worker)
+        worker.start()
+
+    def create_contact_sheet(self):
+        # type: () -> None
+        """フォルダーの全ての画像を番号付きで格子状に並べたページを作成する(現在の用紙サイズの縦向き)
+        """
+        folder = QtWidgets.QFileDialog.getExistingDirectory(self, "コンタクトシートにするフォルダを選択")
+        if not folder:
+            return
+        image_paths = folder_images(folder)
+        if not image_paths:
+            QtWidgets.QMessageBox.information(self, "コンタクトシート", "画像がありません")
+            return
+        defaults = ContactSheetOptions()
+        columns, ok = QtWidgets.QInputDialog.getInt(self, "コンタクトシート", "列数:", defaults.columns, 1, 50)
+        if not ok:
+            return
+        rows, ok = QtWidgets.QInputDialog.getInt(self, "コンタクトシート", "行数:", defaults.rows, 1, 50)
+        if not ok:
+            return
+        path, selected_filter = QtWidgets.QFileDialog.getSaveFileName(
+            self, "コンタクトシートを保存", "contact_sheet.jpg", EXPORT_FILE_FILTER)
+        if not path:
+            return
+        path = ensure_export_ext(path, selected_filter)
+        width, height, dpi = preset_canvas_size(self.input_widget.get_current_size_preset(), True)
+        options = defaults._replace(columns=columns, rows=rows, width=width, height=height, dpi=dpi)
+
+        worker = ContactSheetWorker(image_paths, path, options, self._export_options, self)
+        progress = QtWidgets.QProgressDialog(
+            "コンタクトシートを作成しています...", "キャンセル", 0, len(image_paths), self)
+        progress.setWindowTitle("コンタクトシート")
+        progress.setWindowModality(QtCore.Qt.NonModal)
+        progress.setAutoClose(False)
+        progress.setMinimumDuration(0)
+        progress.canceled.connect(worker.cancel)
+        worker.progress.connect(lambda done, total: progress.setValue(done))
+        worker.succeeded.connect(lambda saved: QtWidgets.QMessageBox.information(
+            self, "保存完了", "%d 枚を %d ページに保存しました:\n%s" % (len(image_paths), len(saved), saved[0])))
+        worker.failed.connect(
+            lambda message: QtWidgets.QMessageBox.warning(self, "保存失敗", f"保存できませんでした:\n{message}"))
+        worker.finished.connect(progress.deleteLater)
+        worker.finished.connect(lambda: self._export_workers.remove(worker))
+        worker.finished.connect(self.export_prefetcher.resume)
+        worker.finished.connect(worker.deleteLater)
+        self.export_prefetcher.suspend()
+        self._export_workers.append(worker)
+        worker.start()
 
     def save_layout(self, config=False):
         # type: (bool) -> None
@@ -70,18 +246,19 @@ class PhotoBookApp(QtWidgets.QMainWindow):
         """
         if not config:
             file_path = QtWidgets.QFileDialog.getSaveFileName(
-                self, "レイアウトを保存", "", "Layout Files (*.json)")
+                self, "レイアウトを保存", "", LAYOUT_FILE_FILTER)
+            if file_path[0] and BUNDLE_EXT in file_path[1] and not file_path[0].endswith(BUNDLE_EXT):
+                file_path = (file_path[0] + BUNDLE_EXT, file_path[1])
         else:
             file_path = [CONFIG_FILE.as_posix()]
         if file_path and os.path.isdir(os.path.dirname(file_path[0])):
-            # windowのサイズを保持し、再現する
-            window_size_width, window_size_height = self.size().width(), self.size().height()
-            context = {
-                'input_context': self.input_widget.context(),
-                'photo_context': self.photo_widget.context(),
-                'stock_context': self.stock_widget.context(),
-                'window_size': (window_size_width, window_size_height),
-            }
+            context = self.context()
+            if file_path[0].endswith(BUNDLE_EXT):
+                # プレビューも同梱して、別環境でも元画像をデコードせずに開けるようにする
+                preview_sources = self.stock_widget.preview_sources()
+                preview_sources.update(self.photo_widget.preview_sources())
+                save_bundle(file_path[0], context, preview_sources)
+                return
             with open(file_path[0], "w", encoding="utf-8") as f:
                 json.dump(context, f, indent=4, ensure_ascii=False)
 
@@ -90,35 +267,257 @@ class PhotoBookApp(QtWidgets.QMainWindow):
         """レイアウトを読み込む
         """
         if not config:
-            file_path = QtWidgets.QFileDialog.getOpenFileName(self, "レイアウトを読み込む", "", "Layout Files (*.json)")
+            file_path = QtWidgets.QFileDialog.getOpenFileName(self, "レイアウトを読み込む", "", LAYOUT_FILE_FILTER)
         else:
             file_path = [CONFIG_FILE.as_posix()]
         if file_path and os.path.isfile(file_path[0]):
             try:
-                with open(file_path[0], "r", encoding="utf-8") as f:
-                    context = json.load(f)
-                    self.input_widget.set_context(context.get('input_context', {}))
-                    self.photo_widget.set_context(context.get('photo_context', []))
-                    self.stock_widget.set_context(context.get('stock_context', []))
-                    self.resize(*context.get('window_size', (700, 500)))
+                if file_path[0].endswith(BUNDLE_EXT):
+                    with ProjectBundle(file_path[0]) as bundle:
+                        self.set_context(bundle.context, bundle.preview, defer_images=True)
+                else:
+                    with open(file_path[0], "r", encoding="utf-8") as f:
+                        context = json.load(f)
+                    if config:
+                        # 前回終了時のプレビューはアリーナからデコードせずに読み込む
+                        self._preview_arena = open_arena(PREVIEW_ARENA_FILE.as_posix())
+                    self.set_context(context, self._preview if config else None, defer_images=True)
+                if not self._first_show:
+                    self._request_pending_images()
                 return True
             except Exception as e:
                 pass
         return False
 
+    def context(self):
+        # type: () -> dict
+        """現在のレイアウト情報を辞書で取得する
+        """
+        # windowのサイズを保持し、再現する
+        window_size_width, window_size_height = self.size().width(), self.size().height()
+        self._store_current_page()
+        return {
+            'input_context': self.input_widget.context(),
+            'photo_context': self.photo_widget.context(),
+            'stock_context': self.stock_widget.context(),
+            'book': self.book.context(),
+            'window_size': (window_size_width, window_size_height),
+            'tile_cache_persist': self.tile_cache_action.isChecked(),
+            'mirror_enabled': self.mirror_action.isChecked(),
+        }
+
+    def set_context(self, context, preview_provider=None, defer_images=False):
+        # type: (dict, callable, bool) -> None
+        """保存したレイアウト情報を復元する
+
+        defer_images が True の場合は画像のデコードを後回しにする(_request_pending_images で開始)。
+        """
+        self.input_widget.set_context(context.get('input_context', {}))
+        # 'photo_context' は表示中のページ(ページの無い古いレイアウトはそれを1ページ目にする)
+        book_context = context.get('book') or {'pages': [{
+            'layout': self.input_widget.get_current_layout(),
+            'photo_context': context.get('photo_context', [])}]}
+        self.book.set_context(book_context)
+        self.photo_widget.set_context(context.get('photo_context', []), preview_provider, defer_images)
+        self._update_page_navigator()
+        self.stock_widget.set_context(context.get('stock_context', []), preview_provider, defer_images)
+        self.resize(*context.get('window_size', (700, 500)))
+        self.tile_cache_action.setChecked(context.get('tile_cache_persist', self.tile_cache_action.isChecked()))
+        self.mirror_action.setChecked(context.get('mirror_enabled', self.mirror_action.isChecked()))
+
     def batch_import(self):
         # type: () -> None
         """フォルダを指定してその中の画像を一括で読み込む
         """
         batch_folder = QtWidgets.QFileDialog.getExistingDirectory(self, "画像フォルダを選択")
         if batch_folder and os.path.isdir(batch_folder):
-            image_files = [os.path.join(batch_folder, f) for f in os.listdir(batch_folder)]
-            image_files.sort()
+            image_files = [os.path.join(batch_folder, f) for f in os.listdir(batch_folder)
+                           if f.lower().endswith(IMAGE_EXTS)]
+            # 索引済みの画像は撮影日時順、まだ索引に無い画像はファイル名順で後ろに並べる
+            image_files = self.photo_index.order_paths(image_files)
             self.set_image(image_files)
+            self._index_scanner.scan(batch_folder, recursive=False)
+
+    def set_current_page(self, index):
+        # type: (int) -> None
+        """表示するページを切り替える
+
+        表示中のページの状態とプレビューを BookDocument に預け、切り替え先のページを読み込む。
+        前後のページのプレビューは先読みしておくので、隣のページへの切り替えではデコードしない。
+        """
+        if index == self.book.current:
+            return
+        self._store_current_page()
+        page = self.book.set_current(index)
+        self.photo_widget.clear_blocks()
+        if self.input_widget.get_current_layout() != page.layout_name:
+            # レイアウトの変更は layout_changed から set_layout_name が呼ばれる
+            self.input_widget.layout_combo.setCurrentText(page.layout_name)
+        else:
+            self.set_layout_name(page.layout_name)
+        self.photo_widget.set_context(page.blocks, self._preview, defer_images=True)
+        self.photo_widget.request_pending_images(0)
+        self._prefetch_neighbour_pages()
+        self._update_page_navigator()
+
+    def add_page(self):
+        # type: () -> None
+        """表示中のページの次に空のページを追加する"""
+        self._store_current_page()
+        index = self.book.add_page(layout_name=self.input_widget.get_current_layout())
+        self.set_current_page(index)
+        self._update_page_navigator()
+
+    def remove_page(self):
+        # type: () -> None
+        """表示中のページを削除する"""
+        if len(self.book.pages) <= 1:
+            return
+        reply = QtWidgets.QMessageBox.question(
+            self, "ページを削除", "%d ページ目を削除しますか？" % (self.book.current + 1),
+            QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No, QtWidgets.QMessageBox.No)
+        if reply != QtWidgets.QMessageBox.Yes:
+            return
+        removed = self.book.current
+        self.book.remove_page(removed)
+        # 削除したページの内容は捨て、残ったページを表示し直す
+        self.book.current = -1
+        self.set_current_page(min(removed, len(self.book.pages) - 1))
+
+    def sort_stock_by_similarity(self):
+        # type: () -> None
+        """ストックの画像を色の近い順に並べ替える"""
+        self.stock_widget.sort_by_similarity()
+
+    def cluster_stock_into_pages(self):
+        # type: () -> None
+        """ストックの画像を色の近さでグループに分け、表示中のページの後ろにページとして追加する
+
+        1ページの枚数は現在のレイアウトのセル数まで。
+        """
+        index = self.stock_widget.color_index()
+        if not len(index):
+            QtWidgets.QMessageBox.information(self, "色の近さでページに分ける", "読み込み済みの画像がありません")
+            return
+        layout_name = self.input_widget.get_current_layout()
+        rect_ratios = LAYOUT_PRESETS[layout_name]
+        minimum = -(-len(index) // len(rect_ratios))
+        count, ok = QtWidgets.QInputDialog.getInt(
+            self, "色の近さでページに分ける", "ページ数:", minimum, minimum, max(minimum, len(index)))
+        if not ok:
+            return
+        rotations = {blk.image_path: blk.rotation for blk in self.stock_widget.blocks if blk.image_path}
+        groups = index.cluster(count, capacity=len(rect_ratios))
+        self._store_current_page()
+        first = self.book.current + 1
+        for offset, group in enumerate(groups):
+            page = self.book.pages[self.book.add_page(first + offset, layout_name)]
+            page.blocks = [{
+                "rect_ratio": rect_ratio, "offset_x": 0, "offset_y": 0, "scale": 1.0,
+                "rotation": rotations.get(group[i], 0) if i < len(group) else 0,
+                "file_path": group[i] if i < len(group) else None,
+            } for i, rect_ratio in enumerate(rect_ratios)]
+        self.set_current_page(first)
+        self._update_page_navigator()
+
+    def move_page(self, source, destination):
+        # type: (int, int) -> None
+        self._store_current_page()
+        self.book.move_page(source, destination)
+        self._prefetch_neighbour_pages()
+        self._update_page_navigator()
 
     # =================================
     # Slots
     # =================================
+    def recommend_layout(self):
+        # type: () -> None
+        """読み込んだ画像の縦横比に合うレイアウトを表示する
+        """
+        from photoBook.layoutRecommender import recommend_layouts
+        # まだデコードしていない画像は索引のサイズを使う
+        paths = context_image_paths({'photo_context': self.photo_widget.context(),
+                                     'stock_context': self.stock_widget.context()})
+        display_sizes = {path: record.display_size for path, record in self.photo_index.get_many(paths).items()
+                         if record.aspect}
+        # 同じ画像を複数のセルに配置した場合もセルごとに数える
+        aspects = self.stock_widget.image_aspects(display_sizes) + self.photo_widget.image_aspects(display_sizes)
+        scores = []
+        if aspects:
+            short_px, long_px, _ = SIZE_PRESETS[self.input_widget.get_current_size_preset()]
+            scores = recommend_layouts(aspects, short_px, long_px, *self.input_widget.get_margins())
+        self.input_widget.show_layout_recommendations(scores)
+
+    def set_interaction_recording(self, recording):
+        # type: (bool) -> None
+        """操作の記録を開始/停止し、停止時に保存先を選ぶ
+        """
+        from photoBook.interactionReplay import InteractionRecorder
+        if recording:
+            views = {"photo": self.photo_widget, "stock": self.stock_widget}
+            self._interaction_recorder = InteractionRecorder(views, self.context())
+            self._interaction_recorder.start()
+            return
+        if self._interaction_recorder is None:
+            return
+        self._interaction_recorder.stop()
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, "操作の記録を保存", "interaction.json", "JSON Files (*.json)")
+        if path:
+            self._interaction_recorder.save(path)
+        self._interaction_recorder = None
+
+    def set_tile_cache_persist(self, persist):
+        # type: (bool) -> None
+        """出力タイルのキャッシュをディスクにも保存するかを切り替える
+        """
+        TILE_CACHE.set_cache_dir(TILE_CACHE_DIR.as_posix() if persist else None)
+
+    def set_mirror_enabled(self, enabled):
+        # type: (bool) -> None
+        """元画像をローカルにコピーしてから使うかを切り替える(NAS やカードリーダー上の画像向け)
+        """
+        if enabled and self._mirror is None:
+            throttle_bytes_per_sec, throttle_latency = throttle_from_env()
+            self._mirror = MirrorCache(MIRROR_DIR.as_posix(), throttle_bytes_per_sec=throttle_bytes_per_sec,
+                                       throttle_latency=throttle_latency)
+            set_path_resolver(self._mirror.resolve)
+            self._mirror_images()
+        elif not enabled and self._mirror is not None:
+            set_path_resolver(None)
+            self._mirror.shutdown(wait=False)
+            self._mirror = None
+
+    def set_profiling_enabled(self, enabled):
+        # type: (bool) -> None
+        """パフォーマンス計測の有効/無効を切り替える
+        """
+        PERF.enabled = enabled
+
+    def set_perf_hud_visible(self, visible):
+        # type: (bool) -> None
+        """パフォーマンスHUDの表示を切り替える
+        """
+        PERF.hud_enabled = visible
+        if visible and not PERF.enabled:
+            self.profile_action.setChecked(True)
+        self.photo_widget.viewport().update()
+        self.stock_widget.viewport().update()
+
+    def save_profile(self):
+        # type: () -> None
+        """計測結果を保存する(拡張子 .trace.json の場合はChromeトレース形式)
+        """
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, "計測結果を保存", "photobook_profile.json",
+            "JSON Files (*.json);;Chrome Trace Files (*.trace.json)")
+        if not path:
+            return
+        if path.endswith(".trace.json"):
+            PERF.dump_chrome_trace(path)
+        else:
+            PERF.dump_json(path)
+
     def set_background_color(self, color):
         # type: (QtGui.QColor) -> None
         """背景色を設定する
@@ -130,6 +529,7 @@ class PhotoBookApp(QtWidgets.QMainWindow):
         # type: (int, int, int) -> None
         """余白を設定する
         """
+        self.photo_widget.begin_edit("余白の変更", merge_key="margin")
         self.photo_widget.block_space_margin_px = space_margin_px
         self.photo_widget.top_under_margin_px = top_under_margin_px
         self.photo_widget.side_margin_px = side_margin_px
@@ -139,9 +539,22 @@ class PhotoBookApp(QtWidgets.QMainWindow):
         # type: (str) -> None
         """レイアウト名を元にblockのレイアウトを構築する
         """
+        self.photo_widget.begin_edit("レイアウトの変更")
         self.photo_widget.set_block_layout(layout_name, LAYOUT_PRESETS[layout_name])
         self.photo_widget.draw_layout()
 
+    def undo(self):
+        # type: () -> None
+        """直前の編集を元に戻す
+        """
+        self.photo_widget.undo()
+
+    def redo(self):
+        # type: () -> None
+        """元に戻した編集をやり直す
+        """
+        self.photo_widget.redo()
+
     def set_export_size(self, width_px, height_px, dpi):
         # type: (int, int, int) -> None
         """出力画像のサイズとDPIを設定する
@@ -165,13 +578,15 @@ class PhotoBookApp(QtWidgets.QMainWindow):
         layout.setContentsMargins(0, 0, 0, 0)
         layout.setSpacing(0)
         layout.addWidget(self.input_widget)
+        layout.addWidget(self.page_navigator)
         layout.addWidget(self.splitter)
         self.splitter.addWidget(self.stock_widget)
         self.splitter.addWidget(self.photo_widget)
         self.splitter.setStretchFactor(0, 0)
         self.splitter.setStretchFactor(1, 1)
         layout.setStretch(0, 0)
-        layout.setStretch(1, 1)
+        layout.setStretch(1, 0)
+        layout.setStretch(2, 1)
 
         self.input_widget.canvas_size_changed.connect(self.set_export_size)
         self.input_widget.layout_changed.connect(self.set_layout_name)
@@ -181,25 +596,206 @@ class PhotoBookApp(QtWidgets.QMainWindow):
         self.input_widget.save_layout_clicked.connect(self.save_layout)
         self.input_widget.load_layout_clicked.connect(self.load_layout)
         self.input_widget.batch_import_clicked.connect(self.batch_import)
+        self.input_widget.recommend_layout_clicked.connect(self.recommend_layout)
         self.splitter.splitterMoved.connect(self.fit_stock_widget)
+        self.page_navigator.page_selected.connect(self.set_current_page)
+        self.page_navigator.add_page_clicked.connect(self.add_page)
+        self.page_navigator.remove_page_clicked.connect(self.remove_page)
+        self.page_navigator.page_moved.connect(self.move_page)
 
         menu = self.menuBar().addMenu("ファイル")
         export_image_action = QtGui.QAction("画像を出力する", self)
-        export_image_action.triggered.connect(self.save_image)
+        export_image_action.triggered.connect(lambda: self.save_image())
+        export_all_dpi_action = QtGui.QAction("全てのDPIで画像を出力する", self)
+        export_all_dpi_action.triggered.connect(self.save_image_all_dpi)
         save_layout_action = QtGui.QAction("レイアウトを保存する", self)
         save_layout_action.triggered.connect(self.save_layout)
         load_layout_action = QtGui.QAction("レイアウトを読み込む", self)
         load_layout_action.triggered.connect(self.load_layout)
+        export_book_action = QtGui.QAction("全てのページを PDF / TIFF で出力する", self)
+        export_book_action.triggered.connect(self.export_book)
+        contact_sheet_action = QtGui.QAction("フォルダーからコンタクトシートを作成する", self)
+        contact_sheet_action.triggered.connect(self.create_contact_sheet)
         bach_import_action = QtGui.QAction("指定したディレクトリーの画像を登録する", self)
         bach_import_action.triggered.connect(self.batch_import)
+        self.tile_cache_action = QtGui.QAction("出力キャッシュをディスクに保存する", self)
+        self.tile_cache_action.setCheckable(True)
+        self.tile_cache_action.setChecked(bool(TILE_CACHE.cache_dir))
+        self.tile_cache_action.toggled.connect(self.set_tile_cache_persist)
+        self.mirror_action = QtGui.QAction("画像をローカルにコピーして使う(NAS・カードリーダー向け)", self)
+        self.mirror_action.setCheckable(True)
+        self.mirror_action.toggled.connect(self.set_mirror_enabled)
         menu.addAction(export_image_action)
+        menu.addAction(export_all_dpi_action)
+        menu.addAction(export_book_action)
+        menu.addAction(contact_sheet_action)
+        menu.addAction(self.tile_cache_action)
+        menu.addAction(self.mirror_action)
         menu.addSeparator()
         menu.addAction(save_layout_action)
         menu.addAction(load_layout_action)
         menu.addSeparator()
         menu.addAction(bach_import_action)
+
+        edit_menu = self.menuBar().addMenu("編集")
+        self.undo_action = QtGui.QAction("元に戻す", self)
+        self.undo_action.setShortcut(QtGui.QKeySequence.Undo)
+        self.undo_action.triggered.connect(self.undo)
+        self.redo_action = QtGui.QAction("やり直し", self)
+        self.redo_action.setShortcuts([QtGui.QKeySequence.Redo, QtGui.QKeySequence("Ctrl+Y")])
+        self.redo_action.triggered.connect(self.redo)
+        edit_menu.addAction(self.undo_action)
+        edit_menu.addAction(self.redo_action)
+        edit_menu.addSeparator()
+        sort_stock_action = QtGui.QAction("ストックを色の近い順に並べ替える", self)
+        sort_stock_action.triggered.connect(self.sort_stock_by_similarity)
+        cluster_stock_action = QtGui.QAction("ストックを色の近さでページに分ける", self)
+        cluster_stock_action.triggered.connect(self.cluster_stock_into_pages)
+        edit_menu.addAction(sort_stock_action)
+        edit_menu.addAction(cluster_stock_action)
+        edit_menu.aboutToShow.connect(self._update_edit_menu)
+
+        view_menu = self.menuBar().addMenu("表示")
+        self.profile_action = QtGui.QAction("パフォーマンス計測", self)
+        self.profile_action.setCheckable(True)
+        self.profile_action.setChecked(PERF.enabled)
+        self.profile_action.toggled.connect(self.set_profiling_enabled)
+        perf_hud_action = QtGui.QAction("パフォーマンスHUDを表示", self)
+        perf_hud_action.setCheckable(True)
+        perf_hud_action.setChecked(PERF.hud_enabled)
+        perf_hud_action.toggled.connect(self.set_perf_hud_visible)
+        save_profile_action = QtGui.QAction("計測結果を保存する", self)
+        save_profile_action.triggered.connect(self.save_profile)
+        view_menu.addAction(self.profile_action)
+        view_menu.addAction(perf_hud_action)
+        view_menu.addAction(save_profile_action)
+        record_interaction_action = QtGui.QAction("操作を記録する", self)
+        record_interaction_action.setCheckable(True)
+        record_interaction_action.toggled.connect(self.set_interaction_recording)
+        view_menu.addSeparator()
+        view_menu.addAction(record_interaction_action)
         self.input_widget.set_context({})
 
+    def _update_edit_menu(self):
+        # type: () -> None
+        self.photo_widget.settle_history()
+        history = self.photo_widget.history
+        self.undo_action.setText("元に戻す: %s" % history.undo_label() if history.can_undo() else "元に戻す")
+        self.redo_action.setText("やり直し: %s" % history.redo_label() if history.can_redo() else "やり直し")
+
+    def _sync_tool_bar(self):
+        # type: () -> None
+        """元に戻したレイアウト名と余白をツールバーに反映する(シグナルは出さない)"""
+        widgets = (self.input_widget.layout_combo, self.input_widget.space_margin_spin,
+                   self.input_widget.top_under_margin_spin, self.input_widget.side_margin_spin)
+        for widget in widgets:
+            widget.blockSignals(True)
+        try:
+            if self.photo_widget.layout_name:
+                self.input_widget.layout_combo.setCurrentText(self.photo_widget.layout_name)
+            self.input_widget.space_margin_spin.setValue(self.photo_widget.block_space_margin_px)
+            self.input_widget.top_under_margin_spin.setValue(self.photo_widget.top_under_margin_px)
+            self.input_widget.side_margin_spin.setValue(self.photo_widget.side_margin_px)
+        finally:
+            for widget in widgets:
+                widget.blockSignals(False)
+
+    def _store_current_page(self):
+        # type: () -> None
+        if 0 <= self.book.current < len(self.book.pages):
+            self.book.store_page(self.book.current, self.input_widget.get_current_layout(),
+                                 self.photo_widget.context(), self.photo_widget.preview_sources())
+
+    def _prefetch_neighbour_pages(self):
+        # type: () -> None
+        """前後のページの画像を表示中のページより低い優先度でデコードしておく"""
+        queue = image_load_queue()
+        for order, path in enumerate(self.book.missing_previews()):
+            preview_data = self._preview_arena.preview(path) if self._preview_arena else None
+            if preview_data is not None:
+                self.book.put_preview(path, preview_data)
+            else:
+                queue.request(path, (2, order), self.book.put_preview)
+
+    def _preview(self, path):
+        # type: (str) -> PreviewData | None
+        """保持しているプレビュー(ページの先読み、前回終了時のアリーナの順に探す)"""
+        preview_data = self.book.preview(path)
+        if preview_data is None and self._preview_arena is not None:
+            preview_data = self._preview_arena.preview(path)
+        return preview_data
+
+    def _save_preview_arena(self):
+        # type: () -> None
+        """全てのページとストックで使っている画像のプレビューをアリーナに保存(変更が無ければ保存しない)"""
+        sources = self.book.preview_sources()
+        sources.update(self.stock_widget.preview_sources())
+        sources.update(self.photo_widget.preview_sources())
+        paths = [blk_data["file_path"] for blk_data in self.stock_widget.context() if blk_data.get("file_path")]
+        for page in self.book.pages:
+            paths.extend(page.image_paths())
+        previews = {}
+        for path in paths:
+            preview_data = sources.get(path)
+            if preview_data is None and self._preview_arena is not None:
+                preview_data = self._preview_arena.preview(path)
+            if preview_data is not None:
+                previews[path] = preview_data
+        arena = self._preview_arena
+        if arena is not None and set(previews) == set(arena.images) and all(
+                arena.images[path]["mtime"] == preview_data.mtime for path, preview_data in previews.items()):
+            return
+        write_arena(PREVIEW_ARENA_FILE.as_posix(), previews)
+
+    def _update_page_navigator(self):
+        # type: () -> None
+        self.page_navigator.set_pages([page.layout_name for page in self.book.pages], self.book.current)
+
+    def _mirror_images(self):
+        # type: () -> None
+        """使っている画像をローカルにコピー(表示中のページ、他のページ、ストックの順)"""
+        if self._mirror is None:
+            return
+        paths = [blk_data["file_path"] for blk_data in self.photo_widget.context() if blk_data.get("file_path")]
+        for page in self.book.pages:
+            paths.extend(page.image_paths())
+        paths.extend(blk_data["file_path"] for blk_data in self.stock_widget.context() if blk_data.get("file_path"))
+        self._mirror.mirror(paths)
+
+    def _request_pending_images(self):
+        # type: () -> None
+        """遅延していた画像の読み込みを開始(メインのビューを優先する)
+
+        続けて、レイアウトで使っている画像のフォルダーの索引をバックグラウンドで更新する。
+        """
+        # コピーを先に要求し、デコードはコピーが終わった画像からローカルで行う
+        self._mirror_images()
+        self.photo_widget.request_pending_images(0)
+        self.stock_widget.request_pending_images(1)
+        self._prefetch_neighbour_pages()
+        paths = context_image_paths({'photo_context': self.photo_widget.context(),
+                                     'stock_context': self.stock_widget.context()})
+        for folder in sorted(set(os.path.dirname(path) for path in paths)):
+            if os.path.isdir(folder):
+                self._index_scanner.scan(folder, recursive=False)
+
+    def _on_first_frame(self):
+        # type: () -> None
+        self._record_startup("startup_first_frame")
+
+    def _on_images_loaded(self):
+        # type: () -> None
+        self._record_startup("startup_images_loaded")
+        self.photo_widget.images_loaded.disconnect(self._on_images_loaded)
+
+    def _record_startup(self, name):
+        # type: (str) -> None
+        """起動からの経過時間を記録(PHOTOBOOK_STARTUP_TRACE=1 の場合は標準出力にも表示)"""
+        duration_ns = time.perf_counter_ns() - STARTUP_NS
+        PERF.record(name, STARTUP_NS, duration_ns)
+        if os.environ.get(STARTUP_TRACE_ENV):
+            print("%s: %.1f ms" % (name, duration_ns / 1e6))
+
     # =================================
     # Override
     # =================================
@@ -211,7 +807,16 @@ class PhotoBookApp(QtWidgets.QMainWindow):
         self.stock_widget.fit_horizontal_window_size()
 
     def closeEvent(self, event):
+        self.export_prefetcher.stop()
+        for worker in list(self._export_workers):
+            worker.wait()
+        self._index_scanner.cancel()
+        self._index_scanner.wait()
+        self.photo_index.close()
+        if self._mirror is not None:
+            self._mirror.shutdown(wait=False)
         self.save_layout(True)
+        self._save_preview_arena()
         return super().closeEvent(event)
 
     def showEvent(self, event):
@@ -226,6 +831,9 @@ class PhotoBookApp(QtWidgets.QMainWindow):
             self.photo_widget.fit_window_size()
             self.stock_widget.fit_window_size()
             self.stock_widget.fit_horizontal_window_size()
+            self._first_show = False
+            # 最初のフレームを描画してから、表示中のブロックの画像から読み込む
+            QtCore.QTimer.singleShot(0, self._request_pending_images)
         return result
 
 if __name__ == "__main__":
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+低速なストレージ(NAS, カードリーダーなど)の画像のローカルコピー
+
+レイアウトで使っている元画像をバックグラウンドでキャッシュフォルダーにまとめてコピーし、
+imageIO.set_path_resolver に resolve を登録すると、以降のデコードはローカルのコピーから行う。
+
+コピーは大きな単位の連続読み込みで行い、同時にコピーする数は max_workers までにする。
+コピーは元画像のサイズと更新日時を記録しておき、mirror を呼ぶたびに元画像と比べて、
+変更されていればコピーし直す。resolve は元画像にアクセスしないので、
+マウントが応答しなくなってもコピー済みの画像は表示・出力できる。
+
+throttle_bytes_per_sec / throttle_latency を指定すると、元画像の読み込みを遅くできる
+(ローカルのフォルダーを低速なストレージの代わりにして確認する場合に使う)。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError
+from .perfMonitor import PERF
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+"""元画像を読み込む単位(大きな連続読み込みにする)"""
+DEFAULT_MIRROR_WORKERS = 2
+DEFAULT_RESOLVE_TIMEOUT = 5.0
+"""resolve がコピー中の画像を待つ最大秒数(過ぎたら元画像のパスを返す)"""
+MANIFEST_NAME = "manifest.json"
+MIRROR_VERSION = 1
+MIRROR_THROTTLE_ENV = "PHOTOBOOK_MIRROR_THROTTLE"
+""""バイト/秒[,待ち時間(秒)]" を指定すると元画像の読み込みを遅くする(確認用)"""
+
+
+def mirror_name(path):
+    # type: (str) -> str
+    """元画像のパスからキャッシュフォルダー内のファイル名を作成(拡張子は残す)"""
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+    return digest[:2] + "/" + digest + os.path.splitext(path)[1].lower()
+
+
+def throttle_from_env():
+    # type: () -> tuple[int | None, float]
+    """MIRROR_THROTTLE_ENV から (throttle_bytes_per_sec, throttle_latency) を取得"""
+    value = os.environ.get(MIRROR_THROTTLE_ENV, "")
+    if not value:
+        return None, 0.0
+    parts = value.split(",")
+    latency = float(parts[1]) if len(parts) > 1 else 0.0
+    return int(float(parts[0])) or None, latency
+
+
+class MirrorCache:
+    """元画像のローカルコピーを管理する"""
+
+    def __init__(self, cache_dir, max_workers=DEFAULT_MIRROR_WORKERS, throttle_bytes_per_sec=None,
+                 throttle_latency=0.0, resolve_timeout=DEFAULT_RESOLVE_TIMEOUT):
+        # type: (str, int, int, float, float) -> None
+        self.cache_dir = str(cache_dir)
+        self.throttle_bytes_per_sec = throttle_bytes_per_sec
+        """元画像の読み込み速度の上限(None の場合は制限しない)"""
+        self.throttle_latency = throttle_latency
+        """元画像へのアクセス1回ごとの待ち時間(秒)"""
+        self.resolve_timeout = resolve_timeout
+        """resolve がコピー中の画像を待つ最大秒数"""
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mirror")
+        self._lock = threading.Lock()
+        self._entries = {}  # type: dict[str, tuple[int, int, str]]
+        """元画像のパス -> (サイズ, 更新日時(ns), キャッシュ内のファイル名)"""
+        self._futures = {}  # type: dict[str, Future]
+        self._manifest_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_manifest()
+
+    # =================================
+    # Public
+    # =================================
+    def resolve(self, path):
+        # type: (str) -> str
+        """デコードに使うパス(コピー済みならローカルのコピー、無ければ元のパス)
+
+        GUIスレッド以外から呼ばれた場合、コピー中の画像はコピーが終わるまで resolve_timeout 秒まで待つ。
+        マウントが応答せずコピーが終わらない場合も、デコードのワーカーが止まり続けることはない。
+        """
+        if not path:
+            return path
+        key = os.path.abspath(path)
+        with self._lock:
+            future = self._futures.get(key)
+        if future is not None and threading.current_thread() is not threading.main_thread():
+            try:
+                future.exception(self.resolve_timeout)
+            except TimeoutError:
+                PERF.count("mirror_wait_timeout")
+            except CancelledError:
+                pass
+        local_path = self.local_path(key)
+        if local_path:
+            PERF.count("mirror_hit")
+            return local_path
+        PERF.count("mirror_miss")
+        return path
+
+    def local_path(self, path):
+        # type: (str) -> str | None
+        """コピー済みで、コピーが記録と一致している場合はそのパス"""
+        with self._lock:
+            entry = self._entries.get(os.path.abspath(path))
+        if entry is None:
+            return None
+        size, mtime_ns, name = entry
+        local_path = os.path.join(self.cache_dir, name)
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return None
+        if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+            return None
+        return local_path
+
+    def mirror(self, paths):
+        # type: (list[str]) -> int
+        """画像をバックグラウンドでコピー(コピー済みの場合は元画像が変わっていないかを確認)
+
+        渡した順にコピーするので、先に表示する画像を前にする。要求した件数を返す。
+        """
+        count = 0
+        for path in paths:
+            if not path:
+                continue
+            key = os.path.abspath(path)
+            with self._lock:
+                if key in self._futures:
+                    continue
+                future = self._executor.submit(self._copy, key)
+                self._futures[key] = future
+            future.add_done_callback(lambda _, key=key: self._on_copied(key))
+            count += 1
+        return count
+
+    def pending_count(self):
+        # type: () -> int
+        with self._lock:
+            return len(self._futures)
+
+    def wait(self, timeout=None):
+        # type: (float) -> bool
+        """要求済みのコピーが全て終わるまで待つ(タイムアウトした場合は False)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                futures = list(self._futures.values())
+            if not futures:
+                return True
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                futures[0].exception(remaining)
+            except TimeoutError:
+                return False
+            except CancelledError:
+                pass
+
+    def nbytes(self):
+        # type: () -> int
+        with self._lock:
+            return sum(entry[0] for entry in self._entries.values())
+
+    def shutdown(self, wait=True):
+        # type: (bool) -> None
+        """待ち中のコピーを取り消す(wait が True の場合はコピー中のものが終わるのを待つ)"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        self._save_manifest()
+
+    # =================================
+    # Copy
+    # =================================
+    def _source_access(self):
+        # type: () -> None
+        if self.throttle_latency:
+            time.sleep(self.throttle_latency)
+
+    def _copy(self, path):
+        # type: (str) -> str | None
+        try:
+            self._source_access()
+            stat = os.stat(path)
+        except OSError:
+            # マウントが外れている場合などは、コピー済みのものをそのまま使う
+            PERF.count("mirror_source_error")
+            return self.local_path(path)
+        name = mirror_name(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry == (stat.st_size, stat.st_mtime_ns, name) and self.local_path(path):
+            return self.local_path(path)
+
+        # 元画像が変わっている場合は、コピーし終わるまで古いコピーを使わない
+        with self._lock:
+            self._entries.pop(path, None)
+        local_path = os.path.join(self.cache_dir, name)
+        tmp_path = local_path + ".tmp"
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        try:
+            with PERF.measure("mirror_copy", path=os.path.basename(path)):
+                self._copy_file(path, tmp_path)
+            self._source_access()
+            after = os.stat(path)
+            if (after.st_size, after.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                # コピー中に書き換えられた場合は使わない(次の mirror でコピーし直す)
+                os.remove(tmp_path)
+                return None
+            os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(tmp_path, local_path)
+        except OSError:
+            PERF.count("mirror_source_error")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        with self._lock:
+            self._entries[path] = (stat.st_size, stat.st_mtime_ns, name)
+        PERF.count("mirror_copy_bytes", stat.st_size)
+        return local_path
+
+    def _copy_file(self, src_path, dst_path):
+        # type: (str, str) -> None
+        self._source_access()
+        start = time.perf_counter()
+        copied = 0
+        with open(src_path, "rb", buffering=0) as src, open(dst_path, "wb") as dst:
+            while True:
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                copied += len(chunk)
+                if self.throttle_bytes_per_sec:
+                    delay = copied / float(self.throttle_bytes_per_sec) - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+
+    def _on_copied(self, path):
+        # type: (str) -> None
+        with self._lock:
+            self._futures.pop(path, None)
+            idle = not self._futures
+        if idle:
+            self._save_manifest()
+
+    # =================================
+    # Manifest
+    # =================================
+    def _manifest_path(self):
+        # type: () -> str
+        return os.path.join(self.cache_dir, MANIFEST_NAME)
+
+    def _load_manifest(self):
+        # type: () -> None
+        try:
+            with open(self._manifest_path(), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") != MIRROR_VERSION:
+            return
+        self._entries = {path: tuple(entry) for path, entry in manifest.get("entries", {}).items()}
+
+    def _save_manifest(self):
+        # type: () -> None
+        with self._lock:
+            manifest = {"version": MIRROR_VERSION, "entries": dict(self._entries)}
+        tmp_path = self._manifest_path() + ".tmp"
+        with self._manifest_lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(tmp_path, self._manifest_path())
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2024, YAMAGUCHI Yasushi
+"""
+from PySide6 import QtWidgets, QtCore
+
+
+class PageNavigatorWidget(QtWidgets.QWidget):
+    """フォトブックのページ一覧"""
+    page_selected = QtCore.Signal(int)
+    add_page_clicked = QtCore.Signal()
+    remove_page_clicked = QtCore.Signal()
+    page_moved = QtCore.Signal(int, int)
+
+    def __init__(self):
+        super().__init__()
+        self.page_list = QtWidgets.QListWidget()
+        self.page_list.setFlow(QtWidgets.QListView.LeftToRight)
+        self.page_list.setWrapping(False)
+        self.page_list.setFixedHeight(34)
+        self.page_list.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAsNeeded)
+        self.page_list.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.page_list.setDragDropMode(QtWidgets.QAbstractItemView.InternalMove)
+        self.add_page_btn = QtWidgets.QPushButton("ページ追加")
+        self.remove_page_btn = QtWidgets.QPushButton("ページ削除")
+
+        h_layout = QtWidgets.QHBoxLayout(self)
+        h_layout.setContentsMargins(10, 2, 10, 2)
+        h_layout.setSpacing(3)
+        h_layout.addWidget(QtWidgets.QLabel("ページ:"))
+        h_layout.addWidget(self.page_list, 1)
+        h_layout.addWidget(self.add_page_btn)
+        h_layout.addWidget(self.remove_page_btn)
+
+        self.page_list.currentRowChanged.connect(self._current_row_changed)
+        self.page_list.model().rowsMoved.connect(self._rows_moved)
+        self.add_page_btn.clicked.connect(self.add_page_clicked)
+        self.remove_page_btn.clicked.connect(self.remove_page_clicked)
+
+    def set_pages(self, labels, current):
+        # type: (list[str], int) -> None
+        """ページ一覧を更新する(シグナルは出さない)
+        """
+        self.page_list.blockSignals(True)
+        self.page_list.clear()
+        for index, label in enumerate(labels):
+            self.page_list.addItem("%d: %s" % (index + 1, label))
+        self.page_list.setCurrentRow(current)
+        self.page_list.blockSignals(False)
+        self.remove_page_btn.setEnabled(len(labels) > 1)
+
+    def _current_row_changed(self, row):
+        # type: (int) -> None
+        if row >= 0:
+            self.page_selected.emit(row)
+
+    def _rows_moved(self, parent, start, end, destination, row):
+        # type: (QtCore.QModelIndex, int, int, QtCore.QModelIndex, int) -> None
+        """ドラッグでの並べ替えを通知する(row は移動前の並びでの挿入位置)
+        """
+        self.page_moved.emit(start, row - 1 if row > start else row)
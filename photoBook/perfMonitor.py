@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+パフォーマンス計測
+
+環境変数 PHOTOBOOK_PROFILE=1 で起動時から計測を有効にする(メニューからも切り替え可能)。
+無効時は measure() が共有の何もしないコンテキストを返すだけなので常に仕込んでおける。
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+PROFILE_ENV = "PHOTOBOOK_PROFILE"
+PROFILE_HUD_ENV = "PHOTOBOOK_PROFILE_HUD"
+MAX_TRACE_EVENTS = 200000
+FRAME_HISTORY = 120
+
+
+class _NullTimer:
+    """計測無効時に使う何もしないタイマー"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    """with 文で囲んだ区間の時間を記録する"""
+    __slots__ = ("_monitor", "_name", "_args", "_start")
+
+    def __init__(self, monitor, name, args):
+        self._monitor = monitor
+        self._name = name
+        self._args = args
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        self._monitor.record(self._name, self._start, end - self._start, self._args)
+        return False
+
+
+class PerfMonitor:
+    """呼び出しごとの時間とカウンターを集計する"""
+
+    def __init__(self, enabled=False, hud_enabled=False):
+        # type: (bool, bool) -> None
+        self.enabled = enabled
+        """計測を行うかどうか"""
+        self.hud_enabled = hud_enabled
+        """PhotoCollageView 上にHUDを表示するかどうか"""
+        self._lock = threading.Lock()
+        self._origin_ns = time.perf_counter_ns()
+        self.reset()
+
+    def reset(self):
+        # type: () -> None
+        """計測結果をクリア"""
+        with self._lock:
+            self.stats = {}  # type: dict[str, list]
+            """名前ごとの [回数, 合計ns, 最大ns]"""
+            self.counters = collections.Counter()
+            """キャッシュヒット数などのカウンター"""
+            self.gauges = {}  # type: dict[str, float]
+            """保持バイト数などの現在値"""
+            self.item_paint_ms = {}  # type: dict[str, float]
+            """アイテムごとの直近の描画時間(ms)"""
+            self.frame_ms = collections.deque(maxlen=FRAME_HISTORY)
+            """直近のフレーム時間(ms)"""
+            self.events = collections.deque(maxlen=MAX_TRACE_EVENTS)
+
+    def measure(self, name, **args):
+        # type: (str, ...) -> _Timer | _NullTimer
+        """with 文で区間の時間を計測する"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, args)
+
+    def record(self, name, start_ns, duration_ns, args=None):
+        # type: (str, int, int, dict) -> None
+        """計測結果を記録"""
+        with self._lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0, 0]
+            stat[0] += 1
+            stat[1] += duration_ns
+            stat[2] = max(stat[2], duration_ns)
+            self.events.append((name, start_ns, duration_ns, threading.get_ident(), args or None))
+
+    def count(self, name, value=1):
+        # type: (str, int) -> None
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+
+    def gauge(self, name, value):
+        # type: (str, float) -> None
+        if self.enabled:
+            self.gauges[name] = value
+
+    def record_item_paint(self, label, start_ns, duration_ns):
+        # type: (str, int, int) -> None
+        """アイテム単位の描画時間を記録"""
+        self.record("paint", start_ns, duration_ns, {"item": label})
+        self.item_paint_ms[label] = duration_ns / 1e6
+
+    def record_frame(self, duration_ms):
+        # type: (float) -> None
+        if self.enabled:
+            self.frame_ms.append(duration_ms)
+
+    def slowest_items(self, count=5):
+        # type: (int) -> list[tuple[str, float]]
+        """描画の遅いアイテムを取得"""
+        items = sorted(self.item_paint_ms.items(), key=lambda x: x[1], reverse=True)
+        return items[:count]
+
+    def hud_lines(self):
+        # type: () -> list[str]
+        """HUDに表示する文字列"""
+        lines = []
+        if self.frame_ms:
+            average = sum(self.frame_ms) / len(self.frame_ms)
+            lines.append("frame: %.1f ms (avg %.1f ms)" % (self.frame_ms[-1], average))
+        for label, duration_ms in self.slowest_items():
+            lines.append("paint %s: %.1f ms" % (label, duration_ms))
+        for name in sorted(self.counters):
+            lines.append("%s: %d" % (name, self.counters[name]))
+        for name in sorted(self.gauges):
+            lines.append("%s: %s" % (name, format_bytes(self.gauges[name]) if name.endswith("bytes")
+                                     else self.gauges[name]))
+        return lines
+
+    def summary(self):
+        # type: () -> dict
+        """集計結果を辞書で取得"""
+        with self._lock:
+            timings = {}
+            for name, (count, total_ns, max_ns) in sorted(self.stats.items()):
+                timings[name] = {
+                    "count": count,
+                    "total_ms": total_ns / 1e6,
+                    "mean_ms": total_ns / 1e6 / count,
+                    "max_ms": max_ns / 1e6,
+                }
+            return {
+                "timings": timings,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "slowest_items": self.slowest_items(20),
+            }
+
+    def dump_json(self, path):
+        # type: (str) -> None
+        """集計結果をJSONで保存"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=4, ensure_ascii=False)
+
+    def dump_chrome_trace(self, path):
+        # type: (str) -> None
+        """chrome://tracing / Perfetto で開けるトレースを保存"""
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        trace_events = []
+        for name, start_ns, duration_ns, tid, args in events:
+            event = {
+                "name": name, "cat": "photobook", "ph": "X", "pid": pid, "tid": tid,
+                "ts": (start_ns - self._origin_ns) / 1000.0, "dur": duration_ns / 1000.0,
+            }
+            if args:
+                event["args"] = args
+            trace_events.append(event)
+        end_ts = (time.perf_counter_ns() - self._origin_ns) / 1000.0
+        for name, value in list(counters.items()) + list(gauges.items()):
+            trace_events.append({"name": name, "ph": "C", "pid": pid, "tid": 0, "ts": end_ts,
+                                 "args": {"value": value}})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+
+def format_bytes(value):
+    # type: (float) -> str
+    for unit in ("B", "KB", "MB"):
+        if abs(value) < 1024.0:
+            return "%.1f %s" % (value, unit)
+        value /= 1024.0
+    return "%.1f GB" % value
+
+
+def _env_flag(name):
+    # type: (str) -> bool
+    return os.environ.get(name, "") not in ("", "0", "false", "False")
+
+
+PERF = PerfMonitor(_env_flag(PROFILE_ENV), _env_flag(PROFILE_HUD_ENV))
+
+
+def timed(name):
+    # type: (str) -> callable
+    """関数の呼び出し時間を記録するデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PERF.enabled:
+                return func(*args, **kwargs)
+            with PERF.measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -4,14 +4,19 @@ PhotoCollage - QGraphicsView完全再現版
 """
 import copy
 from PySide6 import QtWidgets, QtGui, QtCore
-from PIL import Image
-from pillow_heif import register_heif_opener
-register_heif_opener()
 import os
 import random
 import math
+import time
 from .define import *
-PREVIEW_MAX_SIZE = 512.0
+from .imageIO import (
+    decode_preview, image_aspect, orientation_transform, pil_image, quarter_turns, resolve_path, transpose_image)
+from .exportRenderer import BlockSnapshot, ExportSnapshot, render_export
+from .imageLoadQueue import image_load_queue
+from .tileCache import TILE_CACHE
+from .qtImageBuffer import QImageBuffer
+from .editHistory import EditHistory, changed_indexes
+from .perfMonitor import PERF, timed
 PREVIEW_CANVAS_WIDTH = 1900
 DRAG_ITEM = None
 
@@ -25,7 +30,8 @@ class PhotoInfo:
         self.rect_ratio = (0.0, 0.0, 1.0, 1.0)
         self.image_path = None  # type: str
         self.preview_img = None  # type: Image.ImageFile
-        self.full_img = None  # type: Image.ImageFile
+        self.preview_data = None  # type: PreviewData
+        """プレビューのピラミッドなどを保持するデータ"""
         self.color = (255, random.randint(180, 210), random.randint(180, 210))
         self.offset_x = 0
         self.offset_y = 0
@@ -47,22 +53,70 @@ class PhotoInfo:
             self.offset_x, self.offset_y, self.scale = 0, 0, 1.0
         self._current_layout = layout_name
 
+    @timed("update_image")
     def update_image(self):
-        if not self.image_path or not os.path.isfile(self.image_path):
+        if not self.image_path or not os.path.isfile(resolve_path(self.image_path)):
+            self.clear_image(keep_path=True)
+            return
+        self.set_preview(decode_preview(self.image_path))
+
+    def set_preview(self, preview_data):
+        # type: (PreviewData) -> None
+        """デコード済みのプレビューをセット(元画像は出力時に開く)
+        """
+        self.preview_data = preview_data
+        if preview_data is None:
             self.preview_img = None
-            self.full_img = None
             return
-        image = Image.open(self.image_path)
-        self.full_img = image
-        if image.width > image.height:
-            new_width = PREVIEW_MAX_SIZE
-            new_height = (PREVIEW_MAX_SIZE / image.width) * image.height
-            self.rot_90_scale = float(new_width) / float(new_height)
-        else:
-            new_height = PREVIEW_MAX_SIZE
-            new_width = (PREVIEW_MAX_SIZE / image.height) * image.width
-            self.rot_90_scale = float(new_height) / float(new_width)
-        self.preview_img = image.resize((int(new_width), int(new_height)), Image.BICUBIC)
+        self.preview_img = preview_data.preview
+        self.rot_90_scale = preview_data.rot_90_scale
+
+    def preview_for_size(self, width, height):
+        # type: (float, float) -> Image.Image
+        """描画サイズに合ったプレビュー画像を取得"""
+        if self.preview_data and self.preview_data.preview is self.preview_img:
+            return self.preview_data.level_for(width, height, self.scale)
+        return self.preview_img
+
+    def rotated_image(self, image):
+        # type: (Image.Image) -> Image.Image
+        """描画する画像を rotation だけ回転した画像(90度単位でない場合は回転しない)
+
+        プレビューのレベルは PreviewData に保持した転置済みの画像を使う。
+        """
+        if self.preview_data is not None:
+            return self.preview_data.rotated(image, self.rotation)
+        return transpose_image(image, orientation_transform(1, self.rotation))
+
+    def clear_image(self, keep_path=False):
+        # type: (bool) -> None
+        """画像をクリア"""
+        if not keep_path:
+            self.image_path = None
+        self.preview_img = None
+        self.preview_data = None
+
+    def image_state(self):
+        # type: () -> tuple
+        """画像と配置の状態を取得(set_image_state で戻せる)"""
+        return (self.image_path, self.preview_img, self.preview_data, self.rot_90_scale,
+                self.offset_x, self.offset_y, self.scale, self.rotation)
+
+    def set_image_state(self, state):
+        # type: (tuple) -> None
+        (self.image_path, self.preview_img, self.preview_data, self.rot_90_scale,
+         self.offset_x, self.offset_y, self.scale, self.rotation) = state
+
+    def history_state(self):
+        # type: () -> tuple
+        """元に戻す用の状態(image_state に矩形とレイアウト名を加えたもの)"""
+        return self.image_state() + (self.init_rect_ratio, self._current_layout)
+
+    def set_history_state(self, state):
+        # type: (tuple) -> None
+        self.set_image_state(state[:-2])
+        self.init_rect_ratio, self._current_layout = state[-2:]
+        self.rect_ratio = self.init_rect_ratio
 
     def switch_status(self, item):
         # type: (PhotoInfo) -> None
@@ -70,7 +124,8 @@ class PhotoInfo:
         """
         self.image_path, item.image_path = item.image_path, self.image_path
         self.preview_img, item.preview_img = item.preview_img, self.preview_img
-        self.full_img, item.full_img = item.full_img, self.full_img
+        self.preview_data, item.preview_data = item.preview_data, self.preview_data
+        self.rot_90_scale, item.rot_90_scale = item.rot_90_scale, self.rot_90_scale
         self.offset_x, item.offset_x = item.offset_x, self.offset_x
         self.offset_y, item.offset_y = item.offset_y, self.offset_y
         self.scale, item.scale = item.scale, self.scale
@@ -91,6 +146,7 @@ class PhotoBlockItem(QtWidgets.QGraphicsItem):
         self._is_selected = False
         self._is_drop_target = False
         self._dpi = None
+        self._image_buffer = QImageBuffer()
         self.update_from_block(scene_rect)
         self.setup_gui()
 
@@ -107,11 +163,7 @@ class PhotoBlockItem(QtWidgets.QGraphicsItem):
         # type: (str) -> None
         """ブロック情報から矩形を更新
         """
-        x = scene_rect.width() * self._block.rect_ratio[0]
-        y = scene_rect.height() * self._block.rect_ratio[1]
-        w = scene_rect.width() * self._block.rect_ratio[2]
-        h = scene_rect.height() * self._block.rect_ratio[3]
-        self.rect = QtCore.QRectF(x, y, w, h)
+        self.rect = block_scene_rect(self._block, scene_rect)
         self.prepareGeometryChange()
 
     # ==========================
@@ -121,24 +173,43 @@ class PhotoBlockItem(QtWidgets.QGraphicsItem):
         return self.rect
 
     def paint(self, painter, option, widget=None):
+        if not PERF.enabled:
+            return self._paint(painter)
+        start = time.perf_counter_ns()
+        self._paint(painter)
+        label = os.path.basename(self._block.image_path) if self._block.image_path else "(empty)"
+        PERF.record_item_paint(label, start, time.perf_counter_ns() - start)
+
+    def _paint(self, painter):
+        # type: (QtGui.QPainter) -> None
+        """セルの描画"""
         painter.save()
         painter.fillRect(self.rect, QtGui.QColor(200, 200, 200))
         painter.setClipRect(self.rect)
 
-        render_image = self._block.preview_img
-        if self._parent_view.export_flag:
-            render_image = self._block.full_img
+        # 表示倍率(ビューの拡大率)に合わせた解像度で縮小し、描画時に倍率を戻す
+        transform = painter.worldTransform()
+        device_scale = max(math.hypot(transform.m11(), transform.m12()), 1e-3)
+        render_image = self._block.preview_for_size(self.rect.width() * device_scale,
+                                                    self.rect.height() * device_scale)
 
         if render_image:
-            img = render_image.convert("RGBA")
-            iw, ih = img.size
+            # 90度単位の回転は転置済みの画像を縮小して描画する(QPainter では回転しない)
+            render_image = self._block.rotated_image(render_image)
+            quarters = quarter_turns(self._block.rotation)
+            quarter_turn = quarters is not None
+            swapped = quarter_turn and quarters % 2 == 1
+            iw, ih = render_image.size
+            if swapped:
+                # 倍率は回転前のサイズで計算する(exportRenderer.render_block と同じ)
+                iw, ih = ih, iw
 
             # スケール倍率を計算
             ratio = max(self.rect.width() / iw, self.rect.height() / ih) * self._block.scale + 0.005
 
-            scaled_size = (int(iw * ratio), int(ih * ratio))
-            img = img.resize(scaled_size, Image.BICUBIC)
-
+            scaled_size = (int(iw * ratio * device_scale), int(ih * ratio * device_scale))
+            if swapped:
+                scaled_size = scaled_size[::-1]
             # Image.NEAREST (最近傍補間)
             # Image.BOX (エリア補間)
             # Image.BILINEAR (双線形補間)
@@ -149,24 +220,29 @@ class PhotoBlockItem(QtWidgets.QGraphicsItem):
             # 高速性重視: NEAREST または BILINEAR
             # 品質重視: BICUBIC または LANCZOS
             # 縮小時のエイリアシング抑制: AREA
-
-            # 回転（アスペクト比維持、中心基準）
-            img = img.rotate(-self._block.rotation, expand=True, resample=Image.BICUBIC)
-
-            # Pillow → QPixmap 変換
-            qimg = QtGui.QImage(img.tobytes("raw", "RGBA"), img.width, img.height, QtGui.QImage.Format_RGBA8888)
-            pix = QtGui.QPixmap.fromImage(qimg)
+            with PERF.measure("resample"):
+                # 縮小した画素を QImage から直接参照する(同じ画像とサイズなら縮小もしない)
+                qimg = self._image_buffer.image(render_image, scaled_size, pil_image().BICUBIC)
 
             # 中心配置 + offset
-            cx = round(self.rect.center().x() - pix.width() / 2 + self._block.offset_x * self._parent_view.canvas_width)
-            cy = round(self.rect.center().y() - pix.height() / 2 + self._block.offset_y * self._parent_view.canvas_height)
-            painter.drawPixmap(QtCore.QPointF(cx, cy), pix)
-        else:
-            # 画像を保存する場合は、BGカラーで塗りつぶす
-            if self._parent_view.export_flag:
-                painter.fillRect(self.rect, self._parent_view.bg_color)
+            cx = self.rect.center().x() + self._block.offset_x * self._parent_view.canvas_width
+            cy = self.rect.center().y() + self._block.offset_y * self._parent_view.canvas_height
+            width, height = qimg.width() / device_scale, qimg.height() / device_scale
+            if quarter_turn:
+                # デバイス座標の画素に揃えて、拡大縮小なしで転送する
+                left = round((cx - width / 2.0) * device_scale) / device_scale
+                top = round((cy - height / 2.0) * device_scale) / device_scale
+                painter.drawImage(QtCore.QRectF(left, top, width, height), qimg)
             else:
-                painter.fillRect(self.rect, QtGui.QColor(*self._block.color))
+                # 任意角の回転は Pillow ではなく QPainter で行う(回転で増える透明な角のためのアルファが不要になる)
+                painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, True)
+                painter.save()
+                painter.translate(cx, cy)
+                painter.rotate(self._block.rotation)
+                painter.drawImage(QtCore.QRectF(-width / 2.0, -height / 2.0, width, height), qimg)
+                painter.restore()
+        else:
+            painter.fillRect(self.rect, QtGui.QColor(*self._block.color))
 
         # =============================
         # 選択していた場合の枠線の描画
@@ -194,6 +270,7 @@ class PhotoBlockItem(QtWidgets.QGraphicsItem):
             self._ctrl_drag = bool(event.modifiers() & QtCore.Qt.ControlModifier)
             self._last_mouse_pos = event.scenePos()
             if self._ctrl_drag:
+                self._parent_view.begin_edit("画像の移動")
                 self.scene().clearSelection()
             else:
                 DRAG_ITEM = self
@@ -215,11 +292,9 @@ class PhotoBlockItem(QtWidgets.QGraphicsItem):
             self.update()
         else:
             # 通常ドラッグ → D&D入れ替え
-            drag = QtGui.QDrag(self._parent_view)
             mime = QtCore.QMimeData()
             mime.setText(self._block.image_path or "")
-            drag.setMimeData(mime)
-            drag.exec(QtCore.Qt.MoveAction)
+            self._parent_view.exec_block_drag(mime)
         super().mouseMoveEvent(event)
 
     def mouseReleaseEvent(self, event):
@@ -239,6 +314,7 @@ class PhotoBlockItem(QtWidgets.QGraphicsItem):
                 delta = event.delta()
             elif hasattr(event, "angleDelta"):  # 念のためPyQt互換
                 delta = event.angleDelta().y()
+            self._parent_view.begin_edit("画像の拡大縮小", merge_key=("scale", id(self._block)))
             if delta > 0:
                 self._block.scale *= 1.05
             else:
@@ -284,6 +360,9 @@ class PhotoBlockItem(QtWidgets.QGraphicsItem):
             #         break
             item = DRAG_ITEM
             if item and isinstance(item, PhotoBlockItem) and item._block.image_path == src_path:
+                self._parent_view.begin_edit("画像の入れ替え")
+                if item._parent_view is not self._parent_view:
+                    item._parent_view.begin_edit("画像の入れ替え")
                 self._block.switch_status(item._block)
                 self.update()
                 item.update()
@@ -295,7 +374,63 @@ class PhotoBlockItem(QtWidgets.QGraphicsItem):
         self.update()
 
 
+class BatchedBlocksItem(QtWidgets.QGraphicsItem):
+    """画像の無いセルをまとめて描画するアイテム
+
+    ブロック数の多いレイアウトで PhotoBlockItem を全セル分作らないために使う。
+    セルは QPicture に一度だけ記録し、クリックやドロップで操作されたセルだけ PhotoBlockItem を上に重ねる。
+    """
+    def __init__(self, blocks, scene_rect, parent_view):
+        # type: (list[PhotoInfo], QtCore.QRectF, PhotoCollageView) -> None
+        super().__init__()
+        self._parent_view = parent_view  # type: PhotoCollageView
+        self.rect = QtCore.QRectF(scene_rect)
+        self._picture = QtGui.QPicture()
+        painter = QtGui.QPainter(self._picture)
+        for blk in blocks:
+            painter.fillRect(block_scene_rect(blk, scene_rect), QtGui.QColor(*blk.color))
+        painter.end()
+        # 位置引き用にセルをグリッドのバケットに分ける
+        self._bucket_count = max(1, int(math.sqrt(len(blocks))))
+        self._buckets = {}  # type: dict[tuple[int, int], list[PhotoInfo]]
+        for blk in blocks:
+            x, y, w, h = blk.rect_ratio
+            for col in range(self._bucket_index(x), self._bucket_index(x + w) + 1):
+                for row in range(self._bucket_index(y), self._bucket_index(y + h) + 1):
+                    self._buckets.setdefault((col, row), []).append(blk)
+        self.setCacheMode(QtWidgets.QGraphicsItem.DeviceCoordinateCache)
+
+    def _bucket_index(self, ratio):
+        # type: (float) -> int
+        return min(self._bucket_count - 1, max(0, int(ratio * self._bucket_count)))
+
+    def block_at(self, scene_pos):
+        # type: (QtCore.QPointF) -> PhotoInfo | None
+        """シーン座標にあるセルのブロックを取得"""
+        if not self.rect.contains(scene_pos):
+            return None
+        rx = (scene_pos.x() - self.rect.x()) / self.rect.width()
+        ry = (scene_pos.y() - self.rect.y()) / self.rect.height()
+        for blk in self._buckets.get((self._bucket_index(rx), self._bucket_index(ry)), []):
+            x, y, w, h = blk.rect_ratio
+            if x <= rx < x + w and y <= ry < y + h:
+                return blk
+        return None
+
+    def boundingRect(self):
+        return self.rect
+
+    def paint(self, painter, option, widget=None):
+        painter.drawPicture(0, 0, self._picture)
+
+
 class PhotoCollageView(QtWidgets.QGraphicsView):
+    first_painted = QtCore.Signal()
+    """最初のフレームを描画した"""
+    images_loaded = QtCore.Signal()
+    """遅延読み込みしていた画像が全て揃った"""
+    history_restored = QtCore.Signal()
+    """元に戻す/やり直しでレイアウト名や余白が変わった"""
 
     def __init__(self):
         super().__init__()
@@ -305,12 +440,31 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         """使用中のブロック数"""
         self._photo_block_items = []  # type: list[PhotoBlockItem]
         """現在保持しているPhotoBlockItemリスト"""
+        self._block_items = {}  # type: dict[int, PhotoBlockItem]
+        """id(PhotoInfo) から PhotoBlockItem を引く辞書"""
+        self._batched_item = None  # type: BatchedBlocksItem | None
+        """ブロック数が多い場合に空のセルをまとめて描画するアイテム"""
+        self._drag_items = []  # type: list[PhotoBlockItem]
+        """ドラッグ中にドロップ先として作った PhotoBlockItem(画像が入らなければまとめた描画に戻す)"""
+        self._scene_rect = QtCore.QRectF()
+        self.batch_render_threshold = BATCH_RENDER_THRESHOLD
+        """ブロック数がこれを超えると空のセルをまとめて描画する"""
+        self.photo_index = None  # type: PhotoIndex | None
+        """撮影日時などの並べ替えに使う写真の索引"""
+        self.layout_name = None  # type: str | None
+        """set_block_layout で読み込んだレイアウト名"""
+        self.history = EditHistory()
+        """元に戻す/やり直しの履歴"""
+        self._pending_blocks = []  # type: list[PhotoInfo]
+        """画像パスだけ復元し、まだデコードしていないブロック"""
+        self._loading_count = 0
+        self._load_generation = 0
+        """clear_blocks のたびに増やし、破棄したブロックのデコード結果を捨てるための番号"""
+        self._painted = False
         self.bg_color = QtGui.QColor("white")
         """背景色"""
         self.dpi = 20  # type: int
         """出力解像度(DPI)"""
-        self.export_flag = False
-        """Export時に高解像度画像を使用するかどうかのフラグ"""
         self.canvas_margin_width = 20000
         self.canvas_margin_height = 20000
         """パンしやすいようにするメインのキャンバスの周りの余白"""
@@ -364,23 +518,77 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         else:
             blk = PhotoInfo()
             self.blocks.append(blk)
+        self.begin_edit("画像の読み込み", merge_key="set_image_to_block")
         blk.image_path = image_path
         blk.update_image()
 
-    def draw_layout(self, export_flag=False, fit_window=True):
-        # type: (bool, bool) -> None
+    def free_slots(self, start=0):
+        # type: (int) -> list[PhotoInfo]
+        """start 以降の画像が無いブロックを順番に取得"""
+        return [blk for blk in self.blocks[start:self.block_count] if not blk.image_path]
+
+    def place_images(self, image_paths, target_block=None):
+        # type: (list[str], PhotoInfo) -> list[PhotoInfo]
+        """複数の画像をまとめて配置し、デコードはバックグラウンドで行う
+
+        1枚目は target_block に、残りは target_block 以降の空いているブロックに順番に配置する。
+        配置先のブロックには先に画像パスをセットして予約しておく。
+        """
+        if not image_paths:
+            return []
+        slots = []
+        start = 0
+        if target_block is not None and target_block in self.blocks[:self.block_count]:
+            start = self.blocks.index(target_block) + 1
+            slots.append(target_block)
+        slots.extend(self.free_slots(start))
+        self.begin_edit("画像の配置")
+        placed = []
+        for blk, image_path in zip(slots, image_paths):
+            blk.image_path = image_path
+            blk.clear_image(keep_path=True)
+            placed.append(blk)
+        self._pending_blocks.extend(placed)
+        self.request_pending_images()
+        for blk in placed:
+            self.item_for_block(blk).update()
+        return placed
+
+    def clear_blocks(self):
+        # type: () -> None
+        """全てのブロックを破棄(別のページを読み込む前に呼ぶ)"""
+        self.blocks = []
+        self._pending_blocks = []
+        # デコード中の画像は破棄したブロックのものなので、完了しても反映しない
+        self._load_generation += 1
+        self._loading_count = 0
+        self.history.clear()
+
+    def block_rect_ratio(self, blk):
+        # type: (PhotoInfo) -> tuple[float, float, float, float]
+        """余白を反映したブロックの矩形(比率)"""
+        return apply_block_margins(blk.init_rect_ratio, self.export_width, self.export_height,
+                                   self.block_space_margin_px, self.top_under_margin_px, self.side_margin_px)
+
+    def exec_block_drag(self, mime):
+        # type: (QtCore.QMimeData) -> None
+        """ブロックのD&Dを開始(操作の再生時はここを差し替える)"""
+        drag = QtGui.QDrag(self)
+        drag.setMimeData(mime)
+        drag.exec(QtCore.Qt.MoveAction)
+
+    @timed("draw_layout")
+    def draw_layout(self, fit_window=True):
+        # type: (bool) -> None
         """レイアウトを描画"""
         # 後でポジションとスケールを再現できるように数値を保持
         # scale = self.transform().m11()
         # center = self.mapToScene(self.viewport().rect().center())
 
         self.scene().clear()
-        self.canvas_width = self.export_width
-        self.canvas_height = self.export_height
-        if not export_flag:
-            self.canvas_width = PREVIEW_CANVAS_WIDTH
-            rate = float(self.export_height) / float(self.export_width)
-            self.canvas_height = int(self.canvas_width * rate)
+        self.canvas_width = PREVIEW_CANVAS_WIDTH
+        rate = float(self.export_height) / float(self.export_width)
+        self.canvas_height = int(self.canvas_width * rate)
 
         # Photoが登録されるシーンの大きさ
         scene_rect = QtCore.QRectF(0, 0, self.canvas_width, self.canvas_height)
@@ -396,17 +604,6 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         color = 160
         self.scene().setBackgroundBrush(QtGui.QColor(color, color, color, 255))
 
-        # 各スペースの値をpxから出力サイズを1とした場合に比率に治す
-        margin_ratio_x = margin_ratio_y = 0
-        if self.block_space_margin_px > 0:
-            margin_ratio_x = self.block_space_margin_px / self.export_width
-            margin_ratio_y = self.block_space_margin_px / self.export_height
-
-        side_margin = self.side_margin_px / self.export_width
-        top_under_margin = self.top_under_margin_px / self.export_height
-        side_scale = (1.0 - side_margin * 2.0)
-        top_scale = (1.0 - top_under_margin * 2.0)
-
         # Photoの下地の色を決めるQGraphicsRectItemを作成し追加
         brush = QtGui.QBrush(self.bg_color)
         rect_item = QtWidgets.QGraphicsRectItem(0, 0, self.canvas_width, self.canvas_height)
@@ -414,51 +611,74 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         self.scene().addItem(rect_item)
 
         self._photo_block_items.clear()
+        self._block_items.clear()
+        self._batched_item = None
+        self._drag_items = []
+        self._scene_rect = scene_rect
 
         # Photoのブロックを追加
+        batched = self.block_count > self.batch_render_threshold
+        item_blocks, batched_blocks = [], []
         for blk in self.blocks[:self.block_count]:
-            # rect_ratio からマージン分を減算
-            x, y, w, h = blk.init_rect_ratio[0:4]
-            x += margin_ratio_x / 2
-            y += margin_ratio_y / 2
-            w -= margin_ratio_x
-            h -= margin_ratio_y
-            x = x * side_scale + side_margin
-            y = y * top_scale + top_under_margin
-            w = w * side_scale
-            h = h * top_scale
-            blk.rect_ratio = (x, y, w, h)
-            item = PhotoBlockItem(blk, scene_rect, self)
-            self.scene().addItem(item)
-            self._photo_block_items.append(item)
+            blk.rect_ratio = self.block_rect_ratio(blk)
+            if batched and not blk.image_path:
+                batched_blocks.append(blk)
+            else:
+                item_blocks.append(blk)
+        if batched_blocks:
+            # 後から追加する PhotoBlockItem がまとめて描画したセルより上に表示される
+            self._batched_item = BatchedBlocksItem(batched_blocks, scene_rect, self)
+            self.scene().addItem(self._batched_item)
+        for blk in item_blocks:
+            self._add_block_item(blk)
 
         if fit_window:
             self.fitInView(scene_rect, QtCore.Qt.KeepAspectRatio)
+        if PERF.enabled:
+            PERF.gauge("preview_bytes", sum(blk.preview_data.nbytes() for blk in self.blocks if blk.preview_data))
 
-    def export_image(self, out_path):
-        # type: (str) -> None
-        self.export_flag = True
-        # self.export_scene(out_path)
-        self.draw_layout(True)
-        for item in  self.scene().items():
-            if isinstance(item, PhotoBlockItem):
-                item._block.update_image()
-            item.setSelected(False)
-        self.clear_selection()
-        self.clear_selection(drop=True)
+    def export_snapshot(self):
+        # type: () -> ExportSnapshot
+        """出力用に現在のブロック状態を固定したスナップショットを作成
 
-        img = QtGui.QImage(int(self.export_width), int(self.export_height), QtGui.QImage.Format_RGB32)
-        img.fill(self.bg_color)
-        dots_per_meter = int(self.dpi / 0.0254)
-        img.setDotsPerMeterX(dots_per_meter)
-        img.setDotsPerMeterY(dots_per_meter)
+        スナップショットは不変なので、出力中に編集を続けても影響しない。
+        """
+        blocks = tuple(
+            BlockSnapshot(self.block_rect_ratio(blk), blk.image_path, blk.offset_x, blk.offset_y,
+                          blk.scale, blk.rotation)
+            for blk in self.blocks[:self.block_count])
+        bg_color = (self.bg_color.red(), self.bg_color.green(), self.bg_color.blue())
+        return ExportSnapshot(int(self.export_width), int(self.export_height), self.dpi, bg_color, blocks)
+
+    @timed("auto_crop")
+    def auto_crop(self, blocks=None):
+        # type: (list[PhotoInfo]) -> int
+        """プレビューの顕著度から、セルに重要な部分が入るように offset と scale を設定
+
+        blocks を省略した場合は全てのブロックに適用する。適用したブロック数を返す。
+        """
+        # NumPy の読み込みは起動時間に影響するので、最初に使う時まで遅らせる
+        from .autoCrop import fit_crop, saliency_for
+        self.begin_edit("自動トリミング")
+        count = 0
+        for blk in self.blocks[:self.block_count] if blocks is None else blocks:
+            if blk.preview_data is None:
+                continue
+            _, _, w, h = self.block_rect_ratio(blk)
+            fit = fit_crop(saliency_for(blk.preview_data), blk.preview_data.source_size, blk.rotation,
+                           w * self.export_width, h * self.export_height, self.export_width, self.export_height)
+            blk.offset_x, blk.offset_y, blk.scale = fit.offset_x, fit.offset_y, fit.scale
+            item = self._block_items.get(id(blk))
+            if item is not None:
+                item.update()
+            count += 1
+        return count
 
-        painter = QtGui.QPainter(img)
-        self.scene().render(painter)
-        painter.end()
-        img.save(out_path)
-        self.export_flag = False
-        self.draw_layout(fit_window=False)
+    @timed("export_image")
+    def export_image(self, out_path, options=None):
+        # type: (str, EncodeOptions) -> None
+        """出力画像を保存(シーンは作り直さない)"""
+        render_export(self.export_snapshot(), out_path, options, tile_cache=TILE_CACHE)
 
     def rotate_selected_image(self, rotation_degree):
         # type: (int) -> None
@@ -466,11 +686,9 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         """
         photo_brock_item = self.get_selected_photo_brock_item()
         if photo_brock_item:
+            self.begin_edit("回転")
             blk = photo_brock_item._block
-            if blk.preview_img:
-                blk.preview_img = blk.preview_img.rotate(rotation_degree, expand=True)
-            if blk.preview_img:
-                blk.preview_img = blk.preview_img.rotate(rotation_degree, expand=True)
+            # プレビューは書き換えない(描画時に回転済みのピラミッド画像を使う)
             blk.rotation = (blk.rotation - rotation_degree) % 360
             photo_brock_item.update()
 
@@ -488,6 +706,7 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
     def set_block_layout(self, layout_name, brock_ratio_list):
         # type: (str, list[list[float]]) -> None
         """レイアウトを読み込む"""
+        self.layout_name = layout_name
         for id, rect_ratio in enumerate(brock_ratio_list):
             if id >= len(self.blocks):
                 self.blocks.append(PhotoInfo())
@@ -495,6 +714,76 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
             self.blocks[id].update_attr_from_layout(layout_name)
         self.block_count = len(brock_ratio_list)
 
+    # =================================
+    # History
+    # =================================
+    def history_view_state(self):
+        # type: () -> tuple
+        """変わるとレイアウトを描画し直す状態"""
+        return (self.layout_name, self.block_count, self.block_space_margin_px, self.top_under_margin_px,
+                self.side_margin_px)
+
+    def begin_edit(self, label, merge_key=None):
+        # type: (str, object) -> None
+        """編集する直前に呼び、現在の状態を元に戻す履歴に積む
+
+        merge_key が同じ操作が続く場合(ホイールでの拡大縮小など)は1ステップにまとめる。
+        """
+        snapshot = self.history.snapshot([blk.history_state() for blk in self.blocks],
+                                         self.history_view_state(), label)
+        self.history.checkpoint(snapshot, merge_key)
+
+    def settle_history(self):
+        # type: () -> None
+        """begin_edit で保留している状態を確定する(元に戻す/やり直しのメニューを更新する前に呼ぶ)"""
+        self.history.settle([blk.history_state() for blk in self.blocks], self.history_view_state())
+
+    def undo(self):
+        # type: () -> bool
+        """直前の編集を元に戻す(戻した場合は True)"""
+        return self._restore(self.history.undo([blk.history_state() for blk in self.blocks],
+                                               self.history_view_state()))
+
+    def redo(self):
+        # type: () -> bool
+        """元に戻した編集をやり直す(やり直した場合は True)"""
+        return self._restore(self.history.redo([blk.history_state() for blk in self.blocks],
+                                               self.history_view_state()))
+
+    @timed("restore_history")
+    def _restore(self, step):
+        # type: (tuple | None) -> bool
+        """状態の変わったブロックだけ書き戻して描画し直す"""
+        if step is None:
+            return False
+        current, target = step
+        states = target.states()
+        del self.blocks[len(states):]
+        while len(self.blocks) < len(states):
+            self.blocks.append(PhotoInfo())
+        restored = []
+        for index in changed_indexes(current, target):
+            if index < len(states):
+                self.blocks[index].set_history_state(states[index])
+                restored.append(self.blocks[index])
+        # 読み込み中だった画像に戻した場合は読み込み直す
+        for blk in restored:
+            if blk.image_path and blk.preview_data is None and blk not in self._pending_blocks:
+                self._pending_blocks.append(blk)
+        PERF.count("history_restored_blocks", len(restored))
+        if target.view_state != current.view_state:
+            (self.layout_name, self.block_count, self.block_space_margin_px, self.top_under_margin_px,
+             self.side_margin_px) = target.view_state
+            self.draw_layout(fit_window=False)
+            self.history_restored.emit()
+        else:
+            for blk in restored:
+                if blk in self.blocks[:self.block_count]:
+                    blk.rect_ratio = self.block_rect_ratio(blk)
+                    self.item_for_block(blk).update()
+        self.request_pending_images()
+        return True
+
     # =================================
     # Context
     # =================================
@@ -513,10 +802,105 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
             })
         return layout_data
 
-    def set_context(self, context):
-        # type: (list[dict]) -> None
-        """JSONレイアウトを読み込み"""
+    def preview_sources(self):
+        # type: () -> dict[str, PreviewData]
+        """画像パスとデコード済みプレビューの辞書を取得"""
+        return {blk.image_path: blk.preview_data for blk in self.blocks
+                if blk.image_path and blk.preview_data}
+
+    def sort_by_capture_time(self):
+        # type: () -> None
+        """画像の入っているブロックの中で、画像を撮影日時順に並べ替える(索引を使い、ファイルは開かない)"""
+        if self.photo_index is None:
+            return
+        self.begin_edit("撮影日時順に並べ替え")
+        blocks = [blk for blk in self.blocks[:self.block_count] if blk.image_path]
+        states = [blk.image_state() for blk in blocks]
+        records = self.photo_index.get_many([state[0] for state in states])
+
+        def capture_time(state):
+            captured_at = records[state[0]].captured_at if state[0] in records else None
+            return captured_at is None, captured_at or "", state[0]
+        states.sort(key=capture_time)
+        for blk, state in zip(blocks, states):
+            blk.set_image_state(state)
+            self.item_for_block(blk).update()
+
+    def color_index(self, paths=None):
+        # type: (list[str]) -> ColorIndex
+        """画像の色の特徴量の索引(既定では画像の入っている全てのブロック)
+
+        読み込み済みのプレビューから作成し、まだ読み込んでいない画像は写真の索引に保存した特徴量を使う。
+        新しく作成した特徴量は写真の索引に保存する。特徴量の無い画像は索引に含めない。
+        """
+        # NumPy の読み込みは起動時間に影響するので、最初に使う時まで遅らせる
+        from .colorIndex import ColorIndex, feature_for, load_features, store_features
+        if paths is None:
+            paths = [blk.image_path for blk in self.blocks[:self.block_count] if blk.image_path]
+        previews = {blk.image_path: blk.preview_data for blk in self.blocks if blk.image_path and blk.preview_data}
+        stored = load_features(self.photo_index, paths) if self.photo_index is not None else {}
+        features, created = {}, {}
+        for path in paths:
+            if path in features:
+                continue
+            if path in stored:
+                features[path] = stored[path]
+            elif path in previews:
+                features[path] = created[path] = feature_for(previews[path])
+        if created and self.photo_index is not None:
+            store_features(self.photo_index, created)
+        return ColorIndex(list(features), list(features.values()))
+
+    @timed("sort_by_similarity")
+    def sort_by_similarity(self):
+        # type: () -> None
+        """画像の入っているブロックの中で、色の似た画像が隣り合うように並べ替える
+
+        特徴量の無い(まだ読み込んでいない)画像は元の順番で後ろに置く。
+        """
+        blocks = [blk for blk in self.blocks[:self.block_count] if blk.image_path]
+        index = self.color_index([blk.image_path for blk in blocks])
+        rank = {path: position for position, path in enumerate(index.sorted_paths())}
+        self.begin_edit("色の近い順に並べ替え")
+        states = [blk.image_state() for blk in blocks]
+        states.sort(key=lambda state: rank.get(state[0], len(rank)))
+        for blk, state in zip(blocks, states):
+            blk.set_image_state(state)
+            self.item_for_block(blk).update()
+
+    def image_aspects(self, display_sizes=None):
+        # type: (dict[str, tuple[int, int]]) -> list[float]
+        """画像を配置したブロックごとに回転を反映した縦横比を取得
+
+        同じ画像を複数のブロックに配置した場合はその数だけ含める。
+        まだデコードしていない画像は display_sizes のサイズを使い、無い場合は除く。
+        """
+        display_sizes = display_sizes or {}
+        aspects = []
+        for blk in self.blocks[:self.block_count]:
+            if not blk.image_path:
+                continue
+            if blk.preview_data:
+                source_size = blk.preview_data.source_size
+            else:
+                source_size = display_sizes.get(blk.image_path)
+            if source_size:
+                aspects.append(image_aspect(source_size, blk.rotation))
+        return aspects
+
+    @timed("set_context")
+    def set_context(self, context, preview_provider=None, defer_images=False):
+        # type: (list[dict], callable, bool) -> None
+        """JSONレイアウトを読み込み
+
+        preview_provider に画像パスから PreviewData を返す関数を渡すと、
+        元画像をデコードせずにそのプレビューを使う。
+        defer_images が True の場合はレイアウトと画像パスだけを復元し、
+        デコードは request_pending_images() でバックグラウンドに任せる。
+        """
         # self.block_count = len(context)
+        self._pending_blocks = []
+        self.history.clear()
         for id, blk_data in enumerate(context):
             if id >= len(self.blocks):
                 self.blocks.append(PhotoInfo())
@@ -527,12 +911,110 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
             blk.scale = blk_data.get("scale", 1.0)
             blk.rotation = blk_data.get("rotation", 0)
             blk.image_path = blk_data.get("file_path", None)
-            blk.update_image()
+            preview_data = None
+            if preview_provider and blk.image_path:
+                preview_data = preview_provider(blk.image_path)
+            if preview_data:
+                PERF.count("preview_cache_hit")
+                blk.set_preview(preview_data)
+            else:
+                if preview_provider and blk.image_path:
+                    PERF.count("preview_cache_miss")
+                if defer_images and blk.image_path:
+                    blk.clear_image(keep_path=True)
+                    self._pending_blocks.append(blk)
+                else:
+                    blk.update_image()
         self.draw_layout(fit_window=False)
 
+    def request_pending_images(self, base_priority=0):
+        # type: (int) -> None
+        """遅延していた画像のデコードを表示中のブロックから順に要求
+
+        優先度は (表示範囲外か, base_priority, 表示範囲の中心からの距離) の順に比較する。
+        """
+        pending, self._pending_blocks = self._pending_blocks, []
+        if not pending:
+            return
+        viewport_rect = self.viewport().rect()
+        center = QtCore.QPointF(viewport_rect.center())
+        queue = image_load_queue()
+        for blk in pending:
+            view_rect = self.mapFromScene(block_scene_rect(blk, self._scene_rect)).boundingRect()
+            visible = view_rect.intersects(viewport_rect)
+            delta = QtCore.QPointF(view_rect.center()) - center
+            distance = math.hypot(delta.x(), delta.y())
+            self._loading_count += 1
+            queue.request(blk.image_path, (0 if visible else 1, base_priority, distance),
+                          lambda path, preview_data, blk=blk, generation=self._load_generation:
+                          self._on_image_loaded(blk, path, preview_data, generation))
+
+    def _on_image_loaded(self, blk, path, preview_data, generation):
+        # type: (PhotoInfo, str, PreviewData, int) -> None
+        """バックグラウンドでデコードしたプレビューを反映"""
+        # 要求した後にページを切り替えていた場合は捨てる
+        if generation != self._load_generation:
+            return
+        self._loading_count -= 1
+        # 読み込み中に別の画像に差し替えられていた場合は捨てる
+        if blk.image_path == path and blk.preview_data is None:
+            blk.set_preview(preview_data)
+            self.item_for_block(blk).update()
+        if self._loading_count == 0:
+            self.images_loaded.emit()
+
+    def item_for_block(self, blk):
+        # type: (PhotoInfo) -> PhotoBlockItem
+        """ブロックの PhotoBlockItem を取得(まとめて描画中なら作成する)"""
+        item = self._block_items.get(id(blk))
+        if item is None:
+            item = self._add_block_item(blk)
+        return item
+
+    def materialize_at(self, scene_pos):
+        # type: (QtCore.QPointF) -> PhotoBlockItem | None
+        """まとめて描画しているセルのうち scene_pos にあるものを PhotoBlockItem にする"""
+        if self._batched_item is None:
+            return None
+        blk = self._batched_item.block_at(scene_pos)
+        if blk is None or id(blk) in self._block_items:
+            return None
+        return self._add_block_item(blk)
+
     # =================================
     # Private Methods
     # =================================
+    def _add_block_item(self, blk):
+        # type: (PhotoInfo) -> PhotoBlockItem
+        item = PhotoBlockItem(blk, self._scene_rect, self)
+        self.scene().addItem(item)
+        self._photo_block_items.append(item)
+        self._block_items[id(blk)] = item
+        return item
+
+    def _remove_block_item(self, item):
+        # type: (PhotoBlockItem) -> None
+        """PhotoBlockItem を取り除き、セルをまとめた描画に戻す"""
+        self.scene().removeItem(item)
+        self._photo_block_items.remove(item)
+        del self._block_items[id(item._block)]
+
+    def _fold_drag_items(self, scene_pos=None):
+        # type: (QtCore.QPointF) -> None
+        """ドラッグ中に作った PhotoBlockItem のうち、画像が入らなかったものを取り除く
+
+        scene_pos にあるセルはドロップ先の候補なので残す。
+        """
+        remaining = []
+        for item in self._drag_items:
+            if item._block.image_path:
+                continue
+            if scene_pos is not None and item.rect.contains(scene_pos):
+                remaining.append(item)
+                continue
+            self._remove_block_item(item)
+        self._drag_items = remaining
+
     def _get_mouse_under_item(self):
         # type: () -> PhotoBlockItem | None
         """マウス下のアイテムを取得"""
@@ -542,7 +1024,7 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         for item in items:
             if isinstance(item, PhotoBlockItem):
                 return item
-        return None
+        return self.materialize_at(scene_mouse_pos)
 
     # ==========================
     # 右クリックメニュー
@@ -556,12 +1038,14 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         right_rotate_action = QtGui.QAction("右 90°回転")
         left_rotate_action = QtGui.QAction("左 90°回転")
         reset_action = QtGui.QAction("フィット")
+        auto_crop_action = QtGui.QAction("自動トリミング")
         clear_image_action = QtGui.QAction("画像をクリア")
 
         if under_item:
             menu.addAction(right_rotate_action)
             menu.addAction(left_rotate_action)
             menu.addAction(reset_action)
+            menu.addAction(auto_crop_action)
             menu.addSeparator()
             menu.addAction(clear_image_action)
 
@@ -571,11 +1055,18 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         preview_size_action = menu.addAction("印刷サイズで画面に表示する")
         fit_window_action = menu.addAction("Windowサイズにフィットさせる")
         menu.addSeparator()
+        auto_crop_all_action = menu.addAction("全ての画像を自動トリミング")
+        sort_capture_time_action = None
+        if self.photo_index is not None:
+            sort_capture_time_action = menu.addAction("撮影日時順に並べ替える")
+        sort_similarity_action = menu.addAction("色の近い順に並べ替える")
         clear_duplicate_images_action = menu.addAction("重複している画像をクリア")
         clear_all_image_action = menu.addAction("全ての画像をクリア")
 
         action = menu.exec(self.mapToGlobal(pos))
 
+        if action in (right_rotate_action, left_rotate_action, reset_action, clear_image_action):
+            self.begin_edit(action.text())
         if action == right_rotate_action:
             under_item._block.rotation = (under_item._block.rotation + 90) % 360
             under_item.update()
@@ -590,10 +1081,12 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
                 under_item._block.scale = under_item._block.rot_90_scale
             under_item._block.update_image()
             under_item.update()
+        elif action == auto_crop_action:
+            self.auto_crop([under_item._block])
+        elif action is auto_crop_all_action:
+            self.auto_crop()
         elif action == clear_image_action:
-            under_item._block.image_path = None
-            under_item._block.preview_img = None
-            under_item._block.full_img = None
+            under_item._block.clear_image()
             under_item.update()
         elif action == preview_size_action:
             set_canvas_scale = self.export_width / PREVIEW_CANVAS_WIDTH
@@ -610,6 +1103,10 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
             self.scale(set_canvas_scale*screen_dpi/canvas_dpi, set_canvas_scale*screen_dpi/canvas_dpi)
         elif action is fit_window_action:
             self.fit_window_size()
+        elif action is not None and action is sort_capture_time_action:
+            self.sort_by_capture_time()
+        elif action is sort_similarity_action:
+            self.sort_by_similarity()
         elif action is clear_all_image_action:
             # 確認用のDialogを出す
             reply = QtWidgets.QMessageBox.question(
@@ -618,18 +1115,16 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
                 QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
                 QtWidgets.QMessageBox.No)
             if reply == QtWidgets.QMessageBox.Yes:
+                self.begin_edit("全ての画像をクリア")
                 for blk in self.blocks:
-                    blk.image_path = None
-                    blk.preview_img = None
-                    blk.full_img = None
+                    blk.clear_image()
             self.draw_layout()
         elif action is clear_duplicate_images_action:
+            self.begin_edit("重複している画像をクリア")
             seen_paths = set()
             for blk in self.blocks:
                 if blk.image_path and os.path.abspath(blk.image_path) in seen_paths:
-                    blk.image_path = None
-                    blk.preview_img = None
-                    blk.full_img = None
+                    blk.clear_image()
                 elif blk.image_path:
                     seen_paths.add(os.path.abspath(blk.image_path))
             self.draw_layout()
@@ -647,9 +1142,47 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         """Windowサイズにフィットさせる"""
         self.fitInView(self.scene().sceneRect(), QtCore.Qt.KeepAspectRatio)
 
+    def _draw_perf_hud(self, painter):
+        # type: (QtGui.QPainter) -> None
+        """フレーム時間と描画の遅いアイテムを画面左上に表示"""
+        lines = PERF.hud_lines() or ["計測中..."]
+        painter.save()
+        painter.resetTransform()
+        metrics = painter.fontMetrics()
+        line_height = metrics.height()
+        width = max(metrics.horizontalAdvance(line) for line in lines) + 16
+        height = line_height * len(lines) + 12
+        painter.fillRect(QtCore.QRectF(8, 8, width, height), QtGui.QColor(0, 0, 0, 170))
+        painter.setPen(QtGui.QColor(120, 255, 120))
+        for index, line in enumerate(lines):
+            painter.drawText(QtCore.QPointF(16, 14 + metrics.ascent() + index * line_height), line)
+        painter.restore()
+
     # =================================
     # Override Methods
     # =================================
+    def paintEvent(self, event):
+        # type: (QtGui.QPaintEvent) -> None
+        """計測有効時はフレーム時間を記録"""
+        if not PERF.enabled:
+            result = super().paintEvent(event)
+        else:
+            start = time.perf_counter_ns()
+            result = super().paintEvent(event)
+            duration_ns = time.perf_counter_ns() - start
+            PERF.record("frame", start, duration_ns)
+            PERF.record_frame(duration_ns / 1e6)
+        if not self._painted:
+            self._painted = True
+            self.first_painted.emit()
+        return result
+
+    def drawForeground(self, painter, rect):
+        # type: (QtGui.QPainter, QtCore.QRectF) -> None
+        super().drawForeground(painter, rect)
+        if PERF.hud_enabled:
+            self._draw_perf_hud(painter)
+
     def wheelEvent(self, event):
         # type: (QtGui.QGraphicsSceneWheelEvent) -> None
         """ホイールでスケール"""
@@ -678,6 +1211,7 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
         """
         self.clear_selection()
         self.clear_selection(drop=True)
+        self.materialize_at(self.mapToScene(event.pos()))
         if event.button() == QtCore.Qt.MiddleButton:
             self._pan_start_pos = event.pos()
             self.setCursor(QtCore.Qt.ClosedHandCursor)
@@ -710,14 +1244,34 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
             self.fit_window_size()
         elif event.key() == QtCore.Qt.Key_Plus:
             item = self.get_selected_photo_brock_item()
+            self.begin_edit("回転")
             item._block.rotation = (item._block.rotation + 90) % 360
             item.update()
         elif event.key() == QtCore.Qt.Key_Minus:
             item = self.get_selected_photo_brock_item()
+            self.begin_edit("回転")
             item._block.rotation = (item._block.rotation - 90) % 360
             item.update()
         return super().keyPressEvent(event)
 
+    def dragMoveEvent(self, event):
+        # type: (QtGui.QDragMoveEvent) -> None
+        """ドロップ先のセルを PhotoBlockItem にしてから受け渡す
+
+        通り過ぎたセルは画像が入らなかったので、まとめた描画に戻す。
+        """
+        scene_pos = self.mapToScene(event.position().toPoint())
+        item = self.materialize_at(scene_pos)
+        if item is not None:
+            self._drag_items.append(item)
+        self._fold_drag_items(scene_pos)
+        super().dragMoveEvent(event)
+
+    def dragLeaveEvent(self, event):
+        # type: (QtGui.QDragLeaveEvent) -> None
+        self._fold_drag_items()
+        super().dragLeaveEvent(event)
+
     def dropEvent(self, event):
         global DRAG_ITEM
         # === 外部画像ファイル ===
@@ -726,6 +1280,7 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
                 under_mouse_item = self._get_mouse_under_item()
                 path = event.mimeData().urls()[0].toLocalFile()
                 if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTS):
+                    self.begin_edit("画像の読み込み")
                     under_mouse_item._block.image_path = path
                     under_mouse_item._block.update_image()
                     under_mouse_item.update()
@@ -737,30 +1292,21 @@ class PhotoCollageView(QtWidgets.QGraphicsView):
                 image_path_list = [path for path in image_path_list
                                    if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTS)]
                 under_mouse_item = self._get_mouse_under_item()
-                for index, image_path in enumerate(image_path_list):
-                    skip_flag = under_mouse_item is not None
-                    for item in self._photo_block_items:
-                        if skip_flag and item is under_mouse_item:
-                            if index == 0:
-                                item._block.image_path = image_path
-                                item._block.update_image()
-                                item.update()
-                                break
-                            skip_flag = False
-                            continue
-                        if skip_flag:
-                            continue
-                        if item._block.image_path:
-                            continue
-                        item._block.image_path = image_path
-                        item._block.update_image()
-                        item.update()
-                        break
+                self.place_images(image_path_list, under_mouse_item._block if under_mouse_item else None)
 
             event.acceptProposedAction()
         self.update()
         self.clear_selection(drop=True)
         super().dropEvent(event)
+        self._fold_drag_items()
+
+
+def block_scene_rect(blk, scene_rect):
+    # type: (PhotoInfo, QtCore.QRectF) -> QtCore.QRectF
+    """ブロックのシーン上の矩形"""
+    x, y, w, h = blk.rect_ratio
+    return QtCore.QRectF(scene_rect.width() * x, scene_rect.height() * y,
+                         scene_rect.width() * w, scene_rect.height() * h)
 
 
 def get_a4_dpi(width_px):
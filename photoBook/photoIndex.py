@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+写真ライブラリのメタデータ索引(SQLite)
+
+パス + 更新日時 + ファイルサイズをキーに、サイズ・EXIF・知覚ハッシュなどを保持する。
+フォルダーの一覧や並べ替え、向きでの絞り込みは索引だけで行い、画像ファイルは開かない。
+索引の更新は scan_folder で差分だけを行う(PhotoIndexScanner でバックグラウンド実行)。
+類似度での並べ替えに使う色の特徴量(colorIndex)は、プレビューから作成したものを別のテーブルに保持する。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional
+from .define import *
+from .imageIO import read_metadata
+INDEX_VERSION = 1
+SCAN_COMMIT_INTERVAL = 200
+"""スキャン中にこの件数ごとにコミットする"""
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+"""EXIF の向きのうち縦横が入れ替わるもの"""
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    orientation INTEGER,
+    captured_at TEXT,
+    camera TEXT,
+    phash TEXT,
+    thumbnail_key TEXT,
+    indexed_at REAL
+);
+CREATE INDEX IF NOT EXISTS photos_folder ON photos (folder, captured_at);
+CREATE INDEX IF NOT EXISTS photos_phash ON photos (phash);
+CREATE TABLE IF NOT EXISTS color_features (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    feature BLOB NOT NULL
+);
+"""
+_COLUMNS = ("path", "folder", "mtime_ns", "size", "width", "height", "orientation", "captured_at",
+            "camera", "phash", "thumbnail_key")
+_DISPLAY_WIDTH = "(CASE WHEN orientation IN (5, 6, 7, 8) THEN height ELSE width END)"
+_DISPLAY_HEIGHT = "(CASE WHEN orientation IN (5, 6, 7, 8) THEN width ELSE height END)"
+ORDER_BY = {
+    "captured_at": "captured_at IS NULL, captured_at, path",
+    "path": "path",
+    "size": "width * height DESC, path",
+}
+
+
+class PhotoRecord(NamedTuple):
+    """索引に保存した1枚分の情報"""
+    path: str
+    folder: str
+    mtime_ns: int
+    size: int
+    width: Optional[int]
+    height: Optional[int]
+    orientation: Optional[int]
+    """EXIF の向き(1-8)"""
+    captured_at: Optional[str]
+    """撮影日時 "YYYY-MM-DD HH:MM:SS" """
+    camera: Optional[str]
+    phash: Optional[str]
+    """dHash(16進数)"""
+    thumbnail_key: Optional[str]
+    """プレビューのキャッシュに使うキー"""
+
+    @property
+    def display_size(self):
+        # type: () -> tuple[int, int]
+        """EXIF の向きを反映した (幅, 高さ)"""
+        if self.orientation in ROTATED_ORIENTATIONS:
+            return self.height, self.width
+        return self.width, self.height
+
+    @property
+    def aspect(self):
+        # type: () -> float | None
+        """EXIF の向きを反映した縦横比(幅 / 高さ)"""
+        width, height = self.display_size
+        if not width or not height:
+            return None
+        return float(width) / float(height)
+
+
+def thumbnail_key(path, stat):
+    # type: (str, os.stat_result) -> str
+    """プレビューのキャッシュキー(ファイルが変わるとキーも変わる)"""
+    state = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    return hashlib.sha1(repr(state).encode("utf-8")).hexdigest()
+
+
+def _normalize_folder(folder):
+    # type: (str) -> str
+    return os.path.normpath(os.path.abspath(folder))
+
+
+class PhotoIndex:
+    """写真のメタデータ索引
+
+    接続は1つだけ持ち、ロックで保護してスキャナーのスレッドとGUIから共有する。
+    """
+
+    def __init__(self, db_path):
+        # type: (str) -> None
+        self.db_path = str(db_path)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(_SCHEMA)
+            version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+            if version != INDEX_VERSION:
+                self._connection.execute("DELETE FROM photos")
+                self._connection.execute("PRAGMA user_version=%d" % INDEX_VERSION)
+            self._connection.commit()
+
+    def close(self):
+        # type: () -> None
+        with self._lock:
+            self._connection.close()
+
+    # =================================
+    # Query
+    # =================================
+    def get(self, path):
+        # type: (str) -> PhotoRecord | None
+        return self.get_many([path]).get(path)
+
+    def get_many(self, paths):
+        # type: (list[str]) -> dict[str, PhotoRecord]
+        """パスごとのレコード(ファイルが変更されている場合も最後に索引した内容を返す)"""
+        records = {}
+        paths = list(paths)
+        for start in range(0, len(paths), 500):
+            chunk = [os.path.abspath(path) for path in paths[start:start + 500]]
+            sql = "SELECT %s FROM photos WHERE path IN (%s)" % (", ".join(_COLUMNS), ", ".join("?" * len(chunk)))
+            with self._lock:
+                rows = self._connection.execute(sql, chunk).fetchall()
+            by_path = {row[0]: PhotoRecord(*row) for row in rows}
+            for path, abs_path in zip(paths[start:start + 500], chunk):
+                if abs_path in by_path:
+                    records[path] = by_path[abs_path]
+        return records
+
+    def query(self, folder=None, orientation=None, min_pixels=None, order_by="captured_at"):
+        # type: (str, str, int, str) -> list[PhotoRecord]
+        """条件に合うレコードを取得
+
+        folder はそのフォルダー直下の画像のみ、
+        orientation は "landscape", "portrait", "square" のいずれか(EXIF の向きを反映)。
+        """
+        where, params = [], []
+        if folder:
+            where.append("folder = ?")
+            params.append(_normalize_folder(folder))
+        if orientation == "landscape":
+            where.append("%s > %s" % (_DISPLAY_WIDTH, _DISPLAY_HEIGHT))
+        elif orientation == "portrait":
+            where.append("%s < %s" % (_DISPLAY_WIDTH, _DISPLAY_HEIGHT))
+        elif orientation == "square":
+            where.append("%s = %s" % (_DISPLAY_WIDTH, _DISPLAY_HEIGHT))
+        if min_pixels:
+            where.append("width * height >= ?")
+            params.append(min_pixels)
+        sql = "SELECT %s FROM photos" % ", ".join(_COLUMNS)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY " + ORDER_BY[order_by]
+        with self._lock:
+            rows = self._connection.execute(sql, params).fetchall()
+        return [PhotoRecord(*row) for row in rows]
+
+    def order_paths(self, paths, order_by="captured_at"):
+        # type: (list[str], str) -> list[str]
+        """索引を使ってパスを並べ替え(索引に無いものはファイル名順で後ろに置く)"""
+        records = self.get_many(paths)
+        known = [path for path in paths if path in records]
+        unknown = sorted(path for path in paths if path not in records)
+        if order_by == "captured_at":
+            known.sort(key=lambda path: (records[path].captured_at is None, records[path].captured_at or "", path))
+        else:
+            known.sort()
+        return known + unknown
+
+    def is_current(self, path, stat):
+        # type: (str, os.stat_result) -> bool
+        """索引の内容がファイルの現在の状態と一致しているか"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT mtime_ns, size FROM photos WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size
+
+    def folder_states(self, folder):
+        # type: (str) -> dict[str, tuple[int, int]]
+        """フォルダー直下の索引済みパスと (mtime_ns, size)"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path, mtime_ns, size FROM photos WHERE folder = ?", (_normalize_folder(folder),)).fetchall()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    # =================================
+    # Update
+    # =================================
+    def upsert_many(self, rows):
+        # type: (list[tuple]) -> None
+        """_COLUMNS の順のタプルをまとめて登録"""
+        sql = "INSERT OR REPLACE INTO photos (%s, indexed_at) VALUES (%s, ?)" % (
+            ", ".join(_COLUMNS), ", ".join("?" * len(_COLUMNS)))
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(sql, [tuple(row) + (now,) for row in rows])
+            self._connection.commit()
+
+    def remove_many(self, paths):
+        # type: (list[str]) -> None
+        with self._lock:
+            self._connection.executemany("DELETE FROM photos WHERE path = ?", [(path,) for path in paths])
+            self._connection.executemany("DELETE FROM color_features WHERE path = ?", [(path,) for path in paths])
+            self._connection.commit()
+
+    # =================================
+    # Color Features
+    # =================================
+    def get_color_features(self, paths, version):
+        # type: (list[str], int) -> dict[str, tuple[int, int, bytes]]
+        """パスごとの (mtime_ns, size, 色の特徴量)(colorIndex で作成したもの。version が違うものは返さない)"""
+        features = {}
+        paths = list(paths)
+        for start in range(0, len(paths), 500):
+            chunk = [os.path.abspath(path) for path in paths[start:start + 500]]
+            sql = "SELECT path, mtime_ns, size, feature FROM color_features WHERE version = ? AND path IN (%s)" % (
+                ", ".join("?" * len(chunk)))
+            with self._lock:
+                rows = self._connection.execute(sql, [version] + chunk).fetchall()
+            by_path = {row[0]: row[1:] for row in rows}
+            for path, abs_path in zip(paths[start:start + 500], chunk):
+                if abs_path in by_path:
+                    features[path] = by_path[abs_path]
+        return features
+
+    def put_color_features(self, rows, version):
+        # type: (list[tuple[str, int, int, bytes]], int) -> None
+        """(パス, mtime_ns, size, 特徴量) をまとめて保存"""
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO color_features (path, mtime_ns, size, version, feature) VALUES (?, ?, ?, ?, ?)",
+                [(os.path.abspath(path), mtime_ns, size, version, sqlite3.Binary(feature))
+                 for path, mtime_ns, size, feature in rows])
+            self._connection.commit()
+
+
+def index_row(path, stat):
+    # type: (str, os.stat_result) -> tuple
+    """ファイルを読んで索引の1行を作成"""
+    path = os.path.abspath(path)
+    try:
+        meta = read_metadata(path)
+    except Exception:
+        # 壊れた画像も登録しておき、変更されるまで読み直さない
+        meta = {}
+    return (path, _normalize_folder(os.path.dirname(path)), stat.st_mtime_ns, stat.st_size,
+            meta.get("width"), meta.get("height"), meta.get("orientation"), meta.get("captured_at"),
+            meta.get("camera"), meta.get("phash"), thumbnail_key(path, stat))
+
+
+def scan_folder(index, folder, recursive=True, progress=None, cancel_event=None):
+    # type: (PhotoIndex, str, bool, callable, threading.Event) -> int
+    """フォルダーの画像を索引に反映し、更新した件数を返す
+
+    更新日時とサイズが変わっていないファイルは読まない。
+    消えたファイルは索引から削除する。
+    """
+    folders = [_normalize_folder(folder)]
+    changed = 0
+    while folders:
+        current = folders.pop()
+        indexed = index.folder_states(current)
+        seen = set()
+        pending = []
+        try:
+            entries = sorted(os.scandir(current), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        for entry in entries:
+            if cancel_event is not None and cancel_event.is_set():
+                index.upsert_many(pending)
+                return changed + len(pending)
+            if entry.is_dir():
+                if recursive:
+                    folders.append(entry.path)
+                continue
+            if not entry.name.lower().endswith(IMAGE_EXTS):
+                continue
+            path = os.path.abspath(entry.path)
+            seen.add(path)
+            stat = entry.stat()
+            if indexed.get(path) == (stat.st_mtime_ns, stat.st_size):
+                continue
+            pending.append(index_row(path, stat))
+            if len(pending) >= SCAN_COMMIT_INTERVAL:
+                index.upsert_many(pending)
+                changed += len(pending)
+                pending = []
+            if progress:
+                progress(changed + len(pending), current)
+        index.upsert_many(pending)
+        changed += len(pending)
+        index.remove_many([path for path in indexed if path not in seen])
+    return changed
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+写真の索引のバックグラウンド更新
+"""
+import threading
+from PySide6 import QtCore
+from .photoIndex import scan_folder
+
+
+class PhotoIndexScanner(QtCore.QThread):
+    """フォルダーを順番にスキャンして索引を更新する"""
+    progress = QtCore.Signal(int, str)
+    """(更新した件数, スキャン中のフォルダー)"""
+    folder_scanned = QtCore.Signal(str, int)
+    """(フォルダー, 更新した件数)"""
+
+    def __init__(self, index, parent=None):
+        # type: (PhotoIndex, QtCore.QObject) -> None
+        super().__init__(parent)
+        self._index = index
+        self._folders = []  # type: list[tuple[str, bool]]
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        # 終了間際に追加されたフォルダーを取りこぼさないようにする
+        self.finished.connect(self._start_if_pending)
+
+    def scan(self, folder, recursive=True):
+        # type: (str, bool) -> None
+        """スキャンするフォルダーを追加(実行中でなければ開始する)"""
+        with self._lock:
+            if (folder, recursive) not in self._folders:
+                self._folders.append((folder, recursive))
+        self._start_if_pending()
+
+    def cancel(self):
+        # type: () -> None
+        with self._lock:
+            self._folders.clear()
+        self._cancel_event.set()
+
+    def _start_if_pending(self):
+        # type: () -> None
+        with self._lock:
+            pending = bool(self._folders)
+        if pending and not self.isRunning():
+            self._cancel_event.clear()
+            self.start(QtCore.QThread.LowPriority)
+
+    def run(self):
+        while not self._cancel_event.is_set():
+            with self._lock:
+                if not self._folders:
+                    return
+                folder, recursive = self._folders.pop(0)
+            changed = scan_folder(self._index, folder, recursive, self.progress.emit, self._cancel_event)
+            self.folder_scanned.emit(folder, changed)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+デコード済みプレビューのアリーナファイル(.arena)
+
+プレビューのピラミッドの画素を無圧縮のまま、ページ境界に揃えて1ファイルに並べる。
+
+    ヘッダー(ARENA_PAGE_SIZE バイト): マジック, バージョン, 索引の位置と長さ
+    画素データ: レベルごとに ARENA_PAGE_SIZE の倍数の位置から
+    索引(JSON): 画像パスごとのサイズ, 更新日時, レベルの (位置, 幅, 高さ, モード)
+
+読み込み時はファイルを mmap し、プレビューのレベル(Pillow の画像)を
+マップしたページの上に直接作成する。デコードもコピーも行わないので、
+大量のプレビューを開いてもページフォールトの分しかかからず、
+同じファイルを開いた他のプロセスとも物理メモリを共有できる。
+描画時は描画サイズに縮小した画素だけを QImageBuffer に書き込む。
+"""
+import json
+import mmap
+import os
+import struct
+from .imageIO import PreviewData, pil_image, resolve_path
+ARENA_MAGIC = b"PBARENA\0"
+ARENA_VERSION = 2
+ARENA_PAGE_SIZE = 64 * 1024
+"""画素データの配置単位(Windows の mmap の割り当て単位に合わせる)"""
+_HEADER = struct.Struct("<8sIQQ")
+_LEVEL_MODES = {
+    # プレビューのモード: アリーナに保存するモード(そのまま frombuffer で参照できるもの)
+    "RGB": "RGBX",
+    "RGBX": "RGBX",
+    "RGBA": "RGBA",
+    "L": "L",
+}
+_PIXEL_BYTES = {"RGBX": 4, "RGBA": 4, "L": 1}
+
+
+def _arena_level(image):
+    # type: (Image.Image) -> Image.Image
+    """アリーナに保存する形式の画像(RGB は4バイト目を 0xff にした RGBX)"""
+    mode = _LEVEL_MODES.get(image.mode)
+    if mode is None:
+        has_alpha = image.mode in ("LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        mode = _LEVEL_MODES[image.mode]
+    if image.mode == "RGB":
+        image = image.convert("RGBX")
+        image.im.fillband(3, 255)
+    return image
+
+
+def write_arena(path, previews):
+    # type: (str, dict[str, PreviewData]) -> int
+    """プレビューをアリーナファイルに保存して、保存した画像の数を返す
+
+    開いているアリーナを置き換えられない場合(Windows でマップ中など)は path + ".next" に保存し、
+    次に open_arena した時に置き換える。
+    """
+    tmp_path = path + ".tmp"
+    images = {}
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * ARENA_PAGE_SIZE)
+        for image_path, preview_data in previews.items():
+            if preview_data is None:
+                continue
+            levels = []
+            for level in preview_data.levels:
+                level = _arena_level(level)
+                offset = f.tell()
+                f.write(level.tobytes("raw", level.mode))
+                levels.append((offset, level.width, level.height, level.mode))
+                # 次のレベルをページ境界から始める
+                f.write(b"\0" * (-f.tell() % ARENA_PAGE_SIZE))
+            images[image_path] = {
+                "width": preview_data.source_size[0],
+                "height": preview_data.source_size[1],
+                "mtime": preview_data.mtime,
+                "size": preview_data.file_size,
+                "levels": levels,
+            }
+        index = json.dumps({"images": images}, ensure_ascii=False).encode("utf-8")
+        index_offset = f.tell()
+        f.write(index)
+        f.seek(0)
+        f.write(_HEADER.pack(ARENA_MAGIC, ARENA_VERSION, index_offset, len(index)))
+    try:
+        os.replace(tmp_path, path)
+    except PermissionError:
+        os.replace(tmp_path, path + ".next")
+    return len(images)
+
+
+def open_arena(path):
+    # type: (str) -> PreviewArena | None
+    """アリーナファイルを開く(無い場合や壊れている場合は None)"""
+    next_path = path + ".next"
+    if os.path.isfile(next_path):
+        try:
+            os.replace(next_path, path)
+        except OSError:
+            pass
+    if not os.path.isfile(path):
+        return None
+    try:
+        return PreviewArena(path)
+    except (OSError, ValueError):
+        return None
+
+
+class PreviewArena:
+    """アリーナファイルをマップし、プレビューを画素をコピーせずに提供する
+
+    返した画像はマップを参照しているので、アリーナは使い終わるまで開いたままにする。
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset, index_length = _HEADER.unpack_from(self._mmap, 0)
+        if magic != ARENA_MAGIC or version != ARENA_VERSION:
+            self._mmap.close()
+            raise ValueError("アリーナファイルではありません: %s" % path)
+        index = json.loads(self._mmap[index_offset:index_offset + index_length].decode("utf-8"))
+        self.images = index.get("images", {})  # type: dict[str, dict]
+        """画像パスごとのメタデータ"""
+        self._view = memoryview(self._mmap)
+        self._previews = {}  # type: dict[str, PreviewData]
+
+    def __contains__(self, image_path):
+        return image_path in self.images
+
+    def is_stale(self, image_path):
+        # type: (str) -> bool
+        """元画像が保存時から変更されているかどうか(元画像が見つからない場合はそのまま使う)"""
+        meta = self.images.get(image_path)
+        if meta is None:
+            return True
+        try:
+            stat = os.stat(resolve_path(image_path))
+        except OSError:
+            return False
+        return stat.st_size != meta["size"] or stat.st_mtime != meta["mtime"]
+
+    def preview(self, image_path):
+        # type: (str) -> PreviewData | None
+        """マップしたページを参照するプレビュー。古い場合は None"""
+        if image_path in self._previews:
+            return self._previews[image_path]
+        if self.is_stale(image_path):
+            return None
+        meta = self.images[image_path]
+        levels = [self._level_image(*level) for level in meta["levels"]]
+        preview_data = PreviewData(levels, (meta["width"], meta["height"]), meta["mtime"], meta["size"])
+        self._previews[image_path] = preview_data
+        return preview_data
+
+    def _level_image(self, offset, width, height, mode):
+        # type: (int, int, int, str) -> Image.Image
+        buffer = self._view[offset:offset + width * height * _PIXEL_BYTES[mode]]
+        return pil_image().frombuffer(mode, (width, height), buffer, "raw", mode, 0, 1)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+プロジェクトバンドル(.pbook)の保存と読み込み
+
+zip形式で以下を1ファイルにまとめる。
+    context.json   : save_layout と同じ形式のレイアウト情報
+    manifest.json  : 画像ごとのメタデータ(サイズ, 更新日時, ハッシュ, プレビューのメンバー名)
+    previews/<hash>/<level>.png : プレビューのピラミッド
+
+読み込み時はzipの中央ディレクトリだけを読み、プレビューは必要な画像のメンバーだけを開く。
+"""
+import hashlib
+import io
+import json
+import os
+import zipfile
+from .imageIO import PreviewData, decode_preview, pil_image
+BUNDLE_VERSION = 1
+CONTEXT_MEMBER = "context.json"
+MANIFEST_MEMBER = "manifest.json"
+PREVIEW_MEMBER_DIR = "previews"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    # type: (str) -> str
+    """ファイル内容のSHA1を計算"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def context_image_paths(context):
+    # type: (dict) -> list[str]
+    """レイアウト情報から参照している画像パスを重複なしで取得"""
+    paths = []
+    for key in ("photo_context", "stock_context"):
+        for blk_data in context.get(key, []):
+            path = blk_data.get("file_path")
+            if path and path not in paths:
+                paths.append(path)
+    return paths
+
+
+def _encode_png(image):
+    # type: (Image.Image) -> bytes
+    if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def save_bundle(path, context, preview_sources=None):
+    # type: (str, dict, dict[str, PreviewData]) -> None
+    """レイアウトとプレビューをバンドルに保存
+
+    preview_sources に既にデコード済みのプレビューを渡すと再デコードを省略する。
+    """
+    preview_sources = preview_sources or {}
+    images = {}
+    written = {}
+    tmp_path = path + ".tmp"
+    try:
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED) as zf:
+            zf.writestr(CONTEXT_MEMBER, json.dumps(context, indent=4, ensure_ascii=False),
+                        compress_type=zipfile.ZIP_DEFLATED)
+            for image_path in context_image_paths(context):
+                if not os.path.isfile(image_path):
+                    continue
+                stat = os.stat(image_path)
+                digest = file_digest(image_path)
+                preview_data = preview_sources.get(image_path)
+                if preview_data is None or preview_data.mtime != stat.st_mtime:
+                    preview_data = decode_preview(image_path)
+                if preview_data is None:
+                    continue
+                if digest not in written:
+                    members = []
+                    for index, level in enumerate(preview_data.levels):
+                        name = "%s/%s/%d.png" % (PREVIEW_MEMBER_DIR, digest, index)
+                        # PNGは圧縮済みなので無圧縮で格納し、読み込み時にそのまま開けるようにする
+                        zf.writestr(name, _encode_png(level))
+                        members.append(name)
+                    written[digest] = members
+                images[image_path] = {
+                    "hash": digest,
+                    "width": preview_data.source_size[0],
+                    "height": preview_data.source_size[1],
+                    "mtime": stat.st_mtime,
+                    "size": stat.st_size,
+                    "levels": written[digest],
+                }
+            manifest = {"version": BUNDLE_VERSION, "images": images}
+            zf.writestr(MANIFEST_MEMBER, json.dumps(manifest, indent=4, ensure_ascii=False),
+                        compress_type=zipfile.ZIP_DEFLATED)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class ProjectBundle:
+    """バンドルを開き、メンバーを必要になった時だけ読み込む"""
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+        self._zip = zipfile.ZipFile(path, "r")
+        self.context = json.loads(self._zip.read(CONTEXT_MEMBER).decode("utf-8"))
+        """save_layout と同じ形式のレイアウト情報"""
+        manifest = json.loads(self._zip.read(MANIFEST_MEMBER).decode("utf-8"))
+        self.images = manifest.get("images", {})  # type: dict[str, dict]
+        """画像パスごとのメタデータ"""
+        self._previews = {}  # type: dict[str, PreviewData]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # type: () -> None
+        self._zip.close()
+
+    def is_stale(self, image_path):
+        # type: (str) -> bool
+        """元画像が保存時から変更されているかどうか
+
+        元画像が見つからない場合は、バンドル内のプレビューをそのまま使う。
+        """
+        meta = self.images.get(image_path)
+        if meta is None:
+            return True
+        if not os.path.isfile(image_path):
+            return False
+        stat = os.stat(image_path)
+        return stat.st_size != meta["size"] or stat.st_mtime != meta["mtime"]
+
+    def preview(self, image_path):
+        # type: (str) -> PreviewData | None
+        """バンドル内のプレビューを取得。古い場合は None"""
+        if image_path in self._previews:
+            return self._previews[image_path]
+        if self.is_stale(image_path):
+            return None
+        meta = self.images[image_path]
+        levels = [self._read_image(name) for name in meta["levels"]]
+        preview_data = PreviewData(levels, (meta["width"], meta["height"]), meta["mtime"], meta["size"])
+        self._previews[image_path] = preview_data
+        return preview_data
+
+    def _read_image(self, name):
+        # type: (str) -> Image.Image
+        with self._zip.open(name) as fp:
+            image = pil_image().open(io.BytesIO(fp.read()))
+            image.load()
+        return image
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Pillow の画像を QImage で描画するためのバッファ
+
+描画サイズに縮小した画像を再利用するバッファに書き込み、QImage はそのバッファを直接参照する
+(tobytes や QPixmap.fromImage によるコピーは行わない)。
+不透明な画像は RGBX(アルファ無しの32bit)、グレースケールは8bitのまま扱い、
+アルファチャンネルは透過のある画像だけに使う。
+"""
+from PySide6 import QtGui
+from .imageIO import pil_image
+from .perfMonitor import PERF
+_BUFFER_FORMATS = {
+    # Pillow のモード: (バッファのモード, 1画素のバイト数, QImage のフォーマット)
+    "RGB": ("RGBX", 4, QtGui.QImage.Format_RGBX8888),
+    "RGBX": ("RGBX", 4, QtGui.QImage.Format_RGBX8888),
+    "RGBA": ("RGBA", 4, QtGui.QImage.Format_RGBA8888),
+    "L": ("L", 1, QtGui.QImage.Format_Grayscale8),
+}
+
+
+def buffer_source(image):
+    # type: (Image.Image) -> Image.Image
+    """バッファにそのまま書き込めるモード(RGB, RGBX, RGBA, L)の画像にする"""
+    if image.mode in _BUFFER_FORMATS:
+        return image
+    if image.mode in ("LA", "PA", "RGBa", "La") or "transparency" in image.info:
+        return image.convert("RGBA")
+    return image.convert("RGB")
+
+
+class QImageBuffer:
+    """縮小した画像を保持し、その画素を参照する QImage を提供する
+
+    同じ画像を同じサイズで描画する場合は縮小をやり直さず、サイズが同じならバッファを使い回す。
+    QImage はバッファを参照しているので、このオブジェクトより長く保持しないこと。
+    """
+
+    def __init__(self):
+        self._buffer = None  # type: bytearray | None
+        self._mapped = None  # type: Image.Image | None
+        """_buffer を画素として参照する Pillow の画像"""
+        self._qimage = None  # type: QtGui.QImage | None
+        self._source = None  # type: Image.Image | None
+        self._size = None  # type: tuple[int, int] | None
+
+    def image(self, source, size, resample=None):
+        # type: (Image.Image, tuple[int, int], int) -> QtGui.QImage
+        """source を size に縮小した QImage(前回と同じ画像とサイズなら前回のものをそのまま返す)"""
+        size = (max(1, int(size[0])), max(1, int(size[1])))
+        if source is self._source and size == self._size:
+            PERF.count("qimage_reuse")
+            return self._qimage
+        image = buffer_source(source)
+        if image.size != size:
+            image = image.resize(size, pil_image().BICUBIC if resample is None else resample)
+        self._ensure_buffer(image.mode, size)
+        # Pillow のコアに直接書き込む(Image.paste は共有している画像をコピーしてしまう)
+        self._mapped.im.paste(image.im, (0, 0) + size)
+        if image.mode == "RGB":
+            # RGB の4バイト目は不定なので、Qt の RGBX(0xff 固定)に合わせる
+            self._mapped.im.fillband(3, 255)
+        self._source = source
+        self._size = size
+        return self._qimage
+
+    def clear(self):
+        # type: () -> None
+        self._buffer = self._mapped = self._qimage = self._source = self._size = None
+
+    def nbytes(self):
+        # type: () -> int
+        return len(self._buffer) if self._buffer is not None else 0
+
+    def _ensure_buffer(self, mode, size):
+        # type: (str, tuple[int, int]) -> None
+        buffer_mode, pixel_bytes, qformat = _BUFFER_FORMATS[mode]
+        if (self._mapped is not None and self._mapped.mode == buffer_mode and self._mapped.size == size):
+            PERF.count("qimage_buffer_reuse")
+            return
+        width, height = size
+        self._buffer = bytearray(width * height * pixel_bytes)
+        self._mapped = pil_image().frombuffer(buffer_mode, size, self._buffer, "raw", buffer_mode, 0, 1)
+        self._qimage = QtGui.QImage(self._buffer, width, height, width * pixel_bytes, qformat)
+        PERF.count("qimage_buffer_alloc")
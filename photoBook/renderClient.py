@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+出力サーバー(renderDaemon)のクライアント
+
+    client = RenderClient(port=8765)
+    client.render_layout_file("layout.json", "collage.png")
+    print(client.stats())
+
+LocalRenderClient は同じ操作をプロセス内の RenderService に直接行う(ネットワークを使わない)。
+"""
+import abc
+import http.client
+import json
+from .renderDaemon import (
+    DEFAULT_HOST, DEFAULT_PORT, RenderResult, RenderService, ServiceBusy, encode_options_from_dict)
+DEFAULT_TIMEOUT = 600.0
+
+
+class RenderError(Exception):
+    """サーバーがエラーを返した"""
+
+    def __init__(self, status, message):
+        # type: (int, str) -> None
+        super().__init__("%d: %s" % (status, message))
+        self.status = status
+
+
+class _ClientBase(abc.ABC):
+    """RenderClient と LocalRenderClient で共通の操作"""
+
+    @abc.abstractmethod
+    def render(self, context, out_path=None, image_format="png", options=None):
+        # type: (dict, str, str, dict) -> RenderResult
+        """レイアウト情報を出力(out_path を指定しない場合は画像のバイト列を受け取る)
+
+        エラーは RenderError で、status は HTTP のステータスコードと同じ。
+        """
+
+    @abc.abstractmethod
+    def stats(self):
+        # type: () -> dict
+        """処理件数やキャッシュの状態(RenderService.stats と同じ内容)"""
+
+    def render_layout_file(self, layout_path, out_path=None, image_format="png", options=None):
+        # type: (str, str, str, dict) -> RenderResult
+        """save_layout で保存したJSONファイルを出力"""
+        with open(layout_path, "r", encoding="utf-8") as f:
+            context = json.load(f)
+        return self.render(context, out_path, image_format, options)
+
+
+class RenderClient(_ClientBase):
+    """HTTP で出力サーバーに接続するクライアント"""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT):
+        # type: (str, int, float) -> None
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def render(self, context, out_path=None, image_format="png", options=None):
+        # type: (dict, str, str, dict) -> RenderResult
+        """out_path を指定するとサーバー側で保存し、指定しないと画像のバイト列を受け取る"""
+        body = json.dumps({"context": context, "out_path": out_path, "format": image_format,
+                           "options": options or {}}, ensure_ascii=False).encode("utf-8")
+        status, headers, data = self._request("POST", "/render", body)
+        if headers.get("Content-Type", "").startswith("application/json"):
+            result = json.loads(data.decode("utf-8"))
+            return RenderResult(result["path"], None, "", result["width"], result["height"], result["seconds"])
+        width, height = (int(v) for v in headers.get("X-Render-Size", "0x0").split("x"))
+        return RenderResult(None, data, headers.get("Content-Type", ""), width, height,
+                            float(headers.get("X-Render-Seconds", 0)))
+
+    def stats(self):
+        # type: () -> dict
+        return json.loads(self._request("GET", "/stats")[2].decode("utf-8"))
+
+    def _request(self, method, path, body=None):
+        # type: (str, str, bytes) -> tuple[int, dict, bytes]
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+            if response.status != 200:
+                try:
+                    message = json.loads(data.decode("utf-8")).get("error", "")
+                except ValueError:
+                    message = data.decode("utf-8", "replace")
+                raise RenderError(response.status, message)
+            return response.status, dict(response.getheaders()), data
+        finally:
+            connection.close()
+
+
+class LocalRenderClient(_ClientBase):
+    """プロセス内の RenderService を直接呼ぶクライアント(RenderClient と同じ使い方)"""
+
+    def __init__(self, service=None):
+        # type: (RenderService) -> None
+        self.service = service or RenderService()
+
+    def render(self, context, out_path=None, image_format="png", options=None):
+        # type: (dict, str, str, dict) -> RenderResult
+        try:
+            return self.service.render(context, out_path, image_format, encode_options_from_dict(options))
+        except ServiceBusy as e:
+            raise RenderError(503, str(e))
+        except (KeyError, ValueError, TypeError) as e:
+            raise RenderError(400, str(e))
+
+    def stats(self):
+        # type: () -> dict
+        return self.service.stats()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+常駐の出力サーバー
+
+    python -m photoBook.renderDaemon --port 8765 --workers 2
+
+save_layout 形式のレイアウト情報(JSON)を受け取り、出力画像を返す(または保存する)。
+Qt を使わずに exportRenderer で描画するので、起動は1回だけで済み、
+タイルキャッシュ、縮小デコードした元画像のキャッシュとワーカーはリクエストをまたいで使い回す。
+
+    POST /render  {"context": {...}, "out_path": "...", "format": "png", "options": {...}}
+        out_path を指定した場合はそこに保存して結果をJSONで返す。
+        指定しない場合は画像のバイト列をそのまま返す。
+    GET  /stats   処理件数やキャッシュの状態をJSONで返す。
+
+接続は 127.0.0.1 のみ受け付ける。
+"""
+import argparse
+import collections
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple, Optional
+from .exportRenderer import (
+    EncodeOptions, encode_format, render_canvas, save_image, save_options, snapshot_from_layout)
+from .tileCache import TileCache
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUE = 16
+DEFAULT_SOURCE_CACHE_BYTES = 256 * 1024 * 1024
+"""縮小デコードした元画像のキャッシュの上限(配置や余白を変えたレイアウトの再出力で使う)"""
+
+
+class RenderResult(NamedTuple):
+    """1回の出力結果"""
+    path: Optional[str]
+    """保存先(バイト列で返した場合は None)"""
+    data: Optional[bytes]
+    """エンコード済みの画像(保存した場合は None)"""
+    content_type: str
+    width: int
+    height: int
+    seconds: float
+
+
+class ServiceBusy(Exception):
+    """待ち行列が一杯でリクエストを受け付けられない"""
+
+
+def encode_options_from_dict(options):
+    # type: (dict | None) -> EncodeOptions
+    """JSONの保存オプションを EncodeOptions に変換(不明なキーは無視)"""
+    options = options or {}
+    return EncodeOptions(**{key: options[key] for key in EncodeOptions._fields if key in options})
+
+
+class RenderService:
+    """出力処理をワーカーに振り分け、キャッシュと統計を保持する"""
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, max_queue=DEFAULT_MAX_QUEUE, tile_cache=None,
+                 source_cache=None):
+        # type: (int, int, TileCache, TileCache) -> None
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.tile_cache = tile_cache or TileCache()
+        """リクエストをまたいで使うタイルキャッシュ"""
+        self.source_cache = source_cache or TileCache(DEFAULT_SOURCE_CACHE_BYTES, name="source_cache")
+        """縮小デコードした元画像のキャッシュ(タイルが変わってもデコードはやり直さない)"""
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="render")
+        # 実行中 + 待ち行列の上限
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._active = 0
+        self._pending = 0
+        self._render_seconds = 0.0
+        self._started_at = time.time()
+
+    def render(self, context, out_path=None, image_format="png", options=None):
+        # type: (dict, str, str, EncodeOptions) -> RenderResult
+        """レイアウト情報を描画して保存、または画像のバイト列を返す
+
+        待ち行列が一杯の場合は ServiceBusy を送出する。
+        """
+        if not self._slots.acquire(blocking=False):
+            self._count("rejected")
+            raise ServiceBusy("待ち行列が一杯です(上限 %d)" % (self.max_workers + self.max_queue))
+        with self._lock:
+            self._counters["requests"] += 1
+            self._pending += 1
+        try:
+            future = self._executor.submit(self._render, context, out_path, image_format, options)
+        except BaseException:
+            # 終了後などで投入できなかった場合は、確保した枠を戻す
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def stats(self):
+        # type: () -> dict
+        """処理件数やキャッシュの状態"""
+        with self._lock:
+            completed = self._counters["completed"]
+            return {
+                "uptime_seconds": time.time() - self._started_at,
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "active": self._active,
+                "queued": self._pending,
+                "requests": self._counters["requests"],
+                "completed": completed,
+                "failed": self._counters["failed"],
+                "rejected": self._counters["rejected"],
+                "average_render_seconds": self._render_seconds / completed if completed else 0.0,
+                "tile_cache_bytes": self.tile_cache.nbytes,
+                "tile_cache_hits": self.tile_cache.hits,
+                "tile_cache_misses": self.tile_cache.misses,
+                "source_cache_bytes": self.source_cache.nbytes,
+                "source_cache_hits": self.source_cache.hits,
+                "source_cache_misses": self.source_cache.misses,
+            }
+
+    def shutdown(self):
+        # type: () -> None
+        self._executor.shutdown(wait=True)
+
+    def _count(self, name, value=1):
+        # type: (str, int) -> None
+        with self._lock:
+            self._counters[name] += value
+
+    def _render(self, context, out_path, image_format, options):
+        # type: (dict, str, str, EncodeOptions) -> RenderResult
+        with self._lock:
+            self._pending -= 1
+            self._active += 1
+        start = time.perf_counter()
+        try:
+            snapshot = snapshot_from_layout(context)
+            canvas = render_canvas(snapshot, tile_cache=self.tile_cache, source_cache=self.source_cache)
+            options = options or EncodeOptions()
+            if out_path:
+                image_format = encode_format(out_path)
+                save_image(canvas, out_path, snapshot.dpi, options)
+                data = None
+            else:
+                # ".png" だけでは splitext が拡張子と見なさないので、ファイル名の形にする
+                image_format = encode_format("render." + image_format.lstrip("."))
+                buffer = io.BytesIO()
+                canvas.save(buffer, image_format, **save_options(image_format, snapshot.dpi, options))
+                data = buffer.getvalue()
+        except Exception:
+            self._count("failed")
+            raise
+        finally:
+            with self._lock:
+                self._active -= 1
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self._counters["completed"] += 1
+            self._render_seconds += seconds
+        return RenderResult(out_path or None, data, "image/%s" % image_format.lower(),
+                            snapshot.width, snapshot.height, seconds)
+
+
+# =================================
+# HTTP
+# =================================
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """RenderService を HTTP で公開するハンドラー"""
+    server_version = "PhotoBookRender/1.0"
+
+    def do_GET(self):
+        if self.path == "/stats":
+            return self._send_json(200, self.server.service.stats())
+        self._send_json(404, {"error": "not found: %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/render":
+            return self._send_json(404, {"error": "not found: %s" % self.path})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            result = self.server.service.render(
+                request["context"], request.get("out_path"), request.get("format", "png"),
+                encode_options_from_dict(request.get("options")))
+        except ServiceBusy as e:
+            return self._send_json(503, {"error": str(e)})
+        except (KeyError, ValueError, TypeError) as e:
+            return self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            return self._send_json(500, {"error": str(e)})
+        if result.data is None:
+            return self._send_json(200, {"path": result.path, "width": result.width,
+                                         "height": result.height, "seconds": result.seconds})
+        self.send_response(200)
+        self.send_header("Content-Type", result.content_type)
+        self.send_header("Content-Length", str(len(result.data)))
+        self.send_header("X-Render-Size", "%dx%d" % (result.width, result.height))
+        self.send_header("X-Render-Seconds", "%.6f" % result.seconds)
+        self.end_headers()
+        self.wfile.write(result.data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, body):
+        # type: (int, dict) -> None
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class RenderHTTPServer(ThreadingHTTPServer):
+    """127.0.0.1 で待ち受ける出力サーバー"""
+    daemon_threads = True
+
+    def __init__(self, service, port=DEFAULT_PORT, verbose=False):
+        # type: (RenderService, int, bool) -> None
+        super().__init__((DEFAULT_HOST, port), RenderRequestHandler)
+        self.service = service
+        self.verbose = verbose
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PhotoBook の常駐出力サーバー")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="同時に描画する数")
+    parser.add_argument("--max-queue", type=int, default=DEFAULT_MAX_QUEUE, help="待たせるリクエストの上限")
+    parser.add_argument("--cache-dir", help="タイルキャッシュをディスクにも保存する場合の保存先")
+    parser.add_argument("--source-cache-mb", type=int, default=DEFAULT_SOURCE_CACHE_BYTES // (1024 * 1024),
+                        help="縮小デコードした元画像のキャッシュの上限(MB)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="リクエストをログに出力する")
+    args = parser.parse_args(argv)
+
+    service = RenderService(args.workers, args.max_queue, TileCache(cache_dir=args.cache_dir),
+                            TileCache(args.source_cache_mb * 1024 * 1024, name="source_cache"))
+    server = RenderHTTPServer(service, args.port, args.verbose)
+    print("listening on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+出力用タイルのキャッシュ
+
+ブロックごとに出力解像度で描画した画像を、描画に影響する状態のハッシュをキーに保持する。
+再出力時は状態が変わったブロックだけを描画し直し、残りはキャッシュから合成する。
+cache_dir を指定するとディスクにも保存し、セッションをまたいで再利用する。
+"""
+import collections
+import hashlib
+import os
+import threading
+from .imageIO import pil_image, resolve_path
+from .perfMonitor import PERF
+TILE_CACHE_VERSION = 2
+"""描画方法を変えた場合に古いキャッシュを使わないようにするためのバージョン"""
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+TILE_CACHE_DIR_ENV = "PHOTOBOOK_TILE_CACHE_DIR"
+
+
+def tile_key(block, width, height, dpi, quality="bicubic"):
+    # type: (BlockSnapshot, int, int, int, str) -> str | None
+    """ブロックの描画状態からキーを作成(画像が無い場合は None)"""
+    local_path = resolve_path(block.image_path)
+    if not local_path or not os.path.isfile(local_path):
+        return None
+    stat = os.stat(local_path)
+    state = (
+        TILE_CACHE_VERSION, os.path.abspath(block.image_path), stat.st_mtime_ns, stat.st_size,
+        tuple(round(v, 9) for v in block.rect_ratio), block.offset_x, block.offset_y,
+        block.scale, block.rotation, width, height, dpi, quality,
+    )
+    return hashlib.sha1(repr(state).encode("utf-8")).hexdigest()
+
+
+def source_key(path, size, mode):
+    # type: (str, tuple[int, int], str) -> str
+    """縮小デコードした元画像のキーを作成(ファイルとデコードの解像度が同じなら同じキー)"""
+    stat = os.stat(resolve_path(path))
+    state = (TILE_CACHE_VERSION, os.path.abspath(path), stat.st_mtime_ns, stat.st_size, tuple(size), mode)
+    return hashlib.sha1(repr(state).encode("utf-8")).hexdigest()
+
+
+def _tile_nbytes(tile):
+    # type: (Image.Image) -> int
+    return tile.width * tile.height * len(tile.getbands())
+
+
+class TileCache:
+    """メモリ(LRU)とディスクの2段のタイルキャッシュ"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, cache_dir=None, name="tile_cache"):
+        # type: (int, str, str) -> None
+        self.max_bytes = max_bytes
+        """メモリに保持する最大バイト数"""
+        self.cache_dir = cache_dir
+        """ディスクキャッシュの保存先(None の場合は保存しない)"""
+        self.name = name
+        """計測(PERF)のカウンタ名の接頭辞"""
+        self._tiles = collections.OrderedDict()  # type: collections.OrderedDict[str, Image.Image]
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self):
+        # type: () -> int
+        return self._bytes
+
+    def set_cache_dir(self, cache_dir):
+        # type: (str | None) -> None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+
+    def get(self, key):
+        # type: (str) -> Image.Image | None
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+        if tile is None and self.cache_dir:
+            tile = self._load(key)
+            if tile is not None:
+                self._store(key, tile)
+        if tile is not None:
+            self.hits += 1
+            PERF.count(self.name + "_hit")
+        else:
+            self.misses += 1
+            PERF.count(self.name + "_miss")
+        return tile
+
+    def contains(self, key):
+        # type: (str) -> bool
+        """キャッシュにあるかどうか(ヒット数は数えず、ディスクからも読み込まない)"""
+        with self._lock:
+            if key in self._tiles:
+                return True
+        return bool(self.cache_dir) and os.path.isfile(self._path(key))
+
+    def put(self, key, tile):
+        # type: (str, Image.Image) -> None
+        self._store(key, tile)
+        if self.cache_dir:
+            self._save(key, tile)
+
+    def clear(self):
+        # type: () -> None
+        """メモリ上のキャッシュをクリア"""
+        with self._lock:
+            self._tiles.clear()
+            self._bytes = 0
+
+    def _store(self, key, tile):
+        # type: (str, Image.Image) -> None
+        nbytes = _tile_nbytes(tile)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self._bytes -= _tile_nbytes(old)
+            self._tiles[key] = tile
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= _tile_nbytes(evicted)
+        PERF.gauge(self.name + "_bytes", self._bytes)
+
+    def _path(self, key):
+        # type: (str) -> str
+        return os.path.join(self.cache_dir, key[:2], key + ".png")
+
+    def _load(self, key):
+        # type: (str) -> Image.Image | None
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with pil_image().open(path) as image:
+                image.load()
+                return image.copy() if image.mode == "RGB" else image.convert("RGB")
+        except OSError:
+            return None
+
+    def _save(self, key, tile):
+        # type: (str, Image.Image) -> None
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        tile.save(tmp_path, "PNG", compress_level=1)
+        os.replace(tmp_path, path)
+
+
+TILE_CACHE = TileCache(cache_dir=os.environ.get(TILE_CACHE_DIR_ENV) or None)
+"""アプリ全体で共有するタイルキャッシュ"""
@@ -16,6 +16,7 @@ class ToolBarWidget(QtWidgets.QWidget):
     save_layout_clicked = QtCore.Signal()
     load_layout_clicked = QtCore.Signal()
     batch_import_clicked = QtCore.Signal()
+    recommend_layout_clicked = QtCore.Signal()
 
     def __init__(self):
         super().__init__()
@@ -50,6 +51,9 @@ class ToolBarWidget(QtWidgets.QWidget):
         self.layout_combo = QtWidgets.QComboBox()
         self.layout_combo.addItems(LAYOUT_PRESETS.keys())
         self.layout_combo.setMaxVisibleItems(30)
+        self.recommend_layout_btn = QtWidgets.QPushButton("おすすめ")
+        self.recommend_layout_btn.setToolTip("読み込んだ画像の縦横比に合うレイアウトを表示")
+        self.recommend_layout_btn.clicked.connect(self.recommend_layout_clicked)
 
         self.bg_color_btn = QtWidgets.QPushButton("背景色")
         self.bg_color_btn.clicked.connect(self._choose_color)
@@ -66,6 +70,7 @@ class ToolBarWidget(QtWidgets.QWidget):
         h_layout1.addWidget(self.size_switch_cb)
         h_layout1.addWidget(QtWidgets.QLabel("レイアウト:"))
         h_layout1.addWidget(self.layout_combo)
+        h_layout1.addWidget(self.recommend_layout_btn)
         h_layout1.addWidget(QtWidgets.QLabel("余白(px):"))
         h_layout1.addWidget(self.space_margin_spin)
         h_layout1.addWidget(QtWidgets.QLabel("上下の余白(px):"))
@@ -91,6 +96,43 @@ class ToolBarWidget(QtWidgets.QWidget):
         """
         return self.layout_combo.currentText()
 
+    def get_current_size_preset(self):
+        # type: () -> str
+        """現在選択されているサイズプリセット名を取得する
+        """
+        return self.size_preset.currentText()
+
+    def preset_canvas_size(self, preset_name):
+        # type: (str) -> tuple[int, int, int]
+        """サイズスイッチを反映したプリセットの (幅, 高さ, DPI) を取得する
+        """
+        return preset_canvas_size(preset_name, self.size_switch_cb.isChecked())
+
+    def get_margins(self):
+        # type: () -> tuple[int, int, int]
+        """(ブロック間, 上下, 左右) の余白(px)を取得する
+        """
+        return (self.space_margin_spin.value(), self.top_under_margin_spin.value(),
+                self.side_margin_spin.value())
+
+    def show_layout_recommendations(self, scores, count=8):
+        # type: (list[LayoutScore], int) -> None
+        """おすすめのレイアウトをメニューで表示し、選ばれたレイアウトに切り替える
+        """
+        menu = QtWidgets.QMenu(self)
+        for score in scores[:count]:
+            text = "%s  (切り抜き 約%d%%" % (score.layout_name, round(score.crop_ratio * 100))
+            if score.unmatched:
+                text += ", 過不足 %d" % score.unmatched
+            action = menu.addAction(text + ")")
+            action.setData(score.layout_name)
+        if not scores:
+            menu.addAction("画像が読み込まれていません").setEnabled(False)
+        action = menu.exec(self.recommend_layout_btn.mapToGlobal(
+            self.recommend_layout_btn.rect().bottomLeft()))
+        if action and action.data():
+            self.layout_combo.setCurrentText(action.data())
+
     def _change_layout(self, layout_name):
         # type: (str) -> None
         """レイアウトのGUIを変更したときに呼ばれる関数"""
@@ -103,11 +145,7 @@ class ToolBarWidget(QtWidgets.QWidget):
         """
         preset_name = self.size_preset.currentText()
         if preset_name in SIZE_PRESETS:
-            height, width, dpi = SIZE_PRESETS[preset_name]
-            if self.size_switch_cb.isChecked():
-                self.canvas_size_changed.emit(height, width, dpi)
-            else:
-                self.canvas_size_changed.emit(width, height, dpi)
+            self.canvas_size_changed.emit(*self.preset_canvas_size(preset_name))
 
     def _choose_color(self):
         # type: () -> None
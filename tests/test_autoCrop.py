@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+自動トリミング(autoCrop.fit_crop)のテスト
+"""
+import numpy as np
+import pytest
+from PIL import Image
+from photoBook.autoCrop import AUTO_CROP_SCALES, fit_crop, saliency_map
+CELL = 100.0
+CANVAS = 1000.0
+
+
+def corner_image(size, corner):
+    # type: (tuple[int, int], str) -> Image.Image
+    """灰色の画像の corner("top_right" など)の4分の1だけに細かい縞模様を入れる"""
+    width, height = size
+    pixels = np.full((height, width), 128, dtype=np.uint8)
+    rows = slice(0, height // 4) if corner.startswith("top") else slice(height - height // 4, height)
+    cols = slice(width - width // 4, width) if corner.endswith("right") else slice(0, width // 4)
+    stripes = np.where((np.arange(width)[np.newaxis, :] // 2 + np.arange(height)[:, np.newaxis] // 2) % 2, 255, 0)
+    pixels[rows, cols] = stripes[rows, cols]
+    return Image.fromarray(pixels, "L")
+
+
+def fit(image, rotation=0):
+    return fit_crop(saliency_map(image), image.size, rotation, CELL, CELL, CANVAS, CANVAS)
+
+
+def test_offset_moves_towards_energy_horizontally():
+    # 横長の画像を正方形のセルに入れると、左右だけ動かせる
+    right = fit(corner_image((400, 200), "top_right"))
+    left = fit(corner_image((400, 200), "bottom_left"))
+    # 右側を見せるには画像を左に動かす
+    assert right.offset_x < -0.01
+    assert left.offset_x > 0.01
+    # 拡大した場合は上下も模様のある側に寄せる(主に動かすのは左右)
+    assert right.offset_y >= 0.0 and left.offset_y <= 0.0
+    assert abs(right.offset_x) > abs(right.offset_y)
+    assert right.kept > 0.5
+
+
+def test_offset_moves_towards_energy_vertically():
+    top = fit(corner_image((200, 400), "top_left"))
+    bottom = fit(corner_image((200, 400), "bottom_right"))
+    assert top.offset_y > 0.01
+    assert bottom.offset_y < -0.01
+
+
+@pytest.mark.parametrize("rotation", [0, 90, 180, 270])
+@pytest.mark.parametrize("size", [(400, 200), (200, 400), (300, 300)])
+def test_flat_image_stays_centred(size, rotation):
+    result = fit(Image.new("RGB", size, (90, 140, 200)), rotation)
+    assert abs(result.offset_x) < 0.01
+    assert abs(result.offset_y) < 0.01
+    # 平坦な画像は拡大しない(セルをちょうど覆う倍率のまま)
+    cover = fit_crop(saliency_map(Image.new("L", size)), size, rotation, CELL, CELL, CANVAS, CANVAS,
+                     scales=AUTO_CROP_SCALES[:1])
+    assert result.scale == pytest.approx(cover.scale)
+
+
+def test_rotation_follows_the_energy():
+    image = corner_image((400, 200), "top_right")
+    # 時計回りに90度回すと右上は右下になり、縦長になるので上下に動かす
+    rotated = fit(image, 90)
+    assert rotated.offset_y < -0.01 and rotated.offset_x <= 0.0
+    # 180度回すと左下になる
+    upside_down = fit(image, 180)
+    assert upside_down.offset_x > 0.01 and upside_down.offset_y <= 0.0
+    # 270度回すと左上になる
+    counter = fit(image, 270)
+    assert counter.offset_y > 0.01 and counter.offset_x >= 0.0
+    # 回転しても寄せる量は変わらない
+    unrotated = fit(image)
+    for result in (rotated, upside_down, counter):
+        assert sorted(map(abs, result[:2])) == pytest.approx(sorted(map(abs, unrotated[:2])), abs=1e-6)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+保存したレイアウトの一括出力(batchExport)のテスト
+"""
+import json
+import multiprocessing
+import os
+import time
+import pytest
+from photoBook import batchExport
+from photoBook.batchExport import BatchManifest, MANIFEST_NAME, export_batch
+SIZE_PRESET = 'L判 1052 x 1500 px (300 DPI)'
+_run_job = batchExport.run_job
+
+
+def write_layout(path, bg_color=(255, 255, 255)):
+    # type: (str, tuple[int, int, int]) -> str
+    """画像を配置していない1ページのレイアウトを保存"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    layout = {
+        "input_context": {"size_preset": SIZE_PRESET, "size_switch": False, "bg_color": bg_color,
+                          "space_margin": 10, "top_under_margin": 10, "side_margin": 10},
+        "photo_context": [{"rect_ratio": (0.0, 0.0, 1.0, 1.0), "file_path": None, "offset_x": 0.0,
+                           "offset_y": 0.0, "scale": 1.0, "rotation": 0}],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(layout, f)
+    return path
+
+
+def crashing_run_job(job, options):
+    """crash を含むレイアウトはワーカーごと落とし、他は少し待ってから出力する(巻き添えにするため)"""
+    if "crash" in os.path.basename(job.layout_path):
+        time.sleep(0.2)
+        os._exit(1)
+    time.sleep(0.5)
+    return _run_job(job, options)
+
+
+def statuses(results):
+    # type: (list) -> dict[str, str]
+    return {result.job.out_path: result.status for result in results}
+
+
+def test_json_without_layout_keys_fails(tmp_path):
+    layout_dir = tmp_path / "layouts"
+    write_layout(str(layout_dir / "page.json"))
+    with open(layout_dir / "bad.json", "w", encoding="utf-8") as f:
+        json.dump({"bad": 1}, f)
+    out_dir = str(tmp_path / "out")
+
+    results = {os.path.basename(result.job.layout_path): result for result in export_batch([str(layout_dir)], out_dir)}
+    assert results["bad.json"].status == "failed"
+    assert "photo_context" in results["bad.json"].error
+    assert results["page.json"].status == "done"
+    assert not os.path.exists(os.path.join(out_dir, "bad.png"))
+    manifest = BatchManifest(os.path.join(out_dir, MANIFEST_NAME))
+    assert [entry["layout"] for entry in manifest.outputs.values()] == [str(layout_dir / "page.json")]
+
+
+def test_same_layout_names_get_unique_outputs(tmp_path):
+    first = write_layout(str(tmp_path / "a" / "x.json"), (255, 0, 0))
+    second = write_layout(str(tmp_path / "b" / "x.json"), (0, 0, 255))
+    third = write_layout(str(tmp_path / "y.json"))
+    out_dir = str(tmp_path / "out")
+
+    results = export_batch([first, second, third], out_dir)
+    out_paths = [result.job.out_path for result in results]
+    assert [result.status for result in results] == ["done"] * 3
+    assert len(set(out_paths)) == 3
+    assert [os.path.basename(path) for path in out_paths] == ["a_x.png", "b_x.png", "y.png"]
+    assert all(os.path.isfile(path) for path in out_paths)
+
+    # 再実行時は全て飛ばす
+    assert [result.status for result in export_batch([first, second, third], out_dir)] == ["skipped"] * 3
+
+
+def test_jobs_broken_by_another_worker_are_retried(tmp_path, monkeypatch):
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("ワーカーに差し替えた関数を渡すために fork が必要")
+    monkeypatch.setattr(batchExport, "run_job", crashing_run_job)
+    paths = [write_layout(str(tmp_path / name)) for name in ("crash.json", "ok_1.json", "ok_2.json")]
+    out_dir = str(tmp_path / "out")
+
+    results = export_batch(paths, out_dir, max_workers=3)
+    assert len(results) == 3
+    assert statuses(results) == {
+        os.path.join(out_dir, "crash.png"): "failed",
+        os.path.join(out_dir, "ok_1.png"): "done",
+        os.path.join(out_dir, "ok_2.png"): "done",
+    }
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+ブック出力(PdfWriter / マルチページTIFF)のテスト
+"""
+import io
+import re
+import zlib
+import pytest
+from PIL import Image
+from photoBook.bookExport import PdfWriter, book_snapshots, render_book
+from photoBook.define import SIZE_PRESETS, SIZE_SWITCH_LAYOUT
+from photoBook.exportRenderer import EncodeOptions
+SIZE_PRESET = 'L判 1052 x 1500 px (300 DPI)'
+PAGE_SIZES = ((120, 80), (60, 90))
+
+
+def write_pdf(compression):
+    # type: (str) -> bytes
+    """色の違う2ページの PDF を作成"""
+    buffer = io.BytesIO()
+    writer = PdfWriter(buffer)
+    for (width, height), color in zip(PAGE_SIZES, ((200, 40, 40), (40, 40, 200))):
+        writer.add_page(Image.new("RGB", (width, height), color), 300, EncodeOptions(pdf_compression=compression))
+    writer.close()
+    return buffer.getvalue()
+
+
+def xref_offsets(data):
+    # type: (bytes) -> dict[int, int]
+    """startxref からクロスリファレンスを読み、オブジェクト番号ごとのオフセットを返す"""
+    xref = int(re.search(rb"startxref\n(\d+)\n%%EOF\n$", data).group(1))
+    assert data[xref:].startswith(b"xref\n")
+    lines = data[xref:].split(b"\n")
+    first, count = (int(v) for v in lines[1].split())
+    offsets = {}
+    for index, line in enumerate(lines[2:2 + count]):
+        offset, generation, kind = line.split()
+        if kind == b"n":
+            offsets[first + index] = int(offset)
+    size = int(re.search(rb"trailer\n<< /Size (\d+)", data).group(1))
+    assert size == count
+    return offsets
+
+
+def book_layout(layouts):
+    # type: (list[str]) -> dict
+    """ページごとにレイアウト名の違う、画像を配置していないブック"""
+    return {
+        "input_context": {"size_preset": SIZE_PRESET, "size_switch": False, "layout": layouts[0]},
+        "photo_context": [],
+        "book": {"pages": [{"layout": layout, "photo_context": [
+            {"rect_ratio": (0.0, 0.0, 1.0, 1.0), "file_path": None}]} for layout in layouts]},
+    }
+
+
+@pytest.mark.parametrize("compression", ["flate", "jpeg"])
+def test_pdf_xref_points_at_objects(compression):
+    data = write_pdf(compression)
+    assert data.startswith(b"%PDF-1.4\n")
+    offsets = xref_offsets(data)
+    assert sorted(offsets) == list(range(1, len(offsets) + 1))
+    for object_id, offset in offsets.items():
+        assert data[offset:].startswith(b"%d 0 obj\n" % object_id)
+    assert re.search(rb"/Type /Pages /Kids \[(\d+ 0 R ?){2}\] /Count 2", data)
+
+
+def test_pdf_streams_match_length_objects():
+    data = write_pdf("flate")
+    offsets = xref_offsets(data)
+    images = re.finditer(rb"/Width (\d+) /Height (\d+) .*?/Length (\d+) 0 R >>\nstream\n", data)
+    sizes = []
+    for match in images:
+        width, height, length_id = (int(v) for v in match.groups())
+        length_body = data[offsets[length_id]:].split(b"\n")[1]
+        stream = data[match.end():match.end() + int(length_body)]
+        assert data[match.end() + int(length_body):].startswith(b"\nendstream\nendobj\n")
+        assert len(zlib.decompress(stream)) == width * height * 3
+        sizes.append((width, height))
+    assert sizes == list(PAGE_SIZES)
+    # 用紙サイズは DPI から計算する
+    assert b"/MediaBox [0 0 28.8000 19.2000]" in data
+
+
+def test_multipage_tiff(tmp_path):
+    layouts = ["グリッド", SIZE_SWITCH_LAYOUT[0]]
+    out_path = str(tmp_path / "book.tif")
+    assert render_book(book_snapshots(book_layout(layouts)), out_path) == 2
+    width, height, dpi = SIZE_PRESETS[SIZE_PRESET]
+    with Image.open(out_path) as image:
+        assert image.n_frames == 2
+        sizes = []
+        for frame in range(image.n_frames):
+            image.seek(frame)
+            sizes.append(image.size)
+            assert tuple(round(float(v)) for v in image.info["dpi"]) == (dpi, dpi)
+    # SIZE_SWITCH_LAYOUT のページだけ縦横を入れ替える
+    assert sizes[0] != sizes[1]
+    assert sorted(sizes[0]) == sorted(sizes[1]) == sorted((width, height))
+    assert not (tmp_path / "book.tif.tmp.tif").exists()
+
+
+def test_pdf_book_page_count(tmp_path):
+    out_path = str(tmp_path / "book.pdf")
+    render_book(book_snapshots(book_layout(["グリッド"] * 3)), out_path)
+    with open(out_path, "rb") as f:
+        data = f.read()
+    offsets = xref_offsets(data)
+    for object_id, offset in offsets.items():
+        assert data[offset:].startswith(b"%d 0 obj\n" % object_id)
+    assert b"/Count 3" in data
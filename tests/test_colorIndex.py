@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+ColorIndex(色の特徴量の索引)のテスト
+"""
+import collections
+import numpy as np
+import pytest
+from PIL import Image
+from photoBook.colorIndex import FEATURE_DIM, ColorIndex, _assign_with_capacity, color_feature
+
+
+def blob_index(centers, per_blob, spread=0.01, seed=0):
+    # type: (list[float], int, float, int) -> ColorIndex
+    """1次元目だけ中心を変えた塊を並べた索引(パスは "塊番号_番号")"""
+    rng = np.random.default_rng(seed)
+    paths, features = [], []
+    for blob, center in enumerate(centers):
+        for i in range(per_blob):
+            feature = rng.normal(0.0, spread, FEATURE_DIM).astype(np.float32)
+            feature[0] += center
+            paths.append("%d_%02d" % (blob, i))
+            features.append(feature)
+    return ColorIndex(paths, features)
+
+
+def random_index(count, seed=0):
+    # type: (int, int) -> ColorIndex
+    rng = np.random.default_rng(seed)
+    return ColorIndex(["%04d" % i for i in range(count)], rng.random((count, FEATURE_DIM), dtype=np.float32))
+
+
+def test_knn_matches_brute_force():
+    index = random_index(200)
+    query = index.paths[17]
+    result = index.knn(query, k=8)
+    distances = np.sqrt(((index.features - index.features[17]) ** 2).sum(1))
+    expected = [index.paths[i] for i in np.argsort(distances) if i != 17][:8]
+    assert [path for path, _ in result] == expected
+    assert all(a[1] <= b[1] for a, b in zip(result, result[1:]))
+    assert query not in [path for path, _ in result]
+
+
+def test_knn_with_feature_and_large_k():
+    index = random_index(5)
+    result = index.knn(index.features[2], k=50)
+    assert len(result) == 5
+    assert result[0] == (index.paths[2], 0.0)
+    # パスで検索した場合は自身を除く
+    assert len(index.knn(index.paths[2], k=50)) == 4
+
+
+def test_order_is_permutation_along_gradient():
+    # 1次元目だけが変わる並びは端から順につながる
+    features = np.zeros((12, FEATURE_DIM), dtype=np.float32)
+    positions = np.random.default_rng(1).permutation(12)
+    features[:, 0] = positions
+    index = ColorIndex(["%02d" % i for i in range(12)], features)
+    order = index.order()
+    assert sorted(order) == list(range(12))
+    walk = features[order, 0]
+    assert list(walk) in (sorted(walk), sorted(walk, reverse=True))
+
+
+def test_order_subset():
+    index = random_index(50)
+    subset = [3, 9, 27, 41, 44]
+    assert sorted(index.order(subset)) == subset
+    assert index.order([]) == []
+
+
+def test_cluster_recovers_blobs():
+    index = blob_index([0.0, 5.0, 10.0], 10)
+    groups = index.cluster(3, capacity=10)
+    assert sorted(len(group) for group in groups) == [10, 10, 10]
+    for group in groups:
+        assert len({path.split("_")[0] for path in group}) == 1
+    # 中心の似た順に並べるので、真ん中の塊は両端の塊の間になる
+    assert groups[1][0].startswith("1_")
+
+
+@pytest.mark.parametrize("total, count, capacity", [(100, 7, None), (100, 4, 25), (300, 10, 40), (1, 3, 2)])
+def test_cluster_assigns_every_path_once_within_capacity(total, count, capacity):
+    index = random_index(total, seed=total)
+    groups = index.cluster(count, capacity=capacity)
+    assigned = [path for group in groups for path in group]
+    assert collections.Counter(assigned) == collections.Counter(index.paths)
+    assert len(groups) <= count
+    limit = max(capacity or 0, -(-total // min(count, total)))
+    assert max(len(group) for group in groups) <= limit
+
+
+def test_cluster_capacity_splits_single_blob():
+    # 1つの塊でも容量を超えないように分ける
+    index = blob_index([0.0], 30)
+    groups = index.cluster(3, capacity=10)
+    assert [len(group) for group in groups] == [10, 10, 10]
+    assert sorted(path for group in groups for path in group) == sorted(index.paths)
+
+
+def test_assign_with_capacity_prefers_nearest():
+    distances = np.array([[0.0, 1.0], [0.1, 1.0], [0.2, 1.0], [5.0, 0.0]], dtype=np.float32)
+    assignment = _assign_with_capacity(distances, 2)
+    # 中心0には近い2枚だけ入り、溢れた1枚は次に近い中心1に入る
+    assert list(assignment) == [0, 0, 1, 1]
+
+
+def test_cluster_empty():
+    assert ColorIndex([], np.zeros((0, FEATURE_DIM), dtype=np.float32)).cluster(3) == []
+
+
+def test_color_feature_similarity():
+    red, dark_red, blue = (color_feature(Image.new("RGB", (64, 48), color))
+                           for color in ((220, 30, 30), (180, 20, 20), (30, 30, 220)))
+    assert red.shape == (FEATURE_DIM,) and red.dtype == np.float32
+    index = ColorIndex(["red", "dark_red", "blue"], [red, dark_red, blue])
+    assert [path for path, _ in index.knn("red", k=2)] == ["dark_red", "blue"]
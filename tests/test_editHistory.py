@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+EditHistory(元に戻す/やり直し)のテスト
+"""
+from photoBook.editHistory import HISTORY_CHUNK_SIZE, EditHistory, build_snapshot, changed_indexes
+BLOCK_COUNT = HISTORY_CHUNK_SIZE * 3 + 4
+VIEW_STATE = ("グリッド", 10)
+
+
+class Model:
+    """PhotoCollageView と同じ手順で履歴を使うブロックの状態の一覧"""
+
+    def __init__(self, count=BLOCK_COUNT, **kwargs):
+        self.states = [("photo_%03d.jpg" % i, object(), 0.0, 1.0, 0) for i in range(count)]
+        self.view_state = VIEW_STATE
+        self.history = EditHistory(**kwargs)
+
+    def begin_edit(self, label, merge_key=None):
+        # type: (str, object) -> bool
+        return self.history.checkpoint(self.history.snapshot(self.states, self.view_state, label), merge_key)
+
+    def move(self, index, offset, label="画像の移動", merge_key=None):
+        # type: (int, float, str, object) -> None
+        self.begin_edit(label, merge_key)
+        path, image, _, scale, rotation = self.states[index]
+        self.states[index] = (path, image, offset, scale, rotation)
+
+    def undo(self):
+        # type: () -> str | None
+        return self._restore(self.history.undo(self.states, self.view_state))
+
+    def redo(self):
+        # type: () -> str | None
+        return self._restore(self.history.redo(self.states, self.view_state))
+
+    def _restore(self, step):
+        # type: (tuple | None) -> str | None
+        """変わったブロックだけ書き換え、操作の名前を返す"""
+        if step is None:
+            return None
+        current, target = step
+        states = target.states()
+        for index in changed_indexes(current, target):
+            self.states[index] = states[index]
+        self.view_state = target.view_state
+        return target.label
+
+
+def test_undo_redo_round_trip():
+    model = Model()
+    original = list(model.states)
+    model.move(3, 0.1)
+    after_first = list(model.states)
+    model.move(HISTORY_CHUNK_SIZE + 5, 0.2, label="拡大")
+    after_second = list(model.states)
+
+    assert model.undo() == "拡大"
+    assert model.states == after_first
+    assert model.undo() == "画像の移動"
+    assert model.states == original
+    assert model.undo() is None
+    assert not model.history.can_undo()
+
+    assert model.redo() == "画像の移動"
+    assert model.states == after_first
+    assert model.redo() == "拡大"
+    assert model.states == after_second
+    assert not model.history.can_redo()
+    # 戻した画像は同じオブジェクト(複製しない)
+    assert all(a[1] is b[1] for a, b in zip(model.states, after_second))
+
+
+def test_noop_edit_keeps_redo():
+    model = Model()
+    model.move(0, 0.5)
+    model.undo()
+    assert model.history.can_redo()
+
+    # 何も変えなかった操作はやり直しの履歴を消さない
+    model.begin_edit("回転")
+    model.history.settle(model.states, model.view_state)
+    assert model.history.can_redo()
+    assert model.redo() == "画像の移動"
+    assert model.states[0][2] == 0.5
+
+    # 状態を変えた操作はやり直しの履歴を消す
+    model.undo()
+    model.move(1, 0.3)
+    model.history.settle(model.states, model.view_state)
+    assert not model.history.can_redo()
+    assert model.redo() is None
+
+
+def test_unchanged_chunks_are_shared():
+    model = Model()
+    model.move(HISTORY_CHUNK_SIZE + 1, 0.5)
+    # begin_edit で渡した編集前の状態と、編集後の状態を比べる
+    first = model.history.snapshot(model.states, model.view_state)
+    model.history.checkpoint(first)
+    model.states[HISTORY_CHUNK_SIZE * 2 + 2] = ("replaced.jpg", object(), 0.0, 1.0, 0)
+    second = model.history.snapshot(model.states, model.view_state)
+
+    assert len(second.chunks) == 4
+    assert second.chunks[0] is first.chunks[0]
+    assert second.chunks[1] is first.chunks[1]
+    assert second.chunks[2] is not first.chunks[2]
+    assert second.chunks[3] is first.chunks[3]
+    # 変わったチャンクでも変わっていない状態のタプルは使い回す
+    assert second.chunks[2][0] is first.chunks[2][0]
+    assert changed_indexes(first, second) == [HISTORY_CHUNK_SIZE * 2 + 2]
+
+
+def test_equal_states_are_shared_but_images_compare_by_identity():
+    states = [("a.jpg", object(), 0.0), ("b.jpg", object(), 0.0)]
+    previous = build_snapshot(states, VIEW_STATE)
+    # 等しいスカラー値だけの新しいタプルは前のタプルを使う
+    same = build_snapshot([tuple(state) for state in states], VIEW_STATE, previous=previous)
+    assert same.chunks[0] is previous.chunks[0]
+    # 画像は == ではなく同一性で比べる
+    replaced = build_snapshot([("a.jpg", object(), 0.0), states[1]], VIEW_STATE, previous=previous)
+    assert changed_indexes(previous, replaced) == [0]
+
+
+def test_changed_indexes_when_block_count_changes():
+    model = Model()
+    before = model.history.snapshot(model.states, model.view_state)
+    after = model.history.snapshot(model.states[:HISTORY_CHUNK_SIZE + 2], model.view_state)
+    assert changed_indexes(before, after) == list(range(HISTORY_CHUNK_SIZE + 2, BLOCK_COUNT))
+    assert changed_indexes(after, before) == list(range(HISTORY_CHUNK_SIZE + 2, BLOCK_COUNT))
+
+
+def test_merge_key_groups_edits():
+    model = Model(merge_seconds=60.0)
+    for step in range(5):
+        model.move(0, 0.1 * (step + 1), merge_key="wheel")
+    model.move(1, 0.2, label="拡大")
+    model.history.settle(model.states, model.view_state)
+    assert len(model.history) == 2
+
+    assert model.undo() == "拡大"
+    assert model.undo() == "画像の移動"
+    assert model.states[0][2] == 0.0
+    assert not model.history.can_undo()
+
+
+def test_merge_window_expires():
+    model = Model(merge_seconds=0.0)
+    model.move(0, 0.1, merge_key="wheel")
+    model.move(0, 0.2, merge_key="wheel")
+    model.history.settle(model.states, model.view_state)
+    assert len(model.history) == 2
+
+
+def test_limit_drops_oldest_steps():
+    model = Model(limit=3)
+    for step in range(5):
+        model.move(step, 1.0)
+    model.history.settle(model.states, model.view_state)
+    assert len(model.history) == 3
+    while model.undo():
+        pass
+    # 最初の2ステップは戻せない
+    assert [state[2] for state in model.states[:5]] == [1.0, 1.0, 0.0, 0.0, 0.0]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+MirrorCache のテスト(ローカルのフォルダーを throttle で低速なストレージの代わりにする)
+"""
+import os
+import threading
+import time
+import pytest
+from photoBook.mirrorCache import MirrorCache
+SOURCE_BYTES = 256 * 1024
+THROTTLE_BYTES_PER_SEC = 1024 * 1024
+"""SOURCE_BYTES のコピーに約 0.25 秒かかる速度"""
+
+
+@pytest.fixture
+def source_path(tmp_path):
+    path = tmp_path / "source" / "photo.jpg"
+    path.parent.mkdir()
+    path.write_bytes(os.urandom(SOURCE_BYTES))
+    return str(path)
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    caches = []
+
+    def make(**kwargs):
+        cache = MirrorCache(str(tmp_path / "mirror"), **kwargs)
+        caches.append(cache)
+        return cache
+    yield make
+    for cache in caches:
+        cache.shutdown()
+
+
+def resolve_in_worker(cache, path):
+    # type: (MirrorCache, str) -> tuple[str, float]
+    """デコードのワーカーと同じく、GUIスレッド以外から resolve する"""
+    result = {}
+
+    def run():
+        start = time.perf_counter()
+        result["path"] = cache.resolve(path)
+        result["seconds"] = time.perf_counter() - start
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return result["path"], result["seconds"]
+
+
+def test_throttled_copy_is_slow_and_resolves_to_copy(make_cache, source_path):
+    cache = make_cache(throttle_bytes_per_sec=THROTTLE_BYTES_PER_SEC)
+    start = time.perf_counter()
+    cache.mirror([source_path])
+    assert cache.wait(10.0)
+    assert time.perf_counter() - start >= 0.2
+
+    local_path = cache.resolve(source_path)
+    assert local_path != source_path
+    with open(local_path, "rb") as local, open(source_path, "rb") as source:
+        assert local.read() == source.read()
+
+
+def test_worker_waits_for_copy_in_progress(make_cache, source_path):
+    cache = make_cache(throttle_bytes_per_sec=THROTTLE_BYTES_PER_SEC)
+    cache.mirror([source_path])
+    path, _ = resolve_in_worker(cache, source_path)
+    assert path != source_path
+    assert path == cache.local_path(source_path)
+
+
+def test_worker_falls_back_to_source_when_copy_stalls(make_cache, source_path):
+    # 応答しないマウントの代わりに、アクセスごとに長く待たせる
+    cache = make_cache(throttle_latency=1.0, resolve_timeout=0.1)
+    cache.mirror([source_path])
+    path, seconds = resolve_in_worker(cache, source_path)
+    assert path == source_path
+    assert seconds < 0.5
+
+
+def test_changed_source_is_copied_again(make_cache, source_path):
+    cache = make_cache(throttle_bytes_per_sec=THROTTLE_BYTES_PER_SEC * 8)
+    cache.mirror([source_path])
+    assert cache.wait(10.0)
+    with open(source_path, "wb") as f:
+        f.write(b"changed")
+    os.utime(source_path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+
+    # 元画像の変更は mirror を呼んだ時に確認する
+    cache.mirror([source_path])
+    assert cache.wait(10.0)
+    with open(cache.resolve(source_path), "rb") as f:
+        assert f.read() == b"changed"
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+出力サーバーのクライアント(LocalRenderClient と HTTP の RenderClient)のテスト
+"""
+import io
+import threading
+import pytest
+from PIL import Image
+from photoBook.define import SIZE_PRESETS
+from photoBook.renderClient import LocalRenderClient, RenderClient, RenderError
+from photoBook.renderDaemon import RenderHTTPServer, RenderService
+from photoBook.tileCache import TileCache
+SIZE_PRESET = 'L判 1052 x 1500 px (300 DPI)'
+
+
+def make_layout(image_paths, offset_x=0.0):
+    # type: (list[str], float) -> dict
+    """2x1 のセルに画像を割り当てた save_layout 形式のレイアウト"""
+    return {
+        "input_context": {"size_preset": SIZE_PRESET, "size_switch": False, "bg_color": (255, 255, 255),
+                          "space_margin": 10, "top_under_margin": 10, "side_margin": 10},
+        "photo_context": [
+            {"rect_ratio": (0.5 * index, 0.0, 0.5, 1.0), "file_path": path, "offset_x": offset_x,
+             "offset_y": 0.0, "scale": 1.0, "rotation": 90 * index}
+            for index, path in enumerate(image_paths)],
+    }
+
+
+@pytest.fixture
+def image_paths(tmp_path):
+    paths = []
+    for index, color in enumerate(((200, 40, 40), (40, 40, 200))):
+        path = str(tmp_path / ("photo_%d.jpg" % index))
+        Image.new("RGB", (300, 200), color).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def client():
+    service = RenderService(max_workers=1)
+    yield LocalRenderClient(service)
+    service.shutdown()
+
+
+def test_render_returns_encoded_image(client, image_paths):
+    result = client.render(make_layout(image_paths), image_format="png")
+    width, height, _ = SIZE_PRESETS[SIZE_PRESET]
+    assert result.path is None
+    assert result.content_type == "image/png"
+    with Image.open(io.BytesIO(result.data)) as image:
+        assert image.size == (result.width, result.height)
+        assert sorted(image.size) == sorted((width, height))
+
+
+def test_render_saves_to_out_path(client, image_paths, tmp_path):
+    out_path = str(tmp_path / "collage.jpg")
+    result = client.render(make_layout(image_paths), out_path)
+    assert result.path == out_path
+    assert result.data is None
+    with Image.open(out_path) as image:
+        assert image.format == "JPEG"
+        assert image.size == (result.width, result.height)
+
+
+def test_caches_are_warm_across_requests(client, image_paths):
+    client.render(make_layout(image_paths))
+    stats = client.stats()
+    assert stats["completed"] == 1
+    assert stats["tile_cache_misses"] == 2
+    assert stats["source_cache_misses"] == 2
+
+    # 同じレイアウトはタイルから合成する
+    client.render(make_layout(image_paths))
+    stats = client.stats()
+    assert stats["tile_cache_hits"] == 2
+    assert stats["source_cache_misses"] == 2
+
+    # 配置だけ変えた場合はタイルを描画し直すが、元画像はデコードし直さない
+    client.render(make_layout(image_paths, offset_x=0.05))
+    stats = client.stats()
+    assert stats["tile_cache_misses"] == 4
+    assert stats["source_cache_hits"] == 2
+    assert stats["source_cache_misses"] == 2
+    assert stats["source_cache_bytes"] > 0
+
+
+def test_invalid_layout_raises_render_error(client, image_paths):
+    layout = make_layout(image_paths)
+    layout["input_context"]["size_preset"] = "unknown"
+    with pytest.raises(RenderError) as error:
+        client.render(layout)
+    assert error.value.status == 400
+    assert client.stats()["failed"] == 1
+
+
+def test_rejected_submit_releases_slot(image_paths):
+    service = RenderService(max_workers=1, max_queue=0)
+    service.shutdown()
+    # 投入できなかったリクエストが枠を使い切らず、待ち行列が一杯(503)にならない
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            service.render(make_layout(image_paths))
+    stats = service.stats()
+    assert stats["rejected"] == 0
+    assert stats["queued"] == 0
+
+
+class BlockingTileCache(TileCache):
+    """release されるまでタイルの取得で待つ(描画中のワーカーを作るため)"""
+
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def get(self, key):
+        self.entered.set()
+        self.released.wait(10.0)
+        return super().get(key)
+
+
+@pytest.fixture
+def make_server():
+    running = []
+
+    def make(**kwargs):
+        service = RenderService(**kwargs)
+        server = RenderHTTPServer(service, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        running.append((server, service, thread))
+        return server, RenderClient(port=server.server_address[1], timeout=30.0)
+    yield make
+    for server, service, thread in running:
+        server.shutdown()
+        server.server_close()
+        service.shutdown()
+        thread.join()
+
+
+def test_http_render_returns_encoded_image(make_server, image_paths):
+    _, http_client = make_server(max_workers=1)
+    result = http_client.render(make_layout(image_paths), image_format="png")
+    assert result.path is None
+    assert result.content_type == "image/png"
+    assert result.seconds > 0
+    with Image.open(io.BytesIO(result.data)) as image:
+        assert image.size == (result.width, result.height)
+    assert http_client.stats()["completed"] == 1
+
+
+def test_http_render_saves_to_out_path(make_server, image_paths, tmp_path):
+    _, http_client = make_server(max_workers=1)
+    out_path = str(tmp_path / "collage.png")
+    result = http_client.render(make_layout(image_paths), out_path)
+    assert result.path == out_path
+    assert result.data is None
+    with Image.open(out_path) as image:
+        assert image.size == (result.width, result.height)
+
+
+def test_http_errors(make_server, image_paths):
+    server, http_client = make_server(max_workers=1)
+    layout = make_layout(image_paths)
+    layout["input_context"]["size_preset"] = "unknown"
+    with pytest.raises(RenderError) as error:
+        http_client.render(layout)
+    assert error.value.status == 400
+
+    # JSONとして読めない本文と、存在しないパス
+    with pytest.raises(RenderError) as error:
+        http_client._request("POST", "/render", b"{not json")
+    assert error.value.status == 400
+    with pytest.raises(RenderError) as error:
+        http_client._request("GET", "/unknown")
+    assert error.value.status == 404
+    assert http_client.stats()["failed"] == 1
+
+
+def test_http_busy_when_queue_is_full(make_server, image_paths):
+    tile_cache = BlockingTileCache()
+    _, http_client = make_server(max_workers=1, max_queue=0, tile_cache=tile_cache)
+    first = threading.Thread(target=http_client.render, args=(make_layout(image_paths),))
+    first.start()
+    try:
+        assert tile_cache.entered.wait(10.0)
+        with pytest.raises(RenderError) as error:
+            http_client.render(make_layout(image_paths))
+        assert error.value.status == 503
+    finally:
+        tile_cache.released.set()
+        first.join()
+    stats = http_client.stats()
+    assert stats["rejected"] == 1
+    assert stats["completed"] == 1